@@ -14,14 +14,18 @@ import sys
 import time
 
 import logging as log
+import multiprocessing
 log.basicConfig(format='%(asctime)s: %(message)s',
                 datefmt='%m/%d %I:%M:%S %p', level=log.INFO)
 
 import torch
+from allennlp.nn.util import device_mapping
 
 from src.utils import config
+from src.utils import distributed
 
 from src.utils.utils import assert_for_log, maybe_make_dir, load_model_state, check_arg_name
+from src.utils.encoding_cache import EncodingCache
 from src.preprocess import build_tasks
 from src.models import build_model
 from src.trainer import build_trainer, build_trainer_params
@@ -48,6 +52,9 @@ def handle_arguments(cl_arguments):
                         "--tensorboard_port.")
     parser.add_argument('--tensorboard_port', type=int, default=6006)
 
+    # Set by torch.distributed.launch; see distributed_backend in config/defaults.conf.
+    parser.add_argument('--local_rank', type=int, default=0)
+
     return parser.parse_args(cl_arguments)
 
 
@@ -82,6 +89,112 @@ def _run_background_tensorboard(logdir, port):
     atexit.register(_kill_tb_child)
 
 
+def _train_target_task(args, model, task, elmo_scalars, run_dir):
+    ''' Train the task-specific components (and ELMo scalars, if any) for a target task,
+    saving the best model state to run_dir/model_state_eval_best.th. '''
+    pred_module = getattr(model, "%s_mdl" % task.name)
+    to_train = elmo_scalars + [(n, p)
+                               for n, p in pred_module.named_parameters() if p.requires_grad]
+    enc_cache = None
+    if args.cache_sent_encodings:
+        sent_encoder_params = set(id(p) for p in model.sent_encoder.parameters())
+        trained_encoder_params = [n for n, p in to_train if id(p) in sent_encoder_params]
+        if trained_encoder_params:
+            log.warning("Not caching sentence encodings for %s, since sentence encoder "
+                        "parameters are trained: %s", task.name,
+                        ", ".join(trained_encoder_params))
+        else:
+            enc_cache = EncodingCache(
+                args.sent_encoding_cache_mb * 2**20,
+                os.path.join(run_dir, "sent_encodings_%s.%d.bin" %
+                             (task.name, distributed.get_rank())))
+            model.sent_encoder.enable_cache(enc_cache)
+    # Look for <task_name>_<param_name>, then eval_<param_name>
+    params = build_trainer_params(args, task_names=[task.name, 'eval'])
+    trainer, _, opt_params, schd_params = build_trainer(params, model,
+                                                        run_dir,
+                                                        task.val_metric_decreases)
+    trainer.train([task], task.val_metric,
+                  args.batch_size, 1,
+                  args.weighting_method, args.scaling_method,
+                  to_train, opt_params, schd_params,
+                  args.shared_optimizer, load_model=False, phase="eval")
+    if enc_cache is not None:
+        model.sent_encoder.enable_cache(None)
+        enc_cache.close()
+
+
+def _run_target_task_process(args, model, task, elmo_scalars, task_dir, num_threads):
+    # Runs in a forked child; the model's weights are shared copy-on-write with the parent.
+    torch.set_num_threads(num_threads)
+    log.getLogger().addHandler(log.FileHandler(os.path.join(task_dir, "log.log")))
+    _train_target_task(args, model, task, elmo_scalars, task_dir)
+
+
+def _train_target_tasks_concurrently(args, model, tasks, elmo_scalars):
+    ''' Train target tasks in up to args.target_training_workers forked processes at once,
+    each saving its best model state in its own directory under run_dir. Then merge the
+    parameters each task changed into a single run_dir/model_state_eval_best.th.
+
+    Returns:
+        the path of the merged model state
+    '''
+    num_workers = min(args.target_training_workers, len(tasks))
+    num_threads = max(1, os.cpu_count() // num_workers)
+    log.info("Training %d target tasks in %d processes", len(tasks), num_workers)
+    task_dirs = {task.name: os.path.join(args.run_dir, "target_%s" % task.name)
+                 for task in tasks}
+    context = multiprocessing.get_context('fork')
+    pending, running = list(tasks), {}
+    while pending or running:
+        while pending and len(running) < num_workers:
+            task = pending.pop(0)
+            maybe_make_dir(task_dirs[task.name])
+            process = context.Process(target=_run_target_task_process,
+                                      args=(args, model, task, elmo_scalars,
+                                            task_dirs[task.name], num_threads))
+            process.start()
+            log.info("Started training %s (pid %d)", task.name, process.pid)
+            running[task.name] = process
+        for task_name, process in list(running.items()):
+            process.join(timeout=1.0)
+            if process.exitcode is None:
+                continue
+            del running[task_name]
+            assert_for_log(process.exitcode == 0,
+                           "Training %s failed (exit code %d). See %s." %
+                           (task_name, process.exitcode,
+                            os.path.join(task_dirs[task_name], "log.log")))
+            log.info("Finished training %s", task_name)
+
+    # The children train copies of the model, so its parameters here are still the
+    # starting ones. Start from them, as saved by the trainer: without frozen
+    # parameters, like the main ELMo weights. state_dict() doesn't copy tensors.
+    frozen = set(name for name, param in model.named_parameters() if not param.requires_grad)
+    merged_state = {name: tensor for name, tensor in model.state_dict().items()
+                    if name not in frozen}
+    # Then take the parameters each task trained: its task module, and the ELMo
+    # scalars if changed.
+    changed_by = {}
+    for task in tasks:
+        task_state = torch.load(os.path.join(task_dirs[task.name], "model_state_eval_best.th"),
+                                map_location=device_mapping(args.cuda))
+        trained = [name for name in task_state if name.startswith("%s_mdl." % task.name)]
+        trained += [name for name, param in elmo_scalars
+                    if name in task_state and not torch.equal(task_state[name], param.data)]
+        for name in trained:
+            if name in changed_by:
+                log.warning("Parameter %s was trained by both %s and %s; keeping %s's.",
+                            name, changed_by[name], task.name, task.name)
+            merged_state[name] = task_state[name]
+            changed_by[name] = task.name
+        del task_state
+    layer_path = os.path.join(args.run_dir, "model_state_eval_best.th")
+    torch.save(merged_state, layer_path)
+    log.info("Merged target task model states into %s", layer_path)
+    return layer_path
+
+
 # Global notification handler, can be accessed outside main() during exception
 # handling.
 EMAIL_NOTIFIER = None
@@ -99,7 +212,13 @@ def main(cl_arguments):
     maybe_make_dir(args.project_dir)  # e.g. /nfs/jsalt/exp/$HOSTNAME
     maybe_make_dir(args.exp_dir)      # e.g. <project_dir>/jiant-demo
     maybe_make_dir(args.run_dir)      # e.g. <project_dir>/jiant-demo/sst
-    log.getLogger().addHandler(log.FileHandler(args.local_log_path))
+    if distributed.is_launched():
+        distributed.init(args.distributed_backend)
+    if distributed.is_main_process():
+        log.getLogger().addHandler(log.FileHandler(args.local_log_path))
+    else:
+        log.getLogger().addHandler(log.FileHandler(
+            "%s.rank%d" % (args.local_log_path, distributed.get_rank())))
 
     if cl_args.remote_log:
         from src.utils import gcp
@@ -118,14 +237,21 @@ def main(cl_arguments):
 
     log.info("Parsed args: \n%s", args)
 
-    config_file = os.path.join(args.run_dir, "params.conf")
-    config.write_params(args, config_file)
-    log.info("Saved config to %s", config_file)
+    if distributed.is_main_process():
+        config_file = os.path.join(args.run_dir, "params.conf")
+        config.write_params(args, config_file)
+        log.info("Saved config to %s", config_file)
 
     seed = random.randint(1, 10000) if args.random_seed < 0 else args.random_seed
+    seed = distributed.broadcast_object(seed)
+    # Keep the seed in use, e.g. to shuffle training data the same way in all processes.
+    args.random_seed = seed
     random.seed(seed)
     torch.manual_seed(seed)
     log.info("Using random seed %d", seed)
+    if distributed.is_initialized():
+        assert_for_log(args.cuda < 0, "Distributed training is only supported on CPU. "
+                       "Set cuda = -1.")
     if args.cuda >= 0:
         try:
             if not torch.cuda.is_available():
@@ -142,7 +268,12 @@ def main(cl_arguments):
     # Prepare data #
     log.info("Loading tasks...")
     start_time = time.time()
+    # In distributed training, let rank 0 preprocess the data, then load it in the others.
+    if not distributed.is_main_process():
+        distributed.barrier()
     pretrain_tasks, target_tasks, vocab, word_embs = build_tasks(args)
+    if distributed.is_main_process():
+        distributed.barrier()
     if any([t.val_metric_decreases for t in pretrain_tasks]) and any(
             [not t.val_metric_decreases for t in pretrain_tasks]):
         log.warn("\tMixing training tasks with increasing and decreasing val metrics!")
@@ -197,7 +328,7 @@ def main(cl_arguments):
         steps_log.append("Evaluating model on tasks: %s" % args.target_tasks)
 
     # Start Tensorboard if requested
-    if cl_args.tensorboard:
+    if cl_args.tensorboard and distributed.is_main_process():
         tb_logdir = os.path.join(args.run_dir, "tensorboard")
         _run_background_tensorboard(tb_logdir, cl_args.tensorboard_port)
 
@@ -278,47 +409,49 @@ def main(cl_arguments):
         assert_for_log(not elmo_scalars or args.sep_embs_for_skip,
                        "Error: ELMo scalars loaded and will be updated in do_target_task_training but "
                        "they should not be updated! Check sep_embs_for_skip flag or make an issue.")
-        for task in target_tasks:
-            # Skip mnli-diagnostic
-            # This has to be handled differently than probing tasks because probing tasks require the "is_probing_task"
-            # to be set to True. For mnli-diagnostic this flag will be False because it is part of GLUE and
-            # "is_probing_task is global flag specific to a run, not to a task.
-            if task.name == 'mnli-diagnostic':
-                continue
-            pred_module = getattr(model, "%s_mdl" % task.name)
-            to_train = elmo_scalars + [(n, p)
-                                       for n, p in pred_module.named_parameters() if p.requires_grad]
-            # Look for <task_name>_<param_name>, then eval_<param_name>
-            params = build_trainer_params(args, task_names=[task.name, 'eval'])
-            trainer, _, opt_params, schd_params = build_trainer(params, model,
-                                                                args.run_dir,
-                                                                task.val_metric_decreases)
-            best_epoch = trainer.train([task], task.val_metric,
-                                       args.batch_size, 1,
-                                       args.weighting_method, args.scaling_method,
-                                       to_train, opt_params, schd_params,
-                                       args.shared_optimizer, load_model=False, phase="eval")
-
-            # Now that we've trained a model, revert to the normal checkpoint logic for this task.
-            task_names_to_avoid_loading.remove(task.name)
-
-            # The best checkpoint will accumulate the best parameters for each task.
-            # This logic looks strange. We think it works.
-            best_epoch = best_epoch[task.name]
-            layer_path = os.path.join(args.run_dir, "model_state_eval_best.th")
+        # Skip mnli-diagnostic
+        # This has to be handled differently than probing tasks because probing tasks require the "is_probing_task"
+        # to be set to True. For mnli-diagnostic this flag will be False because it is part of GLUE and
+        # "is_probing_task is global flag specific to a run, not to a task.
+        tasks_to_train = [task for task in target_tasks if task.name != 'mnli-diagnostic']
+        if args.target_training_workers > 1 and len(tasks_to_train) > 1:
+            assert_for_log(args.cuda < 0 and not distributed.is_initialized(),
+                           "target_training_workers > 1 is only supported for CPU training "
+                           "in a single process (cuda = -1, no distributed launcher).")
+            layer_path = _train_target_tasks_concurrently(args, model, tasks_to_train,
+                                                          elmo_scalars)
+            task_names_to_avoid_loading = [name for name in task_names_to_avoid_loading
+                                           if name not in [t.name for t in tasks_to_train]]
             load_model_state(
                 model,
                 layer_path,
                 args.cuda,
                 skip_task_models=task_names_to_avoid_loading,
                 strict=strict)
+        else:
+            for task in tasks_to_train:
+                _train_target_task(args, model, task, elmo_scalars, args.run_dir)
 
-    if args.do_full_eval:
+                # Now that we've trained a model, revert to the normal checkpoint logic for this task.
+                task_names_to_avoid_loading.remove(task.name)
+
+                # The best checkpoint will accumulate the best parameters for each task.
+                # This logic looks strange. We think it works.
+                layer_path = os.path.join(args.run_dir, "model_state_eval_best.th")
+                load_model_state(
+                    model,
+                    layer_path,
+                    args.cuda,
+                    skip_task_models=task_names_to_avoid_loading,
+                    strict=strict)
+
+    if args.do_full_eval and distributed.is_main_process():
         # Evaluate #
         log.info("Evaluating...")
         val_results, val_preds = evaluate.evaluate(model, target_tasks,
                                                    args.batch_size,
-                                                   args.cuda, "val")
+                                                   args.cuda, "val",
+                                                   num_workers=args.evaluation_workers)
 
         splits_to_write = evaluate.parse_write_preds_arg(args.write_preds)
         if 'val' in splits_to_write:
@@ -326,7 +459,8 @@ def main(cl_arguments):
                                  strict_glue_format=args.write_strict_glue_format)
         if 'test' in splits_to_write:
             _, te_preds = evaluate.evaluate(model, target_tasks,
-                                            args.batch_size, args.cuda, "test")
+                                            args.batch_size, args.cuda, "test",
+                                            num_workers=args.evaluation_workers)
             evaluate.write_preds(tasks, te_preds, args.run_dir, 'test',
                                  strict_glue_format=args.write_strict_glue_format)
         run_name = args.get("run_name", os.path.basename(args.run_dir))
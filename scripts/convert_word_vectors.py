@@ -0,0 +1,12 @@
+'''
+Convert a GloVe / fastText text vector file to the binary format read by
+get_embeddings (<file>.npy and <file>.words, written next to it).
+Require one argument: path_to_vectors_file.
+'''
+
+import sys
+from src.utils import word_vectors # use symlink from scripts to src
+
+path = sys.argv[1]
+num_words, d_word = word_vectors.convert_word_vectors(path)
+print("Converted %d vectors of dimension %d from %s" % (num_words, d_word, path))
@@ -0,0 +1,78 @@
+''' BucketIterator that forms batches under a budget of padded tokens '''
+import itertools
+import math
+import random
+
+from overrides import overrides
+from allennlp.data.dataset import Batch
+from allennlp.data.iterators import BucketIterator
+from allennlp.data.iterators.bucket_iterator import sort_by_padding
+
+
+class TokenBudgetBucketIterator(BucketIterator):
+    """A BucketIterator whose batches hold as many instances as fit in max_tokens.
+
+    Instances are sorted by sorting_keys within each max_instances_in_memory
+    window, as in BucketIterator, and then grouped greedily so that the padded
+    size of each batch, i.e. the number of instances times the sum over text
+    fields of the longest field in the batch, stays within max_tokens. So
+    batches of short sentences are large and batches of long ones are small.
+    Text fields are the sorting keys with padding key "num_tokens"; an instance
+    that exceeds the budget on its own is put in a batch by itself.
+
+    batch_size is ignored.
+    """
+
+    def __init__(self, sorting_keys, max_tokens, **kwargs):
+        super().__init__(sorting_keys, **kwargs)
+        self._max_tokens = max_tokens
+        self._token_keys = [(field, pad_field) for field, pad_field in sorting_keys
+                            if pad_field == "num_tokens"]
+        assert self._token_keys, "No text fields in sorting keys: %s" % str(sorting_keys)
+
+    def _get_lengths(self, instance):
+        padding_lengths = instance.get_padding_lengths()
+        return [padding_lengths[field][pad_field] for field, pad_field in self._token_keys]
+
+    def _group_by_budget(self, instance_list):
+        batch, max_lengths = [], [0] * len(self._token_keys)
+        for instance in instance_list:
+            lengths = self._get_lengths(instance)
+            new_max_lengths = [max(a, b) for a, b in zip(max_lengths, lengths)]
+            if batch and (len(batch) + 1) * sum(new_max_lengths) > self._max_tokens:
+                yield batch
+                batch, new_max_lengths = [], lengths
+            batch.append(instance)
+            max_lengths = new_max_lengths
+        if batch:
+            yield batch
+
+    @overrides
+    def _create_batches(self, instances, shuffle):
+        for instance_list in self._memory_sized_lists(instances):
+            instance_list = sort_by_padding(instance_list, self._sorting_keys,
+                                            self.vocab, self._padding_noise)
+            batches = [Batch(batch) for batch in self._group_by_budget(instance_list)]
+
+            # Same as BucketIterator: the last batches hold the longest instances.
+            move_to_front = self._biggest_batch_first and len(batches) > 1
+            if move_to_front:
+                last_batch = batches.pop()
+                penultimate_batch = batches.pop()
+            if shuffle:
+                random.shuffle(batches)
+            if move_to_front:
+                batches.insert(0, penultimate_batch)
+                batches.insert(0, last_batch)
+
+            yield from batches
+
+    def estimate_num_batches(self, instances, num_instances, sample_size=1000):
+        ''' Estimate the number of batches in an epoch of num_instances instances,
+        from the token counts of the first sample_size of them. Padding within
+        batches is ignored, so this is a slight underestimate. '''
+        sample = list(itertools.islice(instances, sample_size))
+        if not sample:
+            return 0
+        n_tokens = sum(sum(self._get_lengths(instance)) for instance in sample)
+        return math.ceil(num_instances * n_tokens / len(sample) / self._max_tokens)
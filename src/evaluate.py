@@ -1,7 +1,10 @@
 """ Helper functions to evaluate a model on a dataset """
 import os
 import time
+import itertools
 import logging as log
+import multiprocessing
+import queue
 
 import json
 import pandas as pd
@@ -9,8 +12,11 @@ from csv import QUOTE_NONE, QUOTE_MINIMAL
 
 import torch
 from allennlp.data.iterators import BasicIterator
+from allennlp.training.metrics import Metric
 from . import tasks as tasks_module
 from .tasks.edge_probing import EdgeProbingTask
+from .utils import serialize
+from .utils.tensor_store import TensorBatchIterator
 from allennlp.nn.util import move_to_device
 
 from typing import List, Sequence, Iterable, Tuple, Dict
@@ -34,14 +40,170 @@ def parse_write_preds_arg(write_preds_arg: str) -> List[str]:
         return write_preds_arg.split(",")
 
 
+FIELDS_TO_EXPORT = ['idx', 'sent1_str', 'sent2_str', 'labels']
+# Enforce that these tasks have the 'idx' field set.
+IDX_REQUIRED_TASK_NAMES = tasks_module.ALL_GLUE_TASKS + ['wmt']
+
+
+def _evaluate_batch(model, task, batch, cuda_device):
+    ''' Run the model on a batch, updating the task's metrics.
+
+    Returns:
+        n_exs: number of examples in the batch, as counted by the model
+        preds: DataFrame with columns ['preds'] + FIELDS_TO_EXPORT, or None
+    '''
+    batch = move_to_device(batch, cuda_device)
+    out = model.forward(task, batch, predict=True)
+    # get predictions
+    if 'preds' not in out:
+        return out["n_exs"], None
+    preds = _coerce_list(out['preds'])
+    assert isinstance(preds, list), "Convert predictions to list!"
+    cols = {"preds": preds}
+    if task.name in IDX_REQUIRED_TASK_NAMES:
+        assert 'idx' in batch, (f"'idx' field missing from batches "
+                                "for task {task.name}!")
+    for field in FIELDS_TO_EXPORT:
+        if field in batch:
+            cols[field] = _coerce_list(batch[field])
+
+    # Transpose data using Pandas
+    return out["n_exs"], pd.DataFrame(cols)
+
+
+class _Array(object):
+    ''' A tensor converted to NumPy, to send it between processes. '''
+
+    def __init__(self, tensor):
+        self.array = tensor.detach().cpu().numpy()
+
+
+def _to_picklable(value):
+    return _Array(value) if isinstance(value, torch.Tensor) else value
+
+
+def _from_picklable(value):
+    return torch.from_numpy(value.array) if isinstance(value, _Array) else value
+
+
+class _MetricRecorder(object):
+    ''' Stands in for a task's Metric attribute, recording calls to it instead. '''
+
+    def __init__(self, name, calls):
+        self._name = name
+        self._calls = calls
+
+    def __call__(self, *args, **kwargs):
+        self._calls.append((self._name, [_to_picklable(arg) for arg in args],
+                            {key: _to_picklable(arg) for key, arg in kwargs.items()}))
+
+
+def _iter_batches(dataset, batch_size):
+    ''' Yield the batches of dataset in order, as tensor dicts. '''
+    if TensorBatchIterator.can_read(dataset):
+        iterator = TensorBatchIterator(batch_size)
+    else:
+        iterator = BasicIterator(batch_size)
+    return iterator(dataset, num_epochs=1, shuffle=False)
+
+
+def _get_shard(instances, batch_size, shard_idx, num_shards):
+    ''' Return the instances of every num_shards-th batch, starting with batch shard_idx. '''
+    if isinstance(instances, serialize.RepeatableIterator):
+        # Read only the records of this shard's batches from disk.
+        shard = instances.shard(shard_idx, num_shards, chunk_size=batch_size)
+        if shard is not None:
+            return shard
+    return (instance for i, instance in enumerate(instances)
+            if (i // batch_size) % num_shards == shard_idx)
+
+
+# (model, task, dataset, batch_size, cuda_device, num_shards) for the task
+# currently being evaluated, inherited by forked worker processes.
+_EVAL_JOB = None
+
+
+def _evaluate_shard(shard_idx, out_queue):
+    ''' Evaluate a shard of _EVAL_JOB, recording metric updates rather than applying them.
+
+    Puts a list of (batch index, n_exs, preds, metric calls), one per batch,
+    on out_queue.
+    '''
+    model, task, dataset, batch_size, cuda_device, num_shards = _EVAL_JOB
+    # Split the cores between the workers, rather than each using all of them.
+    torch.set_num_threads(max(1, os.cpu_count() // num_shards))
+    calls = []
+    for name, value in list(task.__dict__.items()):
+        if isinstance(value, Metric):
+            setattr(task, name, _MetricRecorder(name, calls))
+    results = []
+    generator = _iter_batches(_get_shard(dataset, batch_size, shard_idx, num_shards), batch_size)
+    for i, batch in enumerate(generator):
+        n_calls = len(calls)
+        n_exs, preds = _evaluate_batch(model, task, batch, cuda_device)
+        results.append((i * num_shards + shard_idx, _to_picklable(n_exs), preds,
+                        calls[n_calls:]))
+    out_queue.put(results)
+
+
+def _evaluate_sharded(model, task, dataset, batch_size, cuda_device, num_workers):
+    ''' Evaluate on dataset with num_workers forked processes, each running its
+    own shard of batches. Metric updates and predictions are merged in batch
+    order, so the results are the same as evaluating in one process.
+
+    Returns:
+        list of (n_exs, preds) per batch, as from _evaluate_batch
+    '''
+    global _EVAL_JOB
+    _EVAL_JOB = (model, task, dataset, batch_size, cuda_device, num_workers)
+    ctx = multiprocessing.get_context('fork')
+    out_queue = ctx.Queue()
+    # Not a Pool: its workers are daemonic, and so couldn't start processes of
+    # their own while reading the data.
+    workers = [ctx.Process(target=_evaluate_shard, args=(shard_idx, out_queue))
+               for shard_idx in range(num_workers)]
+    try:
+        for worker in workers:
+            worker.start()
+        shard_results = []
+        while len(shard_results) < num_workers:
+            try:
+                shard_results.append(out_queue.get(timeout=1.0))
+            except queue.Empty:
+                failed = [w.exitcode for w in workers if w.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError("Evaluation worker for %s failed (exit code %d)" %
+                                       (task.name, failed[0]))
+        for worker in workers:
+            worker.join()
+    finally:
+        _EVAL_JOB = None
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    batch_results = sorted(itertools.chain.from_iterable(shard_results), key=lambda r: r[0])
+    outputs = []
+    for _, n_exs, preds, calls in batch_results:
+        # Apply each batch's metric updates, in the same order as a single process would.
+        for name, args, kwargs in calls:
+            getattr(task, name)(*[_from_picklable(arg) for arg in args],
+                                **{key: _from_picklable(arg) for key, arg in kwargs.items()})
+        outputs.append((_from_picklable(n_exs), preds))
+    return outputs
+
+
 def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
-             cuda_device: int, split="val") -> Tuple[Dict, pd.DataFrame]:
-    '''Evaluate on a dataset'''
-    FIELDS_TO_EXPORT = ['idx', 'sent1_str', 'sent2_str', 'labels']
-    # Enforce that these tasks have the 'idx' field set.
-    IDX_REQUIRED_TASK_NAMES = tasks_module.ALL_GLUE_TASKS + ['wmt']
+             cuda_device: int, split="val", num_workers=1) -> Tuple[Dict, pd.DataFrame]:
+    '''Evaluate on a dataset
+
+    If num_workers > 1, evaluate each task with that many processes, each
+    running a shard of the batches on its own copy of the model (CPU only).
+    '''
     model.eval()
-    iterator = BasicIterator(batch_size)
+    if num_workers > 1 and cuda_device >= 0:
+        log.warning("Sharded evaluation is only supported on CPU. Evaluating in one process.")
+        num_workers = 1
 
     all_metrics = {"micro_avg": 0.0, "macro_avg": 0.0}
     all_preds = {}
@@ -56,30 +218,20 @@ def evaluate(model, tasks: Sequence[tasks_module.Task], batch_size: int,
         task_preds = []  # accumulate DataFrames
         assert split in ["train", "val", "test"]
         dataset = getattr(task, "%s_data" % split)
-        generator = iterator(dataset, num_epochs=1, shuffle=False)
-        for batch_idx, batch in enumerate(generator):
-            batch = move_to_device(batch, cuda_device)
-            out = model.forward(task, batch, predict=True)
+        if num_workers > 1:
+            log.info("\tEvaluating in %d processes", num_workers)
+            batch_outputs = _evaluate_sharded(model, task, dataset, batch_size,
+                                              cuda_device, num_workers)
+        else:
+            batch_outputs = (_evaluate_batch(model, task, batch, cuda_device)
+                             for batch in _iter_batches(dataset, batch_size))
+        for batch_idx, (n_exs, preds) in enumerate(batch_outputs):
             # We don't want mnli-diagnostic to affect the micro and macro average.
             # Accuracy of mnli-diagnostic is hardcoded to 0.
             if task.name != "mnli-diagnostic":
-                n_examples += out["n_exs"]
-            # get predictions
-            if 'preds' not in out:
-                continue
-            preds = _coerce_list(out['preds'])
-            assert isinstance(preds, list), "Convert predictions to list!"
-            cols = {"preds": preds}
-            if task.name in IDX_REQUIRED_TASK_NAMES:
-                assert 'idx' in batch, (f"'idx' field missing from batches "
-                                        "for task {task.name}!")
-            for field in FIELDS_TO_EXPORT:
-                if field in batch:
-                    cols[field] = _coerce_list(batch[field])
-
-            # Transpose data using Pandas
-            df = pd.DataFrame(cols)
-            task_preds.append(df)
+                n_examples += n_exs
+            if preds is not None:
+                task_preds.append(preds)
 
             if time.time() - last_log > LOG_INTERVAL:
                 log.info("\tTask %s: batch %d", task.name, batch_idx)
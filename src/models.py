@@ -24,10 +24,10 @@ from allennlp.training.metrics import Average
 
 from .allennlp_mods.elmo_text_field_embedder import ElmoTextFieldEmbedder, ElmoTokenEmbedderWrapper
 from .utils.utils import assert_for_log, get_batch_utilization, \
-    get_batch_size, get_elmo_mixing_weights, maybe_make_dir
+    get_batch_size, get_elmo_mixing_weights, maybe_make_dir, parse_task_list_arg
 from .utils import config
 
-from .preprocess import parse_task_list_arg, get_tasks
+from .preprocess import get_tasks
 
 from .tasks.tasks import CCGTaggingTask, ClassificationTask, CoLATask, GroundedSWTask, \
     GroundedTask, MultiNLIDiagnosticTask, PairClassificationTask, \
@@ -620,6 +620,22 @@ class MultiTaskModel(nn.Module):
             raise ValueError("Task-specific components not found!")
         return out
 
+    def co_batch_forward(self, tasks, batches):
+        ''' Forward one batch for each task (tasks may repeat), with a single sentence
+        encoder call for the input1/input2 fields of all batches.
+
+        Returns:
+            - outs: list of task outputs, one per batch
+        '''
+        sents = [batch[field] for batch in batches for field in ['input1', 'input2']
+                 if field in batch]
+        if sents:
+            self.sent_encoder.encode_jointly(sents)
+        try:
+            return [self.forward(task, batch) for task, batch in zip(tasks, batches)]
+        finally:
+            self.sent_encoder.clear_precomputed()
+
     def _get_task_params(self, task_name):
         """ Get task-specific Params, as set in build_module(). """
         return getattr(self, "%s_task_params" % task_name)
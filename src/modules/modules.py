@@ -41,6 +41,7 @@ from allennlp.nn.util import add_positional_features
 
 from ..utils.utils import MaskedMultiHeadSelfAttention, assert_for_log
 from ..utils import utils
+from ..utils import encoding_cache
 
 from .cnns.alexnet import alexnet
 from .cnns.resnet import resnet101
@@ -95,9 +96,38 @@ class SentenceEncoder(Model):
         else:
             self._dropout = lambda x: x
         self._mask_lstms = mask_lstms
+        self._cache = None
+        self._precomputed = {}
 
         initializer(self)
 
+    def enable_cache(self, cache):
+        ''' Reuse sentence encodings stored in cache (an EncodingCache), computing and
+        storing those that aren't there yet. Only valid while the encoder isn't being
+        trained. Encodings are computed without dropout, which is instead applied to
+        the output when training. Pass None to disable. '''
+        self._cache = cache
+
+    def encode_jointly(self, sents):
+        ''' Encode several batches of sentences (TextField dicts) in one call, padding
+        them to a common length. Until clear_precomputed() is called, forward() on any
+        of these dicts returns its part of the result. Not valid with sep_embs_for_skip,
+        since the sentences may be from different tasks. '''
+        assert not self.sep_embs_for_skip, "Can't encode sentences of several tasks jointly."
+        self.reset_states()
+        joint_sent = {name: _cat_padded([sent[name] for sent in sents]) for name in sents[0]}
+        sent_enc, sent_mask = self._encode(joint_sent, None)
+        start = 0
+        for sent in sents:
+            mask = util.get_text_field_mask(sent)
+            end = start + mask.size(0)
+            self._precomputed[id(sent)] = (sent_enc[start:end, :mask.size(1)],
+                                           sent_mask[start:end, :mask.size(1)])
+            start = end
+
+    def clear_precomputed(self):
+        self._precomputed = {}
+
     def forward(self, sent, task, reset=True):
         # pylint: disable=arguments-differ
         """
@@ -112,9 +142,58 @@ class SentenceEncoder(Model):
                 the padded values in sent_enc are set to 0
             - sent_mask (torch.FloatTensor): (b_size, seq_len, d_emb); all 0/1s
         """
+        if id(sent) in self._precomputed:
+            return self._precomputed[id(sent)]
         if reset:
             self.reset_states()
-
+        if self._cache is not None and reset:
+            return self._cached_forward(sent, task)
+        return self._encode(sent, task)
+
+    def _get_cache_keys(self, sent, task):
+        ''' Get a cache key for each sentence in a batch, from all of its (unpadded) inputs. '''
+        inputs = []
+        for name in sorted(sent):
+            array = sent[name].cpu().numpy()
+            array = array.reshape(array.shape[0], array.shape[1], -1)
+            # Inputs are padded with 0s at the end, and may be padded differently in each batch.
+            nonzero = (array != 0).any(axis=-1)
+            lengths = numpy.where(nonzero.any(axis=1),
+                                  nonzero.shape[1] - numpy.argmax(nonzero[:, ::-1], axis=1), 0)
+            inputs.append([row[:length] for row, length in zip(array, lengths)])
+        # Task-specific embeddings differ by task.
+        prefix = [numpy.frombuffer(task._classifier_name.encode('utf-8'), dtype=numpy.uint8)] \
+            if self.sep_embs_for_skip else []
+        return [encoding_cache.get_key(prefix + list(rows)) for rows in zip(*inputs)]
+
+    def _cached_forward(self, sent, task):
+        sent_mask = util.get_text_field_mask(sent)
+        lengths = sent_mask.sum(dim=1).tolist()
+        keys = self._get_cache_keys(sent, task)
+
+        missing = [i for i, key in enumerate(keys) if key not in self._cache]
+        if missing:
+            missing_idxs = torch.tensor(missing, dtype=torch.long, device=sent_mask.device)
+            missing_sent = {name: tensor.index_select(0, missing_idxs)
+                            for name, tensor in sent.items()}
+            was_training = self.training
+            self.eval()
+            with torch.no_grad():
+                missing_enc, _ = self._encode(missing_sent, task)
+            self.train(was_training)
+            missing_enc = missing_enc.cpu().numpy()
+            for i, enc in zip(missing, missing_enc):
+                self._cache.put(keys[i], enc[:lengths[i]])
+
+        encs = [self._cache.get(key) for key in keys]
+        sent_enc = torch.zeros(sent_mask.size(0), sent_mask.size(1), encs[0].shape[-1])
+        for i, enc in enumerate(encs):
+            sent_enc[i, :lengths[i]] = torch.from_numpy(numpy.array(enc))
+        sent_enc = self._dropout(sent_enc.to(sent_mask.device))
+        sent_mask = sent_mask.float().unsqueeze(dim=-1)
+        return sent_enc.masked_fill(sent_mask == 0, 0), sent_mask
+
+    def _encode(self, sent, task):
         # Embeddings
         # Note: These highway modules are actually identity functions by default.
 
@@ -203,6 +282,19 @@ class SentenceEncoder(Model):
             self._phrase_layer.reset_states()
 
 
+def _cat_padded(tensors):
+    ''' Concatenate tensors along the first dimension, padding the other dimensions
+    with 0s to the largest size. '''
+    max_shape = [max(sizes) for sizes in zip(*[tensor.size() for tensor in tensors])]
+    padded = []
+    for tensor in tensors:
+        padding = []
+        for size, max_size in reversed(list(zip(tensor.size()[1:], max_shape[1:]))):
+            padding.extend([0, max_size - size])
+        padded.append(F.pad(tensor, padding) if any(padding) else tensor)
+    return torch.cat(padded, dim=0)
+
+
 class BiLMEncoder(ElmoLstm):
     """Wrapper around BiLM to give it an interface to comply with SentEncoder
     See base class: ElmoLstm
@@ -10,12 +10,16 @@ The pipeline is three steps
     3) index all the data using appropriate indexers
         We save indexed data to streamable Records to save memory.
 '''
-import io
 import os
 import sys
-import copy
+import heapq
+import itertools
 import logging as log
-from collections import defaultdict
+import multiprocessing
+import multiprocessing.connection
+import queue
+import shutil
+from collections import Counter, defaultdict
 import numpy as np
 import torch
 
@@ -32,11 +36,16 @@ except BaseException:
 import _pickle as pkl  # :(
 
 from .utils import config
+from .utils import distributed
 from .utils import serialize
+from .utils import shared_cache
 from .utils import utils
+from .utils import word_vectors
+from .utils.utils import parse_task_list_arg
 
 from .tasks import REGISTRY as TASKS_REGISTRY
-from .tasks import ALL_GLUE_TASKS, ALL_NLI_PROBING_TASKS, ALL_TARG_VOC_TASKS
+from .tasks import Task
+from .tasks import ALL_NLI_PROBING_TASKS, ALL_TARG_VOC_TASKS
 from .tasks.mt import MTTask
 
 SOS_TOK, EOS_TOK = "<SOS>", "<EOS>"  # NOTE: these are not that same as AllenNLP SOS, EOS tokens
@@ -45,6 +54,9 @@ UNK_TOK = "@@UNKNOWN@@"  # AllenNLP unk token
 
 ALL_SPLITS = ['train', 'val', 'test']
 
+# Splits smaller than this many examples per shard get fewer shards.
+MIN_EXAMPLES_PER_SHARD = 10000
+
 
 def _get_serialized_record_path(task_name, split, preproc_dir):
     """Get the canonical path for a serialized task split."""
@@ -53,7 +65,8 @@ def _get_serialized_record_path(task_name, split, preproc_dir):
     return serialized_record_path
 
 
-def _get_instance_generator(task_name, split, preproc_dir, fraction=None):
+def _get_instance_generator(task_name, split, preproc_dir, fraction=None, shuffle=False,
+                            shard=None, seed=None, prefetch_workers=0):
     """Get a lazy generator for the given task and split.
 
     Args:
@@ -63,13 +76,19 @@ def _get_instance_generator(task_name, split, preproc_dir, fraction=None):
         fraction: if set to a float between 0 and 1, load only the specified percentage
           of examples. Hashing is used to ensure that the same examples are loaded each
           epoch.
+        shuffle: if true, read the examples in a new random order on each pass.
+        shard, seed: to read only one shard of the examples, see serialize.read_records.
+        prefetch_workers: (int) if positive, read and unpickle the examples in
+          this many background processes.
 
     Returns:
         serialize.RepeatableIterator yielding Instance objects
     """
     filename = _get_serialized_record_path(task_name, split, preproc_dir)
     assert os.path.isfile(filename), ("Record file '%s' not found!" % filename)
-    return serialize.read_records(filename, repeatable=True, fraction=fraction)
+    return serialize.read_records(filename, repeatable=True, fraction=fraction,
+                                  shuffle=shuffle, shard=shard, seed=seed,
+                                  prefetch_workers=prefetch_workers)
 
 
 def _indexed_instance_generator(instance_iter, vocab):
@@ -107,7 +126,32 @@ def del_field_tokens(instance):
         del field.tokens
 
 
-def _index_split(task, split, indexers, vocab, record_file):
+def _get_source_shard_instances(task, split, indexers, shard):
+    """Return the Instances of shard (k, num_shards) of a streaming split.
+
+    Streaming loaders open their data file with utils.open_data_file, which then
+    reads only the k-th byte range of the file. Returns None if the split isn't
+    read that way, e.g. because it is held in memory.
+    """
+    split_text = task.get_split_text(split)
+    if hasattr(split_text, '__len__'):
+        return None
+    with utils.data_file_shard(*shard) as num_sharded_opens:
+        instance_iter = task.process_split(split_text, indexers)
+        if hasattr(instance_iter, '__len__'):
+            return None
+        # The data file is opened when the first Instance is made.
+        instance_iter = iter(instance_iter)
+        first = list(itertools.islice(instance_iter, 1))
+        if not num_sharded_opens():
+            log.warning("\tTask '%s', split '%s': data isn't read with open_data_file, so each "
+                        "shard reads the split from the start.", task.name, split)
+            return None
+    return itertools.chain(first, instance_iter)
+
+
+def _index_split(task, split, indexers, vocab, record_file, record_format='binary',
+                 compression='none', block_size=1000, start=0, stop=None, shard=None):
     """Index instances and stream to disk.
     Args:
         task: Task instance
@@ -115,19 +159,37 @@ def _index_split(task, split, indexers, vocab, record_file):
         indexers: dict of token indexers
         vocab: Vocabulary instance
         record_file: (string) file to write serialized Instances to
+        record_format: (string) on-disk format, one of serialize.RECORD_FORMATS
+        compression: (string) block compression for the 'binary' format, one of
+            serialize.COMPRESSIONS
+        block_size: (int) number of records per compressed block
+        start, stop: (int) if set, index only examples [start, stop) of the
+            split, e.g. for one shard. stop=None means to the end.
+        shard: optional (k, num_shards) of a sharded split. Streaming splits
+            that support it are sharded by byte ranges of the data file (see
+            _get_source_shard_instances), in which case start and stop are ignored.
     """
     log_prefix = "\tTask '%s', split '%s'" % (task.name, split)
-    log.info("%s: indexing from scratch", log_prefix)
-    split_text = task.get_split_text(split)
-    instance_iter = task.process_split(split_text, indexers)
-    if hasattr(instance_iter, '__len__'):  # if non-lazy
-        log.warn("%s: non-lazy Instance generation. You'll want to refactor "
-                 "%s.process_split to return a lazy iterator.", log_prefix,
-                 type(task).__name__)
-        log.info("%s: %d examples to index", log_prefix, len(instance_iter))
-        # Copy so that we don't store indexed data in memory.
-        # TODO: remove this case and stream everything.
-        instance_iter = utils.copy_iter(instance_iter)
+    instance_iter = _get_source_shard_instances(task, split, indexers, shard) if shard else None
+    if instance_iter is not None:
+        log_prefix += ", shard %d of %d" % (shard[0] + 1, shard[1])
+        log.info("%s: indexing from scratch", log_prefix)
+    else:
+        if start or stop is not None:
+            log_prefix += ", examples [%d, %s)" % (start, stop if stop is not None else "end")
+        log.info("%s: indexing from scratch", log_prefix)
+        split_text = task.get_split_text(split)
+        instance_iter = task.process_split(split_text, indexers)
+        if hasattr(instance_iter, '__len__'):  # if non-lazy
+            log.warn("%s: non-lazy Instance generation. You'll want to refactor "
+                     "%s.process_split to return a lazy iterator.", log_prefix,
+                     type(task).__name__)
+            log.info("%s: %d examples to index", log_prefix, len(instance_iter))
+            # Copy so that we don't store indexed data in memory.
+            # TODO: remove this case and stream everything.
+            instance_iter = utils.copy_iter(itertools.islice(instance_iter, start, stop))
+        else:
+            instance_iter = itertools.islice(instance_iter, start, stop)
 
     # Counter for lazy-loaded data, so we can log the # of elements.
     _instance_counter = 0
@@ -141,17 +203,82 @@ def _index_split(task, split, indexers, vocab, record_file):
 
     # Actually call generators and stream to disk.
     serialize.write_records(
-        _indexed_instance_generator(instance_iter, vocab), record_file)
+        _indexed_instance_generator(instance_iter, vocab), record_file,
+        record_format=record_format, compression=compression, block_size=block_size)
     log.info("%s: saved %d instances to %s",
              log_prefix, _instance_counter, record_file)
 
 
+def _get_shard_ranges(num_examples, num_shards):
+    """Split a split into contiguous [start, stop) example ranges, one per shard.
+
+    The last range is open-ended, so that every example is indexed even if
+    num_examples is an underestimate.
+    """
+    bounds = [num_examples * k // num_shards for k in range(num_shards)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Indexing jobs for worker processes. This is set before the workers are
+# forked, so that tasks and the vocabulary are inherited by the workers instead
+# of being pickled for every job.
+_INDEXING_JOBS = []
+
+
+def _run_indexing_job(job_idx):
+    _index_split(**_INDEXING_JOBS[job_idx])
+
+
+def _run_indexing_jobs(jobs, num_workers):
+    """Run indexing jobs, in up to num_workers processes at once if num_workers > 1.
+
+    Each job runs in its own forked process. These are not the daemonic workers
+    of a multiprocessing.Pool, so that a job can start its own tokenization
+    pool (see utils.iter_pretokenized).
+
+    Args:
+        jobs: list of dicts of keyword arguments to _index_split
+        num_workers: (int) number of worker processes
+    """
+    global _INDEXING_JOBS
+    if num_workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            _index_split(**job)
+        return
+    log.info("\tIndexing %d splits/shards with %d processes", len(jobs), num_workers)
+    _INDEXING_JOBS = jobs
+    context = multiprocessing.get_context('fork')
+    pending, running = list(range(len(jobs))), {}
+    try:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                job_idx = pending.pop(0)
+                running[job_idx] = context.Process(target=_run_indexing_job, args=(job_idx,))
+                running[job_idx].start()
+            multiprocessing.connection.wait([p.sentinel for p in running.values()])
+            for job_idx, process in list(running.items()):
+                if process.exitcode is None:
+                    continue
+                del running[job_idx]
+                if process.exitcode != 0:
+                    job = jobs[job_idx]
+                    raise RuntimeError("Indexing task '%s', split '%s' to %s failed (exit code %d)" %
+                                       (job['task'].name, job['split'], job['record_file'],
+                                        process.exitcode))
+    finally:
+        for process in running.values():
+            process.terminate()
+            process.join()
+        _INDEXING_JOBS = []
+
+
 def _find_cached_file(exp_dir: str, global_exp_cache_dir: str,
                       relative_path: str, log_prefix: str="") -> bool:
     """Find a cached file.
 
     Look in local exp_dir first, then in global_exp_cache_dir. If found in the
-    global dir, make a symlink in the local dir pointing to the global one.
+    global dir, make a symlink in the local dir pointing to the global one, as
+    well as for any record sidecar files (e.g. offset indices) next to it.
 
     Args:
         exp_dir: (string) local experiment dir
@@ -175,6 +302,10 @@ def _find_cached_file(exp_dir: str, global_exp_cache_dir: str,
         log.info("%sFound (global) preprocessed copy in %s", log_prefix, global_file)
         os.symlink(global_file, local_file)
         log.info("%sCreated symlink: %s -> %s", log_prefix, local_file, global_file)
+        for global_sidecar, local_sidecar in zip(serialize.get_sidecar_paths(global_file),
+                                                 serialize.get_sidecar_paths(local_file)):
+            if os.path.exists(global_sidecar) and not os.path.lexists(local_sidecar):
+                os.symlink(global_sidecar, local_sidecar)
         return True
     return False
 
@@ -190,11 +321,58 @@ def _build_embeddings(args, vocab, emb_file: str):
         return word_embs
 
     word_embs = get_embeddings(vocab, args.word_embs_file, args.d_word)
-    pkl.dump(word_embs, open(emb_file, 'wb'))
+    # Don't write through an existing file, which may be hardlinked to the shared cache.
+    if os.path.lexists(emb_file):
+        os.remove(emb_file)
+    np.save(emb_file, word_embs.numpy())
     log.info("\tSaved embeddings to %s", emb_file)
     return word_embs
 
 
+def _get_vocab_cache_key(args, tasks):
+    ''' Key for the shared cache, from everything the vocab is built from. '''
+    # Task data files are identified by size and mtime, so that regenerating
+    # one gives a new key, without reading them all on every run.
+    sources = {task.name: shared_cache.get_dir_fingerprint(
+        os.path.join(args.data_dir, TASKS_REGISTRY[task.name][1])) for task in tasks}
+    return shared_cache.get_key(
+        tasks=sorted(task.name for task in tasks),
+        sources=sources,
+        data_dir=args.data_dir,
+        tokenizer=args.tokenizer,
+        max_seq_len=args.max_seq_len,
+        max_word_v_size=args.max_word_v_size,
+        max_char_v_size=args.max_char_v_size,
+        openai_transformer=args.openai_transformer,
+        bert_model_name=args.bert_model_name)
+
+
+def _get_embeddings_cache_key(args, vocab_key):
+    ''' Key for the shared cache, from the vocab key and the vectors file. '''
+    return shared_cache.get_key(
+        vocab=vocab_key,
+        word_embs=args.word_embs,
+        word_embs_file=shared_cache.get_file_fingerprint(args.word_embs_file),
+        d_word=args.d_word)
+
+
+def _get_records_cache_key(args, task, split, indexers, vocab_digest, source_digest):
+    ''' Key for the shared cache, from everything a split's indexed records depend on. '''
+    task_cls, rel_path, task_kw = TASKS_REGISTRY[task.name]
+    return shared_cache.get_key(
+        task=task.name,
+        task_cls=task_cls.__name__,
+        task_kw=task_kw,
+        source=source_digest,
+        split=split,
+        tokenizer=args.tokenizer,
+        max_seq_len=args.max_seq_len,
+        indexers=sorted((name, type(indexer).__name__,
+                         getattr(indexer, 'namespace', getattr(indexer, '_namespace', None)))
+                        for name, indexer in indexers.items()),
+        vocab=vocab_digest)
+
+
 def _build_vocab(args, tasks, vocab_path: str):
     ''' Build vocabulary from scratch, reading data from tasks. '''
     # NOTE: task-specific target vocabulary should be counted in the task object
@@ -205,7 +383,7 @@ def _build_vocab(args, tasks, vocab_path: str):
         'word': args.max_word_v_size,
         'char': args.max_char_v_size,
     }
-    word2freq, char2freq = get_words(tasks)
+    word2freq, char2freq = get_words(tasks, num_workers=args.vocab_workers)
     vocab = get_vocab(word2freq, char2freq, max_v_sizes)
     for task in tasks:  # add custom label namespaces
         add_task_label_vocab(vocab, task)
@@ -231,6 +409,11 @@ def build_tasks(args):
     '''
 
     # 1) create / load tasks
+    utils.TOKENIZATION_CACHE_DIR = args.tokenization_cache_dir or None
+    utils.TOKENIZATION_WORKERS = args.tokenization_workers
+    utils.maybe_make_dir(args.shared_cache_dir or args.exp_dir)
+    utils.LINE_COUNT_CACHE_FILE = os.path.join(args.shared_cache_dir or args.exp_dir,
+                                               "line_counts.json")
     tasks, train_task_names, eval_task_names = get_tasks(args)
     for task in tasks:
         task_classifier = config.get_task_attr(args, task.name, "use_classifier")
@@ -272,8 +455,15 @@ def build_tasks(args):
         indexers["bert_wpm_pretokenized"] = SingleIdTokenIndexer(args.bert_model_name)
 
     vocab_path = os.path.join(args.exp_dir, 'vocab')
+    vocab_key = _get_vocab_cache_key(args, tasks)
     if args.reload_vocab or not os.path.exists(vocab_path):
-        _build_vocab(args, tasks, vocab_path)
+        if args.reload_vocab or not shared_cache.fetch(args.shared_cache_dir, 'vocab',
+                                                       vocab_key, vocab_path):
+            # Don't write through existing files, which may be hardlinked to the shared cache.
+            if os.path.exists(vocab_path):
+                shutil.rmtree(vocab_path)
+            _build_vocab(args, tasks, vocab_path)
+            shared_cache.publish(args.shared_cache_dir, 'vocab', vocab_key, vocab_path)
 
     # Always load vocab from file.
     vocab = Vocabulary.from_files(vocab_path)
@@ -288,11 +478,22 @@ def build_tasks(args):
     # 3) build / load word vectors
     word_embs = None
     if args.word_embs != 'none':
-        emb_file = os.path.join(args.exp_dir, 'embs.pkl')
-        if args.reload_vocab or not os.path.exists(emb_file):
-            word_embs = _build_embeddings(args, vocab, emb_file)
-        else:  # load from file
-            word_embs = pkl.load(open(emb_file, 'rb'))
+        emb_file = os.path.join(args.exp_dir, 'embs.npy')
+        legacy_emb_file = os.path.join(args.exp_dir, 'embs.pkl')
+        if not args.reload_vocab and os.path.exists(emb_file):
+            # Copy-on-write mapping: pages are read lazily, and the tensor is writable.
+            word_embs = torch.from_numpy(np.load(emb_file, mmap_mode='c'))
+        elif not args.reload_vocab and os.path.exists(legacy_emb_file):
+            word_embs = pkl.load(open(legacy_emb_file, 'rb'))
+        else:
+            embs_key = _get_embeddings_cache_key(args, vocab_key)
+            if (not args.reload_vocab and not args.fastText and
+                    shared_cache.fetch(args.shared_cache_dir, 'embs', embs_key, emb_file)):
+                word_embs = torch.from_numpy(np.load(emb_file, mmap_mode='c'))
+            else:
+                word_embs = _build_embeddings(args, vocab, emb_file)
+                if not args.fastText:
+                    shared_cache.publish(args.shared_cache_dir, 'embs', embs_key, emb_file)
         log.info("Trimmed word embeddings: %s", str(word_embs.size()))
 
     # 4) Index tasks using vocab (if preprocessed copy not available).
@@ -303,21 +504,68 @@ def build_tasks(args):
         not (
             args.reload_indexing and not reindex_tasks),
         "Flag reload_indexing was set, but no tasks are set to reindex (use -o \"args.reindex_tasks = \"task1,task2,...\"\")")
+    vocab_digest = shared_cache.get_dir_digest(vocab_path) if args.shared_cache_dir else None
+    index_jobs = []
+    sharded_record_files = []  # (record_file, shard_files) to write manifests for
+    records_to_publish = []  # (record_file, shared cache key)
     for task in tasks:
         force_reindex = (args.reload_indexing and task.name in reindex_tasks)
+        max_shards = config.get_task_attr(args, task.name, "indexing_shards")
+        source_digest = None
         for split in ALL_SPLITS:
             log_prefix = "\tTask '%s', split '%s'" % (task.name, split)
             relative_path = _get_serialized_record_path(task.name, split, "preproc")
             cache_found = _find_cached_file(args.exp_dir, args.global_ro_exp_dir,
                                             relative_path, log_prefix=log_prefix)
+            if cache_found and not serialize.is_complete(
+                    os.path.join(args.exp_dir, relative_path),
+                    verify_checksum=args.verify_record_checksums):
+                log.warning("%s: preprocessed copy is incomplete or corrupted, reindexing.",
+                            log_prefix)
+                cache_found = False
             if force_reindex or not cache_found:
                 # Re-index from scratch.
                 record_file = _get_serialized_record_path(task.name, split,
                                                           preproc_dir)
-                if os.path.exists(record_file) and os.path.islink(record_file):
-                    os.remove(record_file)
-
-                _index_split(task, split, indexers, vocab, record_file)
+                for path in [record_file] + serialize.get_sidecar_paths(record_file):
+                    if os.path.islink(path):
+                        os.remove(path)
+
+                if args.shared_cache_dir:
+                    if source_digest is None:
+                        # Task data can be huge, so only sample large files.
+                        source_digest = shared_cache.get_dir_digest(
+                            os.path.join(args.data_dir, TASKS_REGISTRY[task.name][1]),
+                            sample_size=1 << 20)
+                    records_key = _get_records_cache_key(args, task, split, indexers,
+                                                         vocab_digest, source_digest)
+                    if (not force_reindex and
+                            shared_cache.fetch_files(args.shared_cache_dir, 'records',
+                                                     records_key, preproc_dir) and
+                            serialize.is_complete(record_file)):
+                        continue
+                    records_to_publish.append((record_file, records_key))
+
+                job = dict(task=task, split=split, indexers=indexers, vocab=vocab,
+                           record_format=args.record_format,
+                           compression=args.record_compression,
+                           block_size=args.record_block_size)
+                num_examples = task.example_counts[split]
+                num_shards = max(1, min(max_shards, num_examples // MIN_EXAMPLES_PER_SHARD))
+                if num_shards > 1:
+                    shard_files = [serialize.get_shard_path(record_file, k, num_shards)
+                                   for k in range(num_shards)]
+                    for k, (shard_file, (start, stop)) in enumerate(zip(
+                            shard_files, _get_shard_ranges(num_examples, num_shards))):
+                        # Resume from shards completed by a previous (killed) run.
+                        if not force_reindex and serialize.is_complete(shard_file):
+                            log.info("%s: found completed shard %s", log_prefix, shard_file)
+                            continue
+                        index_jobs.append(dict(job, record_file=shard_file,
+                                               start=start, stop=stop, shard=(k, num_shards)))
+                    sharded_record_files.append((record_file, shard_files))
+                else:
+                    index_jobs.append(dict(job, record_file=record_file))
 
         # Delete in-memory data - we'll lazy-load from disk later.
         # TODO: delete task.{split}_data_text as well?
@@ -326,6 +574,13 @@ def build_tasks(args):
         task.test_data = None
         log.info("\tTask '%s': cleared in-memory data.", task.name)
 
+    _run_indexing_jobs(index_jobs, args.indexing_workers)
+    for record_file, shard_files in sharded_record_files:
+        serialize.write_shard_manifest(record_file, shard_files)
+        log.info("\tWrote manifest for %d shards to %s", len(shard_files), record_file)
+    for record_file, records_key in records_to_publish:
+        shared_cache.publish_files(args.shared_cache_dir, 'records', records_key,
+                                   serialize.get_record_paths(record_file))
     log.info("\tFinished indexing tasks")
 
     # 5) Initialize tasks with data iterators.
@@ -333,27 +588,36 @@ def build_tasks(args):
         "training_data_fraction and eval_data_fraction could not be used at a same time (could not be < 1 together)"
     pretrain_tasks = []
     target_tasks = []
+    # Reader options for all splits, and for training splits only.
+    reader_kw = {'prefetch_workers': args.record_prefetch_workers}
+    train_reader_kw = dict(reader_kw, shuffle=args.shuffle_train_data)
+    if distributed.is_initialized():
+        # Each process reads (and unpickles) only its own shard of the training data.
+        # The shuffled order of each epoch is the same in every process, so that
+        # the shards don't overlap.
+        train_reader_kw.update(shard=(distributed.get_rank(), distributed.get_world_size()),
+                               seed=args.random_seed)
     for task in tasks:
         # Replace lists of instances with lazy generators from disk.
-        task.val_data = _get_instance_generator(task.name, "val", preproc_dir)
-        task.test_data = _get_instance_generator(task.name, "test", preproc_dir)
+        task.val_data = _get_instance_generator(task.name, "val", preproc_dir, **reader_kw)
+        task.test_data = _get_instance_generator(task.name, "test", preproc_dir, **reader_kw)
         # When using training_data_fraction, we need modified iterators for use
         # only on training datasets at pretraining time.
         if args.training_data_fraction < 1 and task.name in train_task_names:
             log.info("Creating trimmed pretraining-only version of " + task.name + " train.")
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=args.training_data_fraction)
+                                                      fraction=args.training_data_fraction,
+                                                      **train_reader_kw)
             pretrain_tasks.append(task)
             if task.name in eval_task_names:
                 # Rebuild the iterator so we see the full dataset in the eval training
-                # phase. It will create a deepcopy of the task object
-                # and therefore there could be two tasks with the same name (task.name).
+                # phase. This uses a view of the task object, so there will be two
+                # tasks with the same name (task.name), sharing their data.
                 log.info("Creating un-trimmed eval training version of " + task.name + " train.")
-                log.warn("When using un-trimmed eval training version of train split, "
-                         "it creates a deepcopy of task object which is inefficient.")
-                task = copy.deepcopy(task)
+                task = task.make_view()
                 task.train_data = _get_instance_generator(
-                    task.name, "train", preproc_dir, fraction=1.0)
+                    task.name, "train", preproc_dir, fraction=1.0,
+                    **train_reader_kw)
                 target_tasks.append(task)
 
         # When using eval_data_fraction, we need modified iterators
@@ -361,24 +625,25 @@ def build_tasks(args):
         elif args.eval_data_fraction < 1 and task.name in eval_task_names:
             log.info("Creating trimmed train-for-eval-only version of " + task.name + " train.")
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=args.eval_data_fraction)
+                                                      fraction=args.eval_data_fraction,
+                                                      **train_reader_kw)
             target_tasks.append(task)
             if task.name in train_task_names:
                 # Rebuild the iterator so we see the full dataset in the pretraining
-                # phase. It will create a deepcopy of the task object
-                # and therefore there could be two tasks with the same name (task.name).
+                # phase. This uses a view of the task object, so there will be two
+                # tasks with the same name (task.name), sharing their data.
                 log.info("Creating un-trimmed pretraining version of " + task.name + " train.")
-                log.warn("When using un-trimmed pretraining version of train split, "
-                         "it creates a deepcopy of task object which is inefficient.")
-                task = copy.deepcopy(task)
+                task = task.make_view()
                 task.train_data = _get_instance_generator(
-                    task.name, "train", preproc_dir, fraction=1.0)
+                    task.name, "train", preproc_dir, fraction=1.0,
+                    **train_reader_kw)
                 pretrain_tasks.append(task)
         # When neither eval_data_fraction nor training_data_fraction is specified
         # we use unmodified iterators.
         else:
             task.train_data = _get_instance_generator(task.name, "train", preproc_dir,
-                                                      fraction=1.0)
+                                                      fraction=1.0,
+                                                      **train_reader_kw)
             if task.name in train_task_names:
                 pretrain_tasks.append(task)
             if task.name in eval_task_names:
@@ -392,17 +657,42 @@ def build_tasks(args):
     return pretrain_tasks, target_tasks, vocab, word_embs
 
 
-def parse_task_list_arg(task_list):
-    '''Parse task list argument into a list of task names.'''
-    task_names = []
-    for task_name in task_list.split(','):
-        if task_name == 'glue':
-            task_names.extend(ALL_GLUE_TASKS)
-        elif task_name == 'none' or task_name == '':
-            continue
-        else:
-            task_names.append(task_name)
-    return task_names
+def _get_task_text_path(pkl_path):
+    return os.path.splitext(pkl_path)[0] + ".text.pkl"
+
+
+def _save_task(task, pkl_path):
+    ''' Pickle a task, with its text attributes (see Task.TEXT_ATTRS) in a
+    separate file, so that loading the task doesn't load the text. '''
+    text = {attr: task.__dict__.pop(attr) for attr in Task.TEXT_ATTRS
+            if attr in task.__dict__}
+    try:
+        # Write the text first, so a task pickle always has its text.
+        with open(_get_task_text_path(pkl_path), 'wb') as fh:
+            pkl.dump(text, fh)
+        with open(pkl_path, 'wb') as fh:
+            pkl.dump(task, fh)
+    finally:
+        task.__dict__.update(text)
+
+
+def _load_task(pkl_path):
+    ''' Load a task saved by _save_task. Its text is loaded on first access. '''
+    with open(pkl_path, 'rb') as fh:
+        task = pkl.load(fh)
+    text_path = _get_task_text_path(pkl_path)
+    if any(attr in task.__dict__ for attr in Task.TEXT_ATTRS):
+        # Pickled with its text by an older version; split it once.
+        log.info('\tSplitting text from task pickle %s', pkl_path)
+        if 'example_counts' not in task.__dict__:
+            task.count_examples()
+        _save_task(task, pkl_path)
+        for attr in Task.TEXT_ATTRS:
+            task.__dict__.pop(attr, None)
+    if os.path.isfile(text_path):
+        task.set_text_path(text_path)
+    return task
+
 
 def _get_task(name, args, data_path, scratch_path):
     ''' Build or load a single task. '''
@@ -413,8 +703,13 @@ def _get_task(name, args, data_path, scratch_path):
     # TODO: refactor to always read from disk, even if task is constructed
     # here. This should avoid subtle bugs from deserialization issues.
     if os.path.isfile(pkl_path) and not args.reload_tasks:
-        task = pkl.load(open(pkl_path, 'rb'))
+        task = _load_task(pkl_path)
         log.info('\tLoaded existing task %s', name)
+        if 'example_counts' not in task.__dict__:
+            # Saved without its counts by an older version; counting reads
+            # the text, so save the counts to skip this on later runs.
+            task.count_examples()
+            _save_task(task, pkl_path)
     else:
         log.info('\tCreating task %s from scratch', name)
         # These tasks take an additional kwarg.
@@ -427,8 +722,12 @@ def _get_task(name, args, data_path, scratch_path):
         task_src_path = os.path.join(data_path, rel_path)
         task = task_cls(task_src_path, max_seq_len=args.max_seq_len, name=name,
                         tokenizer_name=args.tokenizer, **task_kw)
+        # Count examples before saving, so that loading the task later
+        # doesn't need its text.
+        if 'example_counts' not in task.__dict__:
+            task.count_examples()
         utils.maybe_make_dir(os.path.dirname(pkl_path))
-        pkl.dump(task, open(pkl_path, 'wb'))
+        _save_task(task, pkl_path)
     #task.truncate(max_seq_len, SOS_TOK, EOS_TOK)
     return task
 
@@ -453,10 +752,6 @@ def get_tasks(args):
         task = _get_task(name, args, data_path=data_path,
                          scratch_path=scratch_path)
         tasks.append(task)
-
-        # Count examples, store in example_counts.
-        if not hasattr(task, 'example_counts'):
-            task.count_examples()
         log.info("\tTask '%s': %s", task.name,
                  " ".join(("%s=%d" % kv for kv in
                            task.example_counts.items())))
@@ -465,29 +760,103 @@ def get_tasks(args):
     return tasks, train_task_names, eval_task_names
 
 
-def get_words(tasks):
+def _iter_vocab_sentences(task):
+    '''Yield the sentences of a task that are counted for the input vocabulary.'''
+    if isinstance(task, MTTask):
+        for src_sent, tgt_sent in task.get_sentences():
+            yield src_sent
+    else:
+        yield from task.get_sentences()
+
+
+def _count_chars(word2freq):
+    '''Count characters from word counts, so each distinct word is only split once.'''
+    char2freq = Counter()
+    for word, freq in word2freq.items():
+        for char in word:
+            char2freq[char] += freq
+    return char2freq
+
+
+def _count_task_words(task, shard, num_shards):
+    '''Count the words in shard number shard (of num_shards) of a task's vocab sentences.
+
+    Streaming tasks read only their part of each data file (see
+    utils.open_data_file), so tokenizing is split between shards as well.
+    Otherwise, every num_shards-th sentence is counted.
+    '''
+    word2freq = Counter()
+    with utils.data_file_shard(shard, num_shards) as num_sharded_opens:
+        sentences = _iter_vocab_sentences(task)
+        first = list(itertools.islice(sentences, 1))
+        sentences = itertools.chain(first, sentences)
+        if not num_sharded_opens():
+            sentences = itertools.islice(sentences, shard, None, num_shards)
+        for sentence in sentences:
+            word2freq.update(sentence)
+    return word2freq
+
+
+def _word_count_worker(tasks, shard, num_shards, out_queue):
+    '''Count the words in one shard of every task, and send back the counts.'''
+    word2freq = Counter()
+    for task in tasks:
+        word2freq.update(_count_task_words(task, shard, num_shards))
+    out_queue.put(word2freq)
+
+
+def _count_words_parallel(tasks, num_workers):
+    '''Count words in num_workers forked processes, and merge their counts.
+
+    Worker k reads, tokenizes and counts shard k of every task, so only the
+    counts are sent between processes. Workers aren't daemonic, so that they
+    can start a tokenization pool (see utils.iter_pretokenized).
+    '''
+    ctx = multiprocessing.get_context('fork')
+    out_queue = ctx.Queue()
+    workers = [ctx.Process(target=_word_count_worker, args=(tasks, k, num_workers, out_queue))
+               for k in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        word2freq = Counter()
+        for _ in workers:
+            while True:
+                try:
+                    word2freq.update(out_queue.get(timeout=1.0))
+                    break
+                except queue.Empty:
+                    failed = [w.exitcode for w in workers if w.exitcode not in (None, 0)]
+                    if failed:
+                        raise RuntimeError("Word counting worker failed (exit code %d)" %
+                                           failed[0])
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    return word2freq
+
+
+def get_words(tasks, num_workers=1):
     '''
     Get all words for all tasks for all splits for all sentences
     Return dictionary mapping words to frequencies.
-    '''
-    word2freq, char2freq = defaultdict(int), defaultdict(int)
-
-    def update_vocab_freqs(sentence):
-        '''Update counts for words in the sentence'''
-        for word in sentence:
-            word2freq[word] += 1
-            for char in list(word):
-                char2freq[char] += 1
-        return
 
-    for task in tasks:
-        log.info("\tCounting words for task: '%s'", task.name)
-        if isinstance(task, MTTask):
-            for src_sent, tgt_sent in task.get_sentences():
-                update_vocab_freqs(src_sent)
-        else:
-            for sentence in task.get_sentences():
-                update_vocab_freqs(sentence)
+    If num_workers > 1, words are counted in that many processes.
+    '''
+    if num_workers > 1:
+        log.info("\tCounting words for tasks %s with %d processes",
+                 ", ".join(task.name for task in tasks), num_workers)
+        word2freq = _count_words_parallel(tasks, num_workers)
+    else:
+        word2freq = Counter()
+        for task in tasks:
+            log.info("\tCounting words for task: '%s'", task.name)
+            for sentence in _iter_vocab_sentences(task):
+                word2freq.update(sentence)
 
     # This branch is meant for tasks that have *English* target sentences
     # (or more generally, same language source and target sentences)
@@ -498,24 +867,30 @@ def get_words(tasks):
             for sentence in task.target_sentences:
                 update_target_vocab_freqs(sentence)
 
+    char2freq = _count_chars(word2freq)
     log.info("\tFinished counting words")
     return word2freq, char2freq
 
 
+def _most_frequent(item2freq, k):
+    '''Select the k most frequent items, without sorting all of them.
+
+    Ties are broken by the item itself, so the result doesn't depend on the
+    order in which items were counted.
+    '''
+    return heapq.nsmallest(k, item2freq.items(), key=lambda x: (-x[1], x[0]))
+
+
 def get_vocab(word2freq, char2freq, max_v_sizes):
     '''Build vocabulary by selecting the most frequent tokens'''
     vocab = Vocabulary(counter=None, max_vocab_size=max_v_sizes)
     for special in SPECIALS:
         vocab.add_token_to_namespace(special, 'tokens')
 
-    words_by_freq = [(word, freq) for word, freq in word2freq.items()]
-    words_by_freq.sort(key=lambda x: x[1], reverse=True)
-    for word, _ in words_by_freq[:max_v_sizes['word']]:
+    for word, _ in _most_frequent(word2freq, max_v_sizes['word']):
         vocab.add_token_to_namespace(word, 'tokens')
 
-    chars_by_freq = [(char, freq) for char, freq in char2freq.items()]
-    chars_by_freq.sort(key=lambda x: x[1], reverse=True)
-    for char, _ in chars_by_freq[:max_v_sizes['char']]:
+    for char, _ in _most_frequent(char2freq, max_v_sizes['char']):
         vocab.add_token_to_namespace(char, 'chars')
 
     return vocab
@@ -577,15 +952,15 @@ def add_openai_bpe_vocab(vocab, namespace='openai_bpe'):
 
 def get_embeddings(vocab, vec_file, d_word) -> torch.FloatTensor:
     '''Get embeddings for the words in vocab from a file of precomputed vectors.
-    Works for fastText and GloVe embedding files. '''
+    Works for fastText and GloVe embedding files, and their converted (.npy) copies;
+    see src/utils/word_vectors.py. Only vectors for words in vocab are parsed. '''
     word_v_size, unk_idx = vocab.get_vocab_size('tokens'), vocab.get_token_index(vocab._oov_token)
-    embeddings = np.random.randn(word_v_size, d_word)
-    with io.open(vec_file, 'r', encoding='utf-8', newline='\n', errors='ignore') as vec_fh:
-        for line in vec_fh:
-            word, vec = line.split(' ', 1)
-            idx = vocab.get_token_index(word)
-            if idx != unk_idx:
-                embeddings[idx] = np.array(list(map(float, vec.split())))
+    embeddings = np.random.randn(word_v_size, d_word).astype(np.float32)
+    token2idx = {word: idx for word, idx in
+                 vocab.get_token_to_index_vocabulary('tokens').items() if idx != unk_idx}
+    indices, vectors = word_vectors.read_vocab_vectors(vec_file, token2idx, d_word)
+    embeddings[indices] = vectors
+    log.info("\tFound vectors for %d of %d words", len(indices), word_v_size)
     embeddings[vocab.get_token_index(vocab._padding_token)] = 0.
     embeddings = torch.FloatTensor(embeddings)
     log.info("\tFinished loading embeddings")
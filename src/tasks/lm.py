@@ -10,7 +10,8 @@ from allennlp.data.token_indexers import SingleIdTokenIndexer
 # Fields for instance processing
 from allennlp.data import Instance, Token
 
-from ..utils.utils import process_sentence, truncate
+from ..utils.utils import process_sentence, truncate, iter_pretokenized, count_lines, \
+    open_data_file
 
 from typing import Iterable, Sequence, List, Dict, Any, Type
 
@@ -54,7 +55,7 @@ class LanguageModelingTask(SequenceGenerationTask):
         """
         example_counts = {}
         for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
+            example_counts[split] = count_lines(split_path)
         self.example_counts = example_counts
 
     def get_metrics(self, reset=False):
@@ -70,12 +71,12 @@ class LanguageModelingTask(SequenceGenerationTask):
         Args:
             path: (str) data file path
         """
-        with open(path) as txt_fh:
-            for row in txt_fh:
-                toks = row.strip()
+        with open_data_file(path) as txt_fh:
+            rows = ([row.strip()] for row in txt_fh)
+            for (toks,), tok_cache in iter_pretokenized(rows, [0]):
                 if not toks:
                     continue
-                yield process_sentence(toks, self.max_seq_len)
+                yield process_sentence(toks, self.max_seq_len, tok_cache=tok_cache)
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
         """Process a language modeling split by indexing and creating fields.
@@ -124,7 +125,7 @@ class WikiTextLMTask(LanguageModelingTask):
     def load_data(self, path):
         ''' Rather than return a whole list of examples, stream them '''
         nonatomics_toks = [UNK_TOK_ALLENNLP, '<unk>']
-        with open(path) as txt_fh:
+        with open_data_file(path) as txt_fh:
             for row in txt_fh:
                 toks = row.strip()
                 if not toks:
@@ -11,7 +11,7 @@ from allennlp.data.token_indexers import SingleIdTokenIndexer
 
 from allennlp.data import Instance, Token
 
-from ..utils.utils import process_sentence, truncate
+from ..utils.utils import process_sentence, truncate, iter_pretokenized, open_data_file
 
 from typing import Iterable, Sequence, List, Dict, Any, Type
 
@@ -60,17 +60,18 @@ class MTTask(SequenceGenerationTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with codecs.open(path, 'r', 'utf-8', errors='ignore') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path, 'utf-8', errors='ignore') as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [0, 1]):
                 if len(row) < 2 or not row[0] or not row[1]:
                     continue
-                src_sent = process_sentence(row[0], self.max_seq_len)
+                src_sent = process_sentence(row[0], self.max_seq_len, tok_cache=tok_cache)
                 # target sentence sos_tok, eos_tok need to match Seq2SeqDecoder class
                 tgt_sent = process_sentence(
                     row[1], self.max_seq_len,
                     sos_tok=allennlp_util.START_SYMBOL,
                     eos_tok=allennlp_util.END_SYMBOL,
+                    tok_cache=tok_cache,
                 )
                 yield (src_sent, tgt_sent)
 
@@ -134,15 +135,16 @@ class RedditSeq2SeqTask(MTTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with codecs.open(path, 'r', 'utf-8', errors='ignore') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path, 'utf-8', errors='ignore') as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [2, 3]):
                 if len(row) < 4 or not row[2] or not row[3]:
                     continue
-                src_sent = process_sentence(row[2], self.max_seq_len)
+                src_sent = process_sentence(row[2], self.max_seq_len, tok_cache=tok_cache)
                 tgt_sent = process_sentence(row[3], self.max_seq_len,
                                             sos_tok=allennlp_util.START_SYMBOL,
                                             eos_tok=allennlp_util.END_SYMBOL,
+                                            tok_cache=tok_cache,
                                             )
                 yield (src_sent, tgt_sent)
 
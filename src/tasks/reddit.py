@@ -1,5 +1,4 @@
 """Task definitions for reddit."""
-import codecs
 import logging as log
 import os
 
@@ -8,7 +7,8 @@ from allennlp.training.metrics import Average
 from allennlp.data import Instance, Token
 from allennlp.data.fields import TextField, LabelField, MetadataField
 
-from ..utils.utils import process_sentence, truncate
+from ..utils.utils import process_sentence, truncate, iter_pretokenized, count_lines, \
+    open_data_file
 
 from typing import Iterable, Sequence, List, Dict, Any, Type
 
@@ -44,13 +44,13 @@ class RedditTask(RankingTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with open(path, 'r') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path) as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [2, 3]):
                 if len(row) < 4 or not row[2] or not row[3]:
                     continue
-                sent1 = process_sentence(row[2], self.max_seq_len)
-                sent2 = process_sentence(row[3], self.max_seq_len)
+                sent1 = process_sentence(row[2], self.max_seq_len, tok_cache=tok_cache)
+                sent2 = process_sentence(row[3], self.max_seq_len, tok_cache=tok_cache)
                 targ = 1
                 yield (sent1, sent2, targ)
 
@@ -69,7 +69,7 @@ class RedditTask(RankingTask):
         ''' Compute here b/c we're streaming the sentences. '''
         example_counts = {}
         for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
+            example_counts[split] = count_lines(split_path)
         self.example_counts = example_counts
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
@@ -117,13 +117,13 @@ class RedditPairClassificationTask(PairClassificationTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with open(path, 'r') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path) as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [2, 3]):
                 if len(row) < 4 or not row[2] or not row[3]:
                     continue
-                sent1 = process_sentence(row[2], self.max_seq_len)
-                sent2 = process_sentence(row[3], self.max_seq_len)
+                sent1 = process_sentence(row[2], self.max_seq_len, tok_cache=tok_cache)
+                sent2 = process_sentence(row[3], self.max_seq_len, tok_cache=tok_cache)
                 targ = 1
                 yield (sent1, sent2, targ)
 
@@ -142,7 +142,7 @@ class RedditPairClassificationTask(PairClassificationTask):
         ''' Compute here b/c we're streaming the sentences. '''
         example_counts = {}
         for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
+            example_counts[split] = count_lines(split_path)
         self.example_counts = example_counts
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
@@ -181,13 +181,13 @@ class MTDataPairClassificationTask(RedditPairClassificationTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with codecs.open(path, 'r', 'utf-8', errors='ignore') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path, 'utf-8', errors='ignore') as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [0, 1]):
                 if len(row) < 2 or not row[0] or not row[1]:
                     continue
-                sent1 = process_sentence(row[0], self.max_seq_len)
-                sent2 = process_sentence(row[1], self.max_seq_len)
+                sent1 = process_sentence(row[0], self.max_seq_len, tok_cache=tok_cache)
+                sent2 = process_sentence(row[1], self.max_seq_len, tok_cache=tok_cache)
                 targ = 1
                 yield (sent1, sent2, targ)
 
@@ -195,8 +195,6 @@ class MTDataPairClassificationTask(RedditPairClassificationTask):
         ''' Compute here b/c we're streaming the sentences. '''
         example_counts = {}
         for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(
-                1 for line in codecs.open(
-                    split_path, 'r', 'utf-8', errors='ignore'))
+            example_counts[split] = count_lines(split_path)
         self.example_counts = example_counts
 
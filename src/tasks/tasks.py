@@ -7,6 +7,7 @@
 get_metrics(): e.g. if task.val_metric = task_name + "_accuracy", then
 task.get_metrics() should return {"accuracy": accuracy_val, ... }
 '''
+import _pickle as pkl
 import codecs
 import collections
 import copy
@@ -19,7 +20,7 @@ import numpy as np
 import torch
 
 from allennlp.training.metrics import CategoricalAccuracy, \
-    BooleanAccuracy, F1Measure, Average
+    BooleanAccuracy, F1Measure, Average, Metric
 from ..allennlp_mods.correlation import Correlation, FastMatthews
 from allennlp.data.token_indexers import SingleIdTokenIndexer
 
@@ -30,7 +31,8 @@ from allennlp.data.fields import TextField, LabelField, \
 from ..allennlp_mods.numeric_field import NumericField
 
 from ..utils import utils
-from ..utils.utils import load_tsv, process_sentence, truncate, load_diagnostic_tsv
+from ..utils.utils import load_tsv, process_sentence, truncate, load_diagnostic_tsv, \
+    iter_pretokenized, count_lines, open_data_file
 
 from typing import Iterable, Sequence, List, Dict, Any, Type
 
@@ -112,11 +114,48 @@ class Task(object):
         - process: pad and indexify data given a mapping
         - optimizer
     '''
+    # Attributes holding the task's (tokenized) text. Cached tasks store these
+    # in a separate text pickle, which is only loaded when one of them is first
+    # accessed; see set_text_path.
+    TEXT_ATTRS = ('train_data_text', 'val_data_text', 'test_data_text',
+                  'sentences', 'target_sentences')
+
     def __init__(self, name, tokenizer_name):
         self.name = name
         assert self.tokenizer_is_supported(tokenizer_name)
         self._tokenizer_name = tokenizer_name
 
+    def set_text_path(self, text_path):
+        ''' Load text attributes from this pickle of {attr: value} on first access. '''
+        self._text_path = text_path
+
+    def make_view(self):
+        ''' Make a second handle on this task, e.g. to train on it in another phase.
+
+        The view shares all data with this task (text, labels, iterators, etc.),
+        except for metrics (Metric attributes, e.g. scorer1), which are copied
+        so that each handle accumulates its own scores. Set the view's
+        train_data etc. to give it different data.
+        '''
+        view = copy.copy(self)
+        for name, value in self.__dict__.items():
+            if isinstance(value, Metric):
+                setattr(view, name, copy.deepcopy(value))
+        return view
+
+    def __getattr__(self, name):
+        # Only called if the attribute isn't found normally. Use __dict__
+        # directly, since this may be called before __init__ (e.g. by pickle).
+        text_path = self.__dict__.get('_text_path')
+        if name in Task.TEXT_ATTRS and text_path is not None:
+            log.info("\tTask '%s': loading text from %s", self.name, text_path)
+            with open(text_path, 'rb') as fh:
+                self.__dict__.update(pkl.load(fh))
+            del self.__dict__['_text_path']
+            return getattr(self, name)
+        raise AttributeError("'%s' object has no attribute '%s'" %
+                             (type(self).__name__, name))
+
     def load_data(self, path, max_seq_len):
         ''' Load data from path and create splits. '''
         raise NotImplementedError
@@ -973,7 +1012,7 @@ class Wiki103Classification(PairClassificationTask):
         example_counts = {}
         for split, split_path in self.files_by_split.items():
             # pair sentence # = sent # - 1
-            example_counts[split] = sum(1 for line in open(split_path)) - 1
+            example_counts[split] = count_lines(split_path) - 1
         self.example_counts = example_counts
 
 
@@ -1010,13 +1049,13 @@ class DisSentTask(PairClassificationTask):
 
     def load_data(self, path):
         ''' Load data '''
-        with open(path, 'r') as txt_fh:
-            for row in txt_fh:
-                row = row.strip().split('\t')
+        with open_data_file(path) as txt_fh:
+            rows = (row.strip().split('\t') for row in txt_fh)
+            for row, tok_cache in iter_pretokenized(rows, [0, 1]):
                 if len(row) != 3 or not (row[0] and row[1] and row[2]):
                     continue
-                sent1 = process_sentence(row[0], self.max_seq_len)
-                sent2 = process_sentence(row[1], self.max_seq_len)
+                sent1 = process_sentence(row[0], self.max_seq_len, tok_cache=tok_cache)
+                sent2 = process_sentence(row[1], self.max_seq_len, tok_cache=tok_cache)
                 targ = int(row[2])
                 yield (sent1, sent2, targ)
 
@@ -1035,7 +1074,7 @@ class DisSentTask(PairClassificationTask):
         ''' Compute the counts here b/c we're streaming the sentences. '''
         example_counts = {}
         for split, split_path in self.files_by_split.items():
-            example_counts[split] = sum(1 for line in open(split_path))
+            example_counts[split] = count_lines(split_path)
         self.example_counts = example_counts
 
     def process_split(self, split, indexers) -> Iterable[Type[Instance]]:
@@ -22,7 +22,11 @@ from allennlp.training.learning_rate_schedulers import LearningRateScheduler  #
 from allennlp.training.optimizers import Optimizer  # pylint: disable=import-error
 from allennlp.nn.util import move_to_device, device_mapping
 
-from .utils.utils import assert_for_log  # pylint: disable=import-error
+from .utils.utils import assert_for_log, parse_task_list_arg  # pylint: disable=import-error
+from .utils.prefetch import BatchPrefetcher
+from .utils.tensor_store import TensorBatchIterator
+from .utils import distributed
+from .allennlp_mods.token_budget_iterator import TokenBudgetBucketIterator
 from .evaluate import evaluate
 from .utils import config
 
@@ -40,7 +44,8 @@ def build_trainer_params(args, task_names):
     extra_opts = ['sent_enc', 'd_hid', 'warmup',
                   'max_grad_norm', 'min_lr', 'batch_size',
                   'cuda', 'keep_all_checkpoints',
-                  'val_data_limit', 'training_data_fraction']
+                  'val_data_limit', 'training_data_fraction', 'batch_prefetch',
+                  'nan_check_interval', 'co_batch_tasks']
     for attr in train_opts:
         params[attr] = _get_task_attr(attr)
     for attr in extra_opts:
@@ -48,6 +53,14 @@ def build_trainer_params(args, task_names):
     params['max_vals'] = _get_task_attr('max_vals')
     params['val_interval'] = _get_task_attr('val_interval')
     params['dec_val_scale'] = _get_task_attr('dec_val_scale')
+    # Token budgets can be set per task, and several tasks are trained at once
+    # when pretraining, so resolve the budget of each task separately.
+    all_task_names = parse_task_list_arg(args.pretrain_tasks) + \
+        parse_task_list_arg(args.target_tasks)
+    params['batch_max_tokens'] = {
+        task_name: config.get_task_attr(args, [task_name] + list(task_names),
+                                        'batch_max_tokens', default=0)
+        for task_name in all_task_names}
 
     return Params(params)
 
@@ -101,7 +114,11 @@ def build_trainer(params, model, run_dir, metric_should_decrease=True):
                            'keep_all_checkpoints': params['keep_all_checkpoints'],
                            'val_data_limit': params['val_data_limit'],
                            'dec_val_scale': params['dec_val_scale'],
-                           'training_data_fraction': params['training_data_fraction']})
+                           'training_data_fraction': params['training_data_fraction'],
+                           'batch_prefetch': params['batch_prefetch'],
+                           'batch_max_tokens': params['batch_max_tokens'],
+                           'nan_check_interval': params['nan_check_interval'],
+                           'co_batch_tasks': params['co_batch_tasks']})
     trainer = SamplingMultiTaskTrainer.from_params(model, run_dir,
                                                    copy.deepcopy(train_params))
     return trainer, train_params, opt_params, schd_params
@@ -112,7 +129,8 @@ class SamplingMultiTaskTrainer:
                  serialization_dir=None, cuda_device=-1,
                  grad_norm=None, grad_clipping=None, lr_decay=None, min_lr=None,
                  keep_all_checkpoints=False, val_data_limit=5000,
-                 dec_val_scale=100, training_data_fraction=1.0):
+                 dec_val_scale=100, training_data_fraction=1.0, batch_prefetch=0,
+                 batch_max_tokens=None, nan_check_interval=0, co_batch_tasks=0):
         """
         The training coordinator. Unusually complicated to handle MTL with tasks of
         diverse sizes.
@@ -149,6 +167,17 @@ class SamplingMultiTaskTrainer:
             Set to -1 to use all.
         training_data_fraction: If set to a float between 0 and 1, load only the specified percentage
             of examples. Hashing is used to ensure that the same examples are loaded each epoch.
+        batch_prefetch: If > 0, prepare up to this many training batches per task ahead of time,
+            in a background thread per task.
+        batch_max_tokens: Dict from task name to a budget of padded tokens per training batch.
+            For tasks with a budget > 0, batches are formed under this budget instead of
+            holding batch_size examples.
+        nan_check_interval: If > 0, check the training loss for NaNs every this many steps.
+            It's always checked when logging and validating, and checking syncs with the GPU,
+            so by default it isn't checked in between.
+        co_batch_tasks: If > 1, each training step in the main phase trains on a batch from each
+            of this many sampled tasks, with one sentence encoder call for all of them, and
+            sums their scaled losses. Requires a shared optimizer.
         """
         self._model = model
 
@@ -165,6 +194,14 @@ class SamplingMultiTaskTrainer:
         self._val_data_limit = val_data_limit
         self._dec_val_scale = dec_val_scale
         self._training_data_fraction = training_data_fraction
+        self._batch_prefetch = batch_prefetch
+        self._batch_max_tokens = batch_max_tokens or {}
+        self._nan_check_interval = nan_check_interval
+        self._co_batch_tasks = co_batch_tasks
+        # In distributed training, each process trains on its own shard of the data,
+        # and rank 0 validates, checkpoints and decides when to stop.
+        self._rank = distributed.get_rank()
+        self._world_size = distributed.get_world_size()
         self._task_infos = None
         self._metric_infos = None
 
@@ -173,7 +210,7 @@ class SamplingMultiTaskTrainer:
             self._model = self._model.cuda(self._cuda_device)
 
         self._TB_dir = None
-        if self._serialization_dir is not None:
+        if self._serialization_dir is not None and self._rank == 0:
             self._TB_dir = os.path.join(self._serialization_dir, "tensorboard")
             self._TB_train_log = SummaryWriter(
                 os.path.join(self._TB_dir, "train"))
@@ -218,7 +255,8 @@ class SamplingMultiTaskTrainer:
             - task_infos (Dict[str:Dict[str:???]]): dictionary containing where each task_info contains:
                 - iterator: a task specific (because it uses that task's fields to dynamically batch) batcher
                 - n_tr_batches: the number of training batches
-                - tr_generator: generator object that returns the batches, set to repeat indefinitely
+                - tr_generator: generator object that returns the batches, set to repeat indefinitely.
+                    If batch_prefetch is set, this is a BatchPrefetcher that prepares them in the background.
                 - loss: the accumulated loss (during training or validation)
                 - n_batches_since_val: number of batches trained on since the last validation
                 - total_batches_trained: number of batches trained over all validation checks
@@ -245,22 +283,48 @@ class SamplingMultiTaskTrainer:
             for field in pad_dict:
                 for pad_field in pad_dict[field]:
                     sorting_keys.append((field, pad_field))
-            iterator = BucketIterator(sorting_keys=sorting_keys,
-                                      max_instances_in_memory=10000,
-                                      batch_size=batch_size,
-                                      biggest_batch_first=True)
-            tr_generator = iterator(task.train_data, num_epochs=None)
-            tr_generator = move_to_device(tr_generator, self._cuda_device)
+            max_tokens = self._batch_max_tokens.get(task.name, 0)
+            if max_tokens > 0:
+                iterator = TokenBudgetBucketIterator(sorting_keys=sorting_keys,
+                                                     max_tokens=max_tokens,
+                                                     max_instances_in_memory=10000,
+                                                     biggest_batch_first=True)
+                log.info("\t%s: batching under a budget of %d tokens", task.name, max_tokens)
+            elif TensorBatchIterator.can_read(task.train_data):
+                iterator = TensorBatchIterator(batch_size, sort_by_lengths=True,
+                                               max_instances_in_memory=10000,
+                                               biggest_batch_first=True)
+                log.info("\t%s: reading batches straight from the tensor store", task.name)
+            else:
+                iterator = BucketIterator(sorting_keys=sorting_keys,
+                                          max_instances_in_memory=10000,
+                                          batch_size=batch_size,
+                                          biggest_batch_first=True)
+            # In distributed training, train_data is already this process's shard
+            # (see preprocess.build_tasks).
+            train_data = task.train_data
+            tr_generator = iterator(train_data, num_epochs=None)
+            if self._batch_prefetch > 0:
+                tr_generator = BatchPrefetcher(tr_generator, self._batch_prefetch,
+                                               cuda_device=self._cuda_device)
+            else:
+                tr_generator = move_to_device(tr_generator, self._cuda_device)
             task_info['iterator'] = iterator
 
             if phase == "main":
                 # Warning: This won't be precise when training_data_fraction is set, since each example is included
                 # or excluded independently using a hashing function. Fortunately, it
                 # doesn't need to be.
-                task_info['n_tr_batches'] = math.ceil(
-                    task.n_train_examples * self._training_data_fraction / batch_size)
+                n_tr_examples = task.n_train_examples * self._training_data_fraction
             else:
-                task_info['n_tr_batches'] = math.ceil(task.n_train_examples / batch_size)
+                n_tr_examples = task.n_train_examples
+            n_tr_examples /= self._world_size
+            if max_tokens > 0:
+                # Nor is this, as batch sizes vary.
+                task_info['n_tr_batches'] = max(1, iterator.estimate_num_batches(
+                    train_data, n_tr_examples))
+            else:
+                task_info['n_tr_batches'] = math.ceil(n_tr_examples / batch_size)
 
             task_info['tr_generator'] = tr_generator
             task_info['loss'] = 0.0
@@ -337,6 +401,9 @@ class SamplingMultiTaskTrainer:
                                "If you don't want them, delete them or change your experiment name." %
                                self._serialization_dir)
 
+        if self._world_size > 1:
+            distributed.broadcast_parameters(self._model)
+
         if self._grad_clipping is not None:  # pylint: disable=invalid-unary-operand-type
             def clip_function(grad): return grad.clamp(-self._grad_clipping, self._grad_clipping)
             for parameter in self._model.parameters():
@@ -385,8 +452,16 @@ class SamplingMultiTaskTrainer:
         log.info("Using weighting method: %s, with normalized sample weights %s ",
                  weighting_method, np.array_str(normalized_sample_weights, precision=4))
 
+        co_batch_tasks = self._co_batch_tasks if phase == "main" else 0
+        if co_batch_tasks > 1:
+            assert_for_log(shared_optimizer, "co_batch_tasks requires shared_optimizer = 1.")
+            assert_for_log(not self._model.sep_embs_for_skip,
+                           "co_batch_tasks can't be used with sep_embs_for_skip.")
+            log.info("Training on batches of %d sampled tasks per step.", co_batch_tasks)
+        n_samples_per_step = max(co_batch_tasks, 1)
+
         # Sample the tasks to train on. Do it all at once (val_interval) for MAX EFFICIENCY.
-        samples = random.choices(tasks, weights=sample_weights, k=validation_interval)
+        samples = self._sample_tasks(tasks, sample_weights, validation_interval * n_samples_per_step)
 
         if scaling_method == 'uniform':
             scaling_weights = [1.0] * len(tasks)
@@ -423,61 +498,82 @@ class SamplingMultiTaskTrainer:
         log.info("Beginning training. Stopping metric: %s", stop_metric)
         while not should_stop:
             self._model.train()
-            task = samples[n_pass % validation_interval]  # randomly select a task
-            task_info = task_infos[task.name]
-            if task_info['stopped']:
-                continue
-            tr_generator = task_info['tr_generator']
-            optimizer = g_optimizer if shared_optimizer else task_info['optimizer']
-            scheduler = g_scheduler if shared_optimizer else task_info['scheduler']
-            total_batches_trained = task_info['total_batches_trained']
-            n_batches_since_val = task_info['n_batches_since_val']
-            tr_loss = task_info['loss']
-            for batch in itertools.islice(tr_generator, n_batches_per_pass):
-                n_batches_since_val += 1
-                total_batches_trained += 1
-                optimizer.zero_grad()
-                output_dict = self._forward(batch, task=task, for_training=True)
-                assert_for_log("loss" in output_dict,
-                               "Model must return a dict containing a 'loss' key")
-                loss = output_dict["loss"]  # optionally scale loss
-
-                loss *= scaling_weights[task.name]
-
-                loss.backward()
-                assert_for_log(not torch.isnan(loss).any(), "NaNs in loss.")
-                tr_loss += loss.data.cpu().numpy()
-
-                # Gradient regularization and application
-                if self._grad_norm:
-                    clip_grad_norm_(self._model.parameters(), self._grad_norm)
-                optimizer.step()
-                n_pass += 1  # update per batch
-
-                # step scheduler if it's not ReduceLROnPlateau
-                if not isinstance(scheduler.lr_scheduler, ReduceLROnPlateau):
-                    scheduler.step_batch(n_pass)
-
-            # Update training progress on that task
-            task_info['n_batches_since_val'] = n_batches_since_val
-            task_info['total_batches_trained'] = total_batches_trained
-            task_info['loss'] = tr_loss
+            if co_batch_tasks > 1:
+                start = (n_pass % validation_interval) * co_batch_tasks
+                step_tasks = [task for task in samples[start:start + co_batch_tasks]
+                              if not task_infos[task.name]['stopped']]
+                if not step_tasks:
+                    continue
+                n_pass = self._train_co_batched(step_tasks, task_infos, n_batches_per_pass,
+                                                scaling_weights, g_optimizer, g_scheduler,
+                                                n_pass)
+            else:
+                task = samples[n_pass % validation_interval]  # randomly select a task
+                task_info = task_infos[task.name]
+                if task_info['stopped']:
+                    continue
+                tr_generator = task_info['tr_generator']
+                optimizer = g_optimizer if shared_optimizer else task_info['optimizer']
+                scheduler = g_scheduler if shared_optimizer else task_info['scheduler']
+                total_batches_trained = task_info['total_batches_trained']
+                n_batches_since_val = task_info['n_batches_since_val']
+                tr_loss = task_info['loss']
+                for batch in itertools.islice(tr_generator, n_batches_per_pass):
+                    n_batches_since_val += 1
+                    total_batches_trained += 1
+                    optimizer.zero_grad()
+                    output_dict = self._forward(batch, task=task, for_training=True)
+                    assert_for_log("loss" in output_dict,
+                                   "Model must return a dict containing a 'loss' key")
+                    loss = output_dict["loss"]  # optionally scale loss
+
+                    loss *= scaling_weights[task.name]
+
+                    loss.backward()
+                    if self._world_size > 1:
+                        distributed.all_reduce_gradients(self._model.parameters())
+                    # Keep the running loss on the device; reading it out every step
+                    # would wait for the GPU to finish the step.
+                    tr_loss = tr_loss + loss.detach()
+
+                    # Gradient regularization and application
+                    if self._grad_norm:
+                        clip_grad_norm_(self._model.parameters(), self._grad_norm)
+                    optimizer.step()
+                    n_pass += 1  # update per batch
+                    if self._nan_check_interval > 0 and n_pass % self._nan_check_interval == 0:
+                        self._get_loss_value(tr_loss)
+
+                    # step scheduler if it's not ReduceLROnPlateau
+                    if not isinstance(scheduler.lr_scheduler, ReduceLROnPlateau):
+                        scheduler.step_batch(n_pass)
+
+                # Update training progress on that task
+                task_info['n_batches_since_val'] = n_batches_since_val
+                task_info['total_batches_trained'] = total_batches_trained
+                task_info['loss'] = tr_loss
+                step_tasks = [task]
 
             # Intermediate log to logger and tensorboard
-            if time.time() - task_info['last_log'] > self._log_interval:
+            for task in sorted(set(step_tasks), key=step_tasks.index):
+                task_info = task_infos[task.name]
+                if time.time() - task_info['last_log'] <= self._log_interval:
+                    continue
+                n_batches_since_val = task_info['n_batches_since_val']
                 task_metrics = task.get_metrics()
+                tr_loss_value = self._get_loss_value(task_info['loss'])
 
                 # log to tensorboard
                 if self._TB_dir is not None:
                     task_metrics_to_TB = task_metrics.copy()
-                    task_metrics_to_TB["loss"] = \
-                        float(task_info['loss'] / n_batches_since_val)
+                    task_metrics_to_TB["loss"] = tr_loss_value / n_batches_since_val
                     self._metrics_to_tensorboard_tr(n_pass, task_metrics_to_TB, task.name)
 
-                task_metrics["%s_loss" % task.name] = tr_loss / n_batches_since_val
+                task_metrics["%s_loss" % task.name] = tr_loss_value / n_batches_since_val
                 description = self._description_from_metrics(task_metrics)
                 log.info("Update %d: task %s, batch %d (%d): %s", n_pass,
-                         task.name, n_batches_since_val, total_batches_trained, description)
+                         task.name, n_batches_since_val, task_info['total_batches_trained'],
+                         description)
 
                 task_info['last_log'] = time.time()
 
@@ -486,7 +582,11 @@ class SamplingMultiTaskTrainer:
                     log.info("TRAINING BATCH UTILIZATION: %.3f", batch_util)
 
             # Validation
-            if n_pass % validation_interval == 0:
+            if n_pass % validation_interval == 0 and self._rank > 0:
+                samples = self._sample_tasks(tasks, sample_weights,
+                                             validation_interval * n_samples_per_step)
+                should_stop = self._sync_validation(tasks, should_stop)
+            elif n_pass % validation_interval == 0:
 
                 # Dump and log all of our current info
                 epoch = int(n_pass / validation_interval)
@@ -500,7 +600,7 @@ class SamplingMultiTaskTrainer:
                         for name, value in task_metrics.items():
                             all_tr_metrics["%s_%s" % (task.name, name)] = value
                         all_tr_metrics["%s_loss" % task.name] = \
-                            float(task_info['loss'] / n_batches_since_val)
+                            self._get_loss_value(task_info['loss']) / n_batches_since_val
                     else:
                         all_tr_metrics["%s_loss" % task.name] = 0.0
                     log.info("%s: trained on %d batches, %.3f epochs", task.name,
@@ -537,19 +637,105 @@ class SamplingMultiTaskTrainer:
 
                 # Reset training preogress
                 all_tr_metrics = {}
-                samples = random.choices(
-                    tasks,
-                    weights=sample_weights,
-                    k=validation_interval)  # pylint: disable=no-member
+                samples = self._sample_tasks(tasks, sample_weights,
+                                             validation_interval * n_samples_per_step)
 
                 if should_save:
                     self._save_checkpoint(
                         {"pass": n_pass, "epoch": epoch, "should_stop": should_stop},
                         phase=phase, new_best_macro=new_best_macro)
+                if self._world_size > 1:
+                    should_stop = self._sync_validation(tasks, should_stop)
 
         log.info('Stopped training after %d validation checks', n_pass / validation_interval)
+        for task_info in task_infos.values():
+            if isinstance(task_info['tr_generator'], BatchPrefetcher):
+                task_info['tr_generator'].close()
+        if self._world_size > 1:
+            # Checkpoints are written by rank 0; wait for them, and share its results.
+            distributed.barrier()
+            metric_infos = self._metric_infos = distributed.broadcast_object(metric_infos)
         return self._aggregate_results(tasks, task_infos, metric_infos)  # , validation_interval)
 
+    def _sample_tasks(self, tasks, weights, k):
+        ''' Sample k tasks by weight. In distributed training, every process uses
+        the samples of rank 0, so they all train the same task at each step. '''
+        idxs = random.choices(range(len(tasks)), weights=weights, k=k)
+        if self._world_size > 1:
+            idxs = distributed.broadcast_object(idxs)
+        return [tasks[idx] for idx in idxs]
+
+    def _sync_validation(self, tasks, should_stop):
+        ''' In distributed training, share the outcome of a validation, which only
+        rank 0 runs, with the other processes. Returns whether to stop training. '''
+        task_infos = self._task_infos
+        if self._g_optimizer is not None:
+            optimizers = [self._g_optimizer]
+        else:
+            optimizers = [task_infos[task.name]['optimizer'] for task in tasks]
+        state = distributed.broadcast_object({
+            'should_stop': should_stop,
+            'stopped': {task.name: task_infos[task.name]['stopped'] for task in tasks},
+            'lrs': [[group['lr'] for group in optimizer.param_groups] for optimizer in optimizers]})
+        if self._rank > 0:
+            for task in tasks:
+                task_info = task_infos[task.name]
+                task_info['stopped'] = state['stopped'][task.name]
+                # Reset training progress, as _validate does.
+                task_info['n_batches_since_val'] = 0
+                task_info['loss'] = 0
+                task.get_metrics(reset=True)
+            if self._model.utilization is not None:
+                self._model.utilization.get_metric(reset=True)
+            for optimizer, lrs in zip(optimizers, state['lrs']):
+                for group, lr in zip(optimizer.param_groups, lrs):
+                    group['lr'] = lr
+        return state['should_stop']
+
+    def _train_co_batched(self, tasks, task_infos, n_batches, scaling_weights,
+                          optimizer, scheduler, n_pass):
+        ''' Train for n_batches steps, each on one batch from each of tasks (which may
+        repeat), encoded with one sentence encoder call, on the sum of their scaled losses.
+        Returns the updated n_pass. '''
+        for _ in range(n_batches):
+            batches = [move_to_device(next(task_infos[task.name]['tr_generator']),
+                                      self._cuda_device) for task in tasks]
+            optimizer.zero_grad()
+            output_dicts = self._model.co_batch_forward(tasks, batches)
+            loss = 0.0
+            for task, output_dict in zip(tasks, output_dicts):
+                assert_for_log("loss" in output_dict,
+                               "Model must return a dict containing a 'loss' key")
+                task_loss = output_dict["loss"] * scaling_weights[task.name]
+                loss = loss + task_loss
+                task_info = task_infos[task.name]
+                task_info['loss'] = task_info['loss'] + task_loss.detach()
+                task_info['n_batches_since_val'] += 1
+                task_info['total_batches_trained'] += 1
+            loss.backward()
+            if self._world_size > 1:
+                distributed.all_reduce_gradients(self._model.parameters())
+
+            if self._grad_norm:
+                clip_grad_norm_(self._model.parameters(), self._grad_norm)
+            optimizer.step()
+            n_pass += 1
+            if self._nan_check_interval > 0 and n_pass % self._nan_check_interval == 0:
+                for task in tasks:
+                    self._get_loss_value(task_infos[task.name]['loss'])
+
+            if not isinstance(scheduler.lr_scheduler, ReduceLROnPlateau):
+                scheduler.step_batch(n_pass)
+        return n_pass
+
+    def _get_loss_value(self, loss_sum):
+        ''' Get the value of a running loss sum, checking for NaNs. This waits for
+        the GPU to catch up, so only do it when the value is needed. Since NaNs
+        propagate through the sum, this catches a NaN loss in any step summed. '''
+        loss_sum = float(loss_sum)
+        assert_for_log(not math.isnan(loss_sum), "NaNs in loss.")
+        return loss_sum
+
     def _aggregate_results(self, tasks, task_infos, metric_infos):
         ''' Helper function to print results after finishing training '''
         results = {}
@@ -589,24 +775,26 @@ class SamplingMultiTaskTrainer:
                 max_data_points = min(task.n_val_examples, self._val_data_limit)
             else:
                 max_data_points = task.n_val_examples
-            val_generator = BasicIterator(batch_size, instances_per_epoch=max_data_points)(
-                task.val_data, num_epochs=1, shuffle=False)
+            if TensorBatchIterator.can_read(task.val_data):
+                val_iterator = TensorBatchIterator(batch_size, instances_per_epoch=max_data_points)
+            else:
+                val_iterator = BasicIterator(batch_size, instances_per_epoch=max_data_points)
+            val_generator = val_iterator(task.val_data, num_epochs=1, shuffle=False)
             val_generator = move_to_device(val_generator, self._cuda_device)
             n_val_batches = math.ceil(max_data_points / batch_size)
-            all_val_metrics["%s_loss" % task.name] = 0.0
+            val_loss = 0.0
 
             for batch in val_generator:
                 batch_num += 1
                 out = self._forward(batch, task=task, for_training=False)
                 loss = out["loss"]
-                all_val_metrics["%s_loss" % task.name] += loss.data.cpu().numpy()
+                val_loss = val_loss + loss.detach()
                 n_examples += out["n_exs"]
 
                 # log
                 if time.time() - task_info['last_log'] > self._log_interval:
                     task_metrics = task.get_metrics()
-                    task_metrics["%s_loss" % task.name] = \
-                        all_val_metrics["%s_loss" % task.name] / batch_num
+                    task_metrics["%s_loss" % task.name] = float(val_loss) / batch_num
                     description = self._description_from_metrics(task_metrics)
                     log.info("Batch %d/%d: %s", batch_num, n_val_batches, description)
                     task_info['last_log'] = time.time()
@@ -616,7 +804,7 @@ class SamplingMultiTaskTrainer:
             task_metrics = task.get_metrics(reset=True)
             for name, value in task_metrics.items():
                 all_val_metrics["%s_%s" % (task.name, name)] = value
-            all_val_metrics["%s_loss" % task.name] /= batch_num  # n_val_batches
+            all_val_metrics["%s_loss" % task.name] = float(val_loss) / batch_num  # n_val_batches
             if task.val_metric_decreases and len(tasks) > 1:
                 all_val_metrics["micro_avg"] += (1 - all_val_metrics[task.val_metric] /
                                                  self._dec_val_scale) * n_examples
@@ -975,6 +1163,12 @@ class SamplingMultiTaskTrainer:
         val_data_limit = params.pop("val_data_limit", 5000)
         dec_val_scale = params.pop("dec_val_scale", 100)
         training_data_fraction = params.pop("training_data_fraction", 1.0)
+        batch_prefetch = params.pop("batch_prefetch", 0)
+        batch_max_tokens = params.pop("batch_max_tokens", {})
+        nan_check_interval = params.pop("nan_check_interval", 0)
+        co_batch_tasks = params.pop("co_batch_tasks", 0)
+        if isinstance(batch_max_tokens, Params):
+            batch_max_tokens = batch_max_tokens.as_dict()
 
         params.assert_empty(cls.__name__)
         return SamplingMultiTaskTrainer(model, patience=patience,
@@ -986,4 +1180,8 @@ class SamplingMultiTaskTrainer:
                                         keep_all_checkpoints=keep_all_checkpoints,
                                         val_data_limit=val_data_limit,
                                         dec_val_scale=dec_val_scale,
-                                        training_data_fraction=training_data_fraction)
+                                        training_data_fraction=training_data_fraction,
+                                        batch_prefetch=batch_prefetch,
+                                        batch_max_tokens=batch_max_tokens,
+                                        nan_check_interval=nan_check_interval,
+                                        co_batch_tasks=co_batch_tasks)
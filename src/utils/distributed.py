@@ -0,0 +1,96 @@
+'''Helpers for multi-process data-parallel training with torch.distributed.
+
+Start one process per worker with a launcher, e.g. on a single machine:
+    python -m torch.distributed.launch --nproc_per_node=8 main.py --config_file ...
+which sets the RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT environment
+variables read by init(). Without a launcher, everything here is a no-op and
+the current process is rank 0 of 1.
+'''
+import logging as log
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_launched():
+    ''' Whether this process was started by a launcher, as one of several workers. '''
+    return int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+
+def init(backend):
+    dist.init_process_group(backend=backend, init_method="env://")
+    if "OMP_NUM_THREADS" not in os.environ:
+        # Split the cores between the workers, rather than have each use all of them.
+        torch.set_num_threads(max(1, os.cpu_count() // get_world_size()))
+    log.info("Initialized distributed worker %d of %d (%s backend, %d threads)",
+             get_rank(), get_world_size(), backend, torch.get_num_threads())
+
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_initialized():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    ''' Return src's obj (any picklable object) in every process. '''
+    if not is_initialized():
+        return obj
+    if get_rank() == src:
+        data = np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+        size = torch.LongTensor([len(data)])
+    else:
+        size = torch.LongTensor([0])
+    dist.broadcast(size, src)
+    if get_rank() == src:
+        buf = torch.from_numpy(data.copy())
+    else:
+        buf = torch.empty(int(size.item()), dtype=torch.uint8)
+    dist.broadcast(buf, src)
+    return pickle.loads(buf.numpy().tobytes())
+
+
+def broadcast_parameters(module, src=0):
+    ''' Copy src's parameters and buffers of module to every process. '''
+    if not is_initialized():
+        return
+    for tensor in module.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def all_reduce_gradients(parameters):
+    ''' Average the gradients of parameters across processes, in a single all-reduce.
+
+    Every process must have gradients for the same parameters, which holds as long
+    as they all train the same tasks at each step.
+    '''
+    if not is_initialized():
+        return
+    grads = [param.grad.data for param in parameters if param.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
@@ -0,0 +1,79 @@
+'''Cache of sentence encodings, for training on top of a frozen sentence encoder.
+
+Encodings are kept in RAM up to a size cap. Once the cap is reached, further
+encodings are appended to a spill file on disk, which is read back through a
+memory map.
+'''
+import hashlib
+import logging as log
+import os
+
+import numpy as np
+
+
+def get_key(arrays):
+    ''' Hash a sequence of numpy arrays (the inputs of a sentence) to a cache key. '''
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        digest.update(str(array.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.digest()
+
+
+class EncodingCache(object):
+    ''' A key -> float32 array cache, holding up to max_mem_bytes of arrays in
+    RAM and the rest in spill_file. Call close() to delete the spill file. '''
+
+    def __init__(self, max_mem_bytes, spill_file):
+        self._max_mem_bytes = max_mem_bytes
+        self._mem_bytes = 0
+        self._in_mem = {}
+        self._spill_file = spill_file
+        self._spill_fd = None
+        self._spill_size = 0
+        self._spilled = {}  # key -> (offset in items, shape)
+        self._mmap = None
+
+    def __contains__(self, key):
+        return key in self._in_mem or key in self._spilled
+
+    def __len__(self):
+        return len(self._in_mem) + len(self._spilled)
+
+    def put(self, key, array):
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        if self._mem_bytes + array.nbytes <= self._max_mem_bytes:
+            self._in_mem[key] = array
+            self._mem_bytes += array.nbytes
+            return
+        if self._spill_fd is None:
+            log.info("Sentence encoding cache is full (%d entries, %.1f MB), spilling to %s",
+                     len(self._in_mem), self._mem_bytes / 2**20, self._spill_file)
+            self._spill_fd = open(self._spill_file, 'wb')
+        self._spill_fd.write(array.tobytes())
+        self._spilled[key] = (self._spill_size, array.shape)
+        self._spill_size += array.size
+
+    def get(self, key):
+        ''' Get a cached array, or None if key isn't cached. '''
+        array = self._in_mem.get(key)
+        if array is not None:
+            return array
+        if key not in self._spilled:
+            return None
+        offset, shape = self._spilled[key]
+        if self._mmap is None or len(self._mmap) < self._spill_size:
+            # Map the spill file again, to see entries written since it was last mapped.
+            self._spill_fd.flush()
+            self._mmap = np.memmap(self._spill_file, dtype=np.float32, mode='r',
+                                   shape=(self._spill_size,))
+        return self._mmap[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def close(self):
+        self._mmap = None
+        if self._spill_fd is not None:
+            self._spill_fd.close()
+            self._spill_fd = None
+            os.remove(self._spill_file)
+        self._in_mem, self._spilled = {}, {}
+        self._mem_bytes = self._spill_size = 0
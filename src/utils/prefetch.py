@@ -0,0 +1,77 @@
+'''Run a batch generator ahead of its consumer in a background thread.'''
+import queue
+import threading
+
+from allennlp.nn.util import move_to_device
+
+_END = object()
+
+
+class _PrefetchError(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class BatchPrefetcher(object):
+    ''' Iterate over batches from a generator, which is run ahead in a background thread.
+
+    Up to max_batches ready batches (already moved to cuda_device) are kept in
+    a queue, so that reading, bucketing, padding and tensorizing the next
+    batches overlaps with training on the current one. Exceptions raised by the
+    generator are re-raised in the consumer. Call close() when done, to stop
+    the thread.
+    '''
+
+    def __init__(self, generator, max_batches, cuda_device=-1):
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._stop = threading.Event()
+        self._done = False
+        self._thread = threading.Thread(target=self._run, args=(generator, cuda_device),
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        ''' Put an item in the queue, unless closed first. Returns False if closed. '''
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, generator, cuda_device):
+        try:
+            for batch in generator:
+                if not self._put(move_to_device(batch, cuda_device)):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put(_PrefetchError(e))
+        else:
+            self._put(_END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        item = self._queue.get()
+        if item is _END:
+            self._done = True
+            raise StopIteration
+        if isinstance(item, _PrefetchError):
+            self._done = True
+            raise item.error
+        return item
+
+    def close(self):
+        ''' Stop the background thread, and drop any prefetched batches. '''
+        self._stop.set()
+        self._done = True
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
@@ -1,49 +1,483 @@
 # Serialization and deserialization helpers.
-# Write arbitrary pickle-able Python objects to a record file, with one object
-# per line as a base64-encoded pickle.
+# Write arbitrary pickle-able Python objects to a record file. Two on-disk
+# formats are supported:
+#   - 'binary': a short magic header followed by length-prefixed pickle frames,
+#     plus a sidecar offset index (<filename>.index) with one uint64 file offset
+#     per record, and a hash sidecar (<filename>.hash) with the uint32 crc32 of
+#     each record, used to select records for training_data_fraction without
+#     reading the excluded ones.
+#     Binary files can optionally be block-compressed (zlib or lzma): records
+#     are grouped into fixed-size blocks of frames, and each block is
+#     compressed separately. Readers decompress upcoming blocks in a thread
+#     pool while the current one is consumed.
+#   - 'base64': legacy format, with one object per line as a base64-encoded
+#     pickle. Still readable, so that existing preproc caches keep working.
+#   - 'tensor': only for indexed AllenNLP Instances; stores field contents as
+#     flat memory-mapped arrays. See tensor_store.py.
+#
+# A record file may also be a shard manifest, listing shard files (in any of
+# the above formats) that are read back as one logical stream, in order.
+#
+# Record files are written under a temporary name and renamed into place once
+# complete, after which a completion marker (<filename>.done) is written with
+# the record count and the size and crc32 of the file. A record file whose
+# marker doesn't match it (e.g. from a killed run) should not be trusted; files
+# written before markers existed are checked once and given one. See
+# is_complete().
 
 import _pickle as pkl
+import array
 import base64
+import collections
+import itertools
+import json
+import lzma
+import multiprocessing
+import os
+import queue
+import shutil
+import random
+import struct
+import zlib
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from zlib import crc32
 
+import numpy as np
 
-def _serialize(examples, fd, flush_every):
+RECORD_FORMATS = ('binary', 'base64', 'tensor')
+COMPRESSIONS = ('none', 'zlib', 'lzma')
+
+_BINARY_MAGIC = b"JNTREC01"
+_BLOCK_MAGIC = b"JNTBLK01"  # followed by a one-byte compression id
+TENSOR_MAGIC = b"JNTTNS01"
+_SHARDED_MAGIC = b"JNTSHD01"  # followed by a pickled list of shard file names
+_FRAME_HEADER = struct.Struct("<I")  # uint32 payload length
+_BLOCK_HEADER = struct.Struct("<II")  # uint32 compressed length, uint32 number of records
+_READ_BUFFER_SIZE = 1 << 20
+
+# Compression name -> (id byte, compress fn, decompress fn). Both libraries
+# release the GIL while (de)compressing, so a thread pool is enough.
+_COMPRESSORS = {
+    'zlib': (b"Z", zlib.compress, zlib.decompress),
+    'lzma': (b"X", lzma.compress, lzma.decompress),
+}
+_COMPRESSOR_BY_ID = {v[0]: k for k, v in _COMPRESSORS.items()}
+
+INDEX_SUFFIX = ".index"
+HASH_SUFFIX = ".hash"
+ARRAYS_SUFFIX = ".arrays"
+DONE_SUFFIX = ".done"
+SIDECAR_SUFFIXES = (INDEX_SUFFIX, HASH_SUFFIX, ARRAYS_SUFFIX, DONE_SUFFIX)
+_TEMP_SUFFIX = ".tmp"
+
+
+def get_sidecar_paths(filename):
+    """Return the paths of all sidecar files that may accompany a record file."""
+    return [filename + suffix for suffix in SIDECAR_SUFFIXES]
+
+
+def _serialize_base64(examples, fd, flush_every):
+    """Write one base64-encoded pickle per line, and return the number of records."""
+    count = 0
     for i, example in enumerate(examples):
         blob = pkl.dumps(example)
         encoded = base64.b64encode(blob)
         fd.write(encoded)
         fd.write(b"\n")
+        count += 1
         if (i + 1) % flush_every == 0 and hasattr(fd, 'flush'):
             fd.flush()
+    return count
 
 
-def write_records(examples, filename, flush_every=10000):
-    """Streaming read records from file.
+def _serialize_binary(examples, fd, flush_every):
+    """Write length-prefixed frames, and return arrays of record offsets and hashes."""
+    offsets = array.array('Q')
+    hashes = array.array('I')
+    fd.write(_BINARY_MAGIC)
+    position = len(_BINARY_MAGIC)
+    for i, example in enumerate(examples):
+        # Use the default protocol, so that record hashes (and hence the subset
+        # selected by training_data_fraction) match the base64 format.
+        blob = pkl.dumps(example)
+        offsets.append(position)
+        hashes.append(crc32(blob) & 0xffffffff)
+        fd.write(_FRAME_HEADER.pack(len(blob)))
+        fd.write(blob)
+        position += _FRAME_HEADER.size + len(blob)
+        if (i + 1) % flush_every == 0 and hasattr(fd, 'flush'):
+            fd.flush()
+    return offsets, hashes
+
+
+def _serialize_blocks(examples, fd, flush_every, compression, block_size):
+    """Write block-compressed frames.
+
+    Returns arrays of per-record offsets (of the record's block) and hashes.
+    """
+    compressor_id, compress_fn, _ = _COMPRESSORS[compression]
+    offsets = array.array('Q')
+    hashes = array.array('I')
+    fd.write(_BLOCK_MAGIC + compressor_id)
+    position = len(_BLOCK_MAGIC) + 1
+    frames = []
+
+    def _write_block():
+        nonlocal position
+        payload = compress_fn(b"".join(frames))
+        fd.write(_BLOCK_HEADER.pack(len(payload), len(frames)))
+        fd.write(payload)
+        position += _BLOCK_HEADER.size + len(payload)
+        frames.clear()
+
+    for i, example in enumerate(examples):
+        blob = pkl.dumps(example)
+        offsets.append(position)
+        hashes.append(crc32(blob) & 0xffffffff)
+        frames.append(_FRAME_HEADER.pack(len(blob)) + blob)
+        if len(frames) >= block_size:
+            _write_block()
+        if (i + 1) % flush_every == 0 and hasattr(fd, 'flush'):
+            fd.flush()
+    if frames:
+        _write_block()
+    return offsets, hashes
+
+
+def write_records(examples, filename, flush_every=10000, record_format='binary',
+                  compression='none', block_size=1000):
+    """Streaming write records to file.
 
     Args:
       examples: iterable(object), iterable of examples to write
       filename: path to file to write
       flush_every: (int), flush to disk after this many examples consumed
+      record_format: (string) one of RECORD_FORMATS. The 'binary' format also
+        writes an offset index to <filename>.index and record hashes to
+        <filename>.hash.
+      compression: (string) one of COMPRESSIONS. Only used for the 'binary'
+        format, to compress blocks of block_size records.
+      block_size: (int) number of records per compressed block
     """
+    assert record_format in RECORD_FORMATS, \
+        "Unknown record format '%s'" % record_format
+    assert compression in COMPRESSIONS, \
+        "Unknown compression '%s'" % compression
+    # Invalidate any existing copy first, so that it isn't trusted if we die
+    # after replacing some, but not all, of its files.
+    invalidate(filename)
+    temp_file = filename + _TEMP_SUFFIX
+    count = _write_records_to(examples, temp_file, flush_every, record_format,
+                              compression, block_size)
+    _move_records(temp_file, filename)
+    _write_marker(filename, count)
+
+
+def _write_records_to(examples, filename, flush_every, record_format, compression,
+                      block_size):
+    """Write records and their sidecars, and return the number of records."""
+    if record_format == 'tensor':
+        from . import tensor_store
+        return tensor_store.write_tensor_store(examples, filename, flush_every=flush_every)
     with open(filename, 'wb') as fd:
-        _serialize(examples, fd, flush_every)
+        if record_format == 'base64':
+            return _serialize_base64(examples, fd, flush_every)
+        if compression != 'none':
+            offsets, hashes = _serialize_blocks(examples, fd, flush_every,
+                                                compression, block_size)
+        else:
+            offsets, hashes = _serialize_binary(examples, fd, flush_every)
+    with open(filename + INDEX_SUFFIX, 'wb') as fd:
+        offsets.tofile(fd)
+    with open(filename + HASH_SUFFIX, 'wb') as fd:
+        hashes.tofile(fd)
+    return len(offsets)
+
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _move_records(src, dst):
+    """Rename a record file and its sidecars into place, sidecars first.
+
+    Stale sidecars of dst that src doesn't have (e.g. from a different record
+    format) are removed.
+    """
+    for suffix in SIDECAR_SUFFIXES:
+        if suffix == DONE_SUFFIX:
+            continue
+        _remove_path(dst + suffix)
+        if os.path.lexists(src + suffix):
+            os.replace(src + suffix, dst + suffix)
+    os.replace(src, dst)
+
+
+def _file_crc32(filename):
+    checksum = 0
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(_READ_BUFFER_SIZE), b""):
+            checksum = crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+
+def _write_marker(filename, count):
+    """Atomically write the completion marker for a record file."""
+    marker = {
+        'count': count,
+        'size': os.path.getsize(filename),
+        'crc32': _file_crc32(filename),
+    }
+    temp_file = filename + DONE_SUFFIX + _TEMP_SUFFIX
+    with open(temp_file, 'w') as fd:
+        json.dump(marker, fd)
+    os.replace(temp_file, filename + DONE_SUFFIX)
+
+
+def read_marker(filename):
+    """Read the completion marker of a record file.
+
+    Returns:
+      dict with 'count', 'size' and 'crc32', or None if there is no marker.
+    """
+    try:
+        with open(filename + DONE_SUFFIX) as fd:
+            return json.load(fd)
+    except (IOError, ValueError):
+        return None
+
+
+def invalidate(filename):
+    """Remove the completion marker of a record file, if any."""
+    if os.path.lexists(filename + DONE_SUFFIX):
+        os.remove(filename + DONE_SUFFIX)
+
+
+def _count_legacy_records(filename):
+    """Check the structure of a record file without a completion marker.
+
+    The last record must be a whole pickle, and for shard manifests, all of
+    the shards must be complete. This doesn't unpickle any records.
+
+    Returns:
+      the number of records, or None if the file looks truncated.
+    """
+    try:
+        record_format = get_record_format(filename)
+        if record_format == 'sharded':
+            shard_files = read_shard_manifest(filename)
+            if not all(is_complete(shard_file) for shard_file in shard_files):
+                return None
+            return sum(read_marker(shard_file)['count'] for shard_file in shard_files)
+        elif record_format == 'base64':
+            size = os.path.getsize(filename)
+            if size == 0:
+                return 0
+            with open(filename, 'rb') as fd:
+                count = sum(chunk.count(b"\n") for chunk in
+                            iter(lambda: fd.read(_READ_BUFFER_SIZE), b""))
+                fd.seek(size - 1)
+                if fd.read(1) != b"\n":
+                    return None
+                # Find the start of the last line.
+                start = size - 1
+                while start > 0:
+                    step = min(start, _READ_BUFFER_SIZE)
+                    fd.seek(start - step)
+                    newline = fd.read(step).rfind(b"\n")
+                    start -= step
+                    if newline >= 0:
+                        start += newline + 1
+                        break
+                fd.seek(start)
+                last_blob = base64.b64decode(fd.read(size - 1 - start), validate=True)
+        else:
+            reader = get_record_reader(filename)
+            count = len(reader)
+            last_blob = reader.read_blob(count - 1) if count and \
+                hasattr(reader, 'read_blob') else b"."
+            if hasattr(reader, 'close'):
+                reader.close()
+    except Exception:
+        return None
+    # Every pickle ends with the STOP opcode.
+    return count if last_blob.endswith(b".") else None
+
+
+def is_complete(filename, verify_checksum=False):
+    """Check whether a record file was completely written.
+
+    A file without a completion marker was written before markers existed, or
+    by a run killed after renaming it into place. If its structure checks out
+    (see _count_legacy_records), a marker is written for it.
+
+    Args:
+      filename: path to a record file
+      verify_checksum: if True, also re-read the file to check its crc32.
+        Otherwise, only its size is checked against the marker.
+
+    Returns:
+      True if the file has a matching completion marker, and for shard
+      manifests, if all of the shards are complete as well.
+    """
+    if not os.path.isfile(filename):
+        return False
+    marker = read_marker(filename)
+    if marker is None and not os.path.lexists(filename + DONE_SUFFIX):
+        count = _count_legacy_records(filename)
+        if count is None:
+            return False
+        try:
+            _write_marker(filename, count)
+        except OSError:
+            # E.g. in a read-only directory; check again next time.
+            pass
+        return True
+    elif marker is None:
+        return False
+    if os.path.getsize(filename) != marker['size']:
+        return False
+    if verify_checksum and _file_crc32(filename) != marker['crc32']:
+        return False
+    if get_record_format(filename) == 'sharded':
+        return all(is_complete(shard_file, verify_checksum)
+                   for shard_file in read_shard_manifest(filename))
+    return True
+
+
+def _read_header(filename):
+    """Detect the format and compression of a record file from its header."""
+    with open(filename, 'rb') as fd:
+        magic = fd.read(len(_BINARY_MAGIC))
+        if magic == _BLOCK_MAGIC:
+            return 'binary', _COMPRESSOR_BY_ID[fd.read(1)]
+    if magic == _BINARY_MAGIC:
+        return 'binary', 'none'
+    elif magic == TENSOR_MAGIC:
+        return 'tensor', 'none'
+    elif magic == _SHARDED_MAGIC:
+        return 'sharded', 'none'
+    return 'base64', 'none'
+
+
+def get_record_format(filename):
+    """Detect the format of a record file from its header.
+
+    Returns one of RECORD_FORMATS, or 'sharded' for shard manifests.
+    """
+    return _read_header(filename)[0]
+
+
+def get_shard_path(filename, shard, num_shards):
+    """Get the canonical path for one shard of a record file."""
+    return "%s.shard-%05d-of-%05d" % (filename, shard, num_shards)
+
+
+def get_record_paths(filename):
+    """Return all existing files (and .arrays dirs) that make up a record file,
+    including its sidecars, and for shard manifests, the shards and theirs."""
+    paths = [path for path in [filename] + get_sidecar_paths(filename)
+             if os.path.exists(path)]
+    if os.path.isfile(filename) and get_record_format(filename) == 'sharded':
+        for shard_file in read_shard_manifest(filename):
+            paths.extend(get_record_paths(shard_file))
+    return paths
+
+
+def write_shard_manifest(filename, shard_files):
+    """Write a record file that reads the given shard files as one stream.
+
+    Shards are stored by basename and resolved relative to the (real) directory
+    of the manifest, so a symlinked manifest finds its shards. All shards must
+    be complete; the manifest's marker records their total count.
+    """
+    invalidate(filename)
+    count = 0
+    for shard_file in shard_files:
+        assert is_complete(shard_file), "Shard '%s' is incomplete!" % shard_file
+        count += read_marker(shard_file)['count']
+    temp_file = filename + _TEMP_SUFFIX
+    with open(temp_file, 'wb') as fd:
+        fd.write(_SHARDED_MAGIC)
+        pkl.dump([os.path.basename(f) for f in shard_files], fd)
+    _move_records(temp_file, filename)
+    _write_marker(filename, count)
+
+
+def read_shard_manifest(filename):
+    """Return the paths of the shard files listed in a shard manifest."""
+    with open(filename, 'rb') as fd:
+        assert fd.read(len(_SHARDED_MAGIC)) == _SHARDED_MAGIC, \
+            "File '%s' is not a shard manifest!" % filename
+        shard_names = pkl.load(fd)
+    shard_dir = os.path.dirname(os.path.realpath(filename))
+    return [os.path.join(shard_dir, name) for name in shard_names]
+
+
+def read_index(filename):
+    """Read the offset index of a binary record file.
+
+    Returns:
+      array.array('Q') of file offsets, one per record. For block-compressed
+      files, this is the offset of the block holding the record.
+    """
+    offsets = array.array('Q')
+    index_file = filename + INDEX_SUFFIX
+    with open(index_file, 'rb') as fd:
+        offsets.frombytes(fd.read())
+    return offsets
 
 
 class RepeatableIterator(object):
     """Repeatable iterator class."""
 
-    def __init__(self, iter_fn):
+    def __init__(self, iter_fn, shard_fn=None, batch_source=None):
         """Create a repeatable iterator.
 
         Args:
           iter_fn: callable with no arguments, creates an iterator
+          shard_fn: optional callable (shard, num_shards, chunk_size), creates a
+            RepeatableIterator over one shard of the items; see shard()
+          batch_source: optional (store, order_fn) for items read from a tensor
+            store, where order_fn() returns the indices of the items of a pass;
+            see get_batch_source()
         """
         self._iter_fn = iter_fn
+        self._shard_fn = shard_fn
+        self._batch_source = batch_source
         self._counter = 0
 
     def get_counter(self):
         return self._counter
 
+    def get_batch_source(self):
+        """Return (store, order_fn) to read batches straight from the arrays of
+        a tensor store (see tensor_store.TensorBatchIterator), or None.
+
+        order_fn() returns the indices of the items of the next pass, in the
+        order this iterator would yield them, and counts as a pass.
+        """
+        if self._batch_source is None:
+            return None
+        store, order_fn = self._batch_source
+
+        def _next_order():
+            self._counter += 1
+            return order_fn()
+        return store, _next_order
+
+    def shard(self, shard, num_shards, chunk_size=None):
+        """Return a RepeatableIterator over the shard-th of num_shards disjoint
+        parts of the items, without reading the others, or None if this
+        iterator can't be sharded. See read_records for the arguments."""
+        if self._shard_fn is None:
+            return None
+        return self._shard_fn(shard, num_shards, chunk_size)
+
     def __iter__(self):
         self._counter += 1
         return self._iter_fn().__iter__()
@@ -57,28 +491,515 @@ def bytes_to_float(b):
     return float(crc32(b) & 0xffffffff) / 2**32
 
 
-def read_records(filename, repeatable=False, fraction=None):
+def read_hashes(filename):
+    """Read the hash sidecar of a binary record file, if there is one.
+
+    Returns:
+      np.ndarray of uint32 record hashes, or None if the sidecar is missing
+    """
+    hash_file = filename + HASH_SUFFIX
+    if not os.path.exists(hash_file):
+        return None
+    return np.fromfile(hash_file, dtype=np.uint32)
+
+
+def select_by_hash(hashes, fraction):
+    """Return the (sorted) indices of records kept by fraction.
+
+    Matches the per-record rule used when reading, bytes_to_float(blob) <= fraction.
+    """
+    return np.flatnonzero(hashes.astype(np.float64) / 2**32 <= fraction)
+
+
+def _iter_base64_blobs(filename):
+    with open(filename, 'rb') as fd:
+        for line in fd:
+            yield base64.b64decode(line)
+
+
+def _iter_binary_blobs(filename):
+    with open(filename, 'rb', buffering=_READ_BUFFER_SIZE) as fd:
+        assert fd.read(len(_BINARY_MAGIC)) == _BINARY_MAGIC, \
+            "File '%s' is not a binary record file!" % filename
+        while True:
+            header = fd.read(_FRAME_HEADER.size)
+            if not header:
+                return
+            (length,) = _FRAME_HEADER.unpack(header)
+            blob = fd.read(length)
+            if len(blob) < length:
+                raise IOError("Truncated record in '%s'" % filename)
+            yield blob
+
+
+def _split_frames(payload):
+    """Split a decompressed block into its record blobs."""
+    view = memoryview(payload)
+    blobs, position = [], 0
+    while position < len(view):
+        (length,) = _FRAME_HEADER.unpack_from(view, position)
+        position += _FRAME_HEADER.size
+        blobs.append(bytes(view[position:position + length]))
+        position += length
+    return blobs
+
+
+def _iter_blocks(fd):
+    """Yield (number of records, compressed payload) for each block in fd."""
+    while True:
+        header = fd.read(_BLOCK_HEADER.size)
+        if not header:
+            return
+        length, num_records = _BLOCK_HEADER.unpack(header)
+        payload = fd.read(length)
+        if len(payload) < length:
+            raise IOError("Truncated block in '%s'" % fd.name)
+        yield num_records, payload
+
+
+def _iter_block_blobs(filename, keep=None, num_workers=2):
+    """Yield record blobs of a block-compressed file, in order.
+
+    Blocks are decompressed in a pool of num_workers threads, keeping up to
+    2 * num_workers blocks in flight ahead of the consumer.
+
+    Args:
+      keep: optional boolean array, one entry per record; records with a False
+        entry are skipped, and blocks with no kept records are not decompressed.
+    """
+    with open(filename, 'rb', buffering=_READ_BUFFER_SIZE) as fd:
+        assert fd.read(len(_BLOCK_MAGIC)) == _BLOCK_MAGIC, \
+            "File '%s' is not a block-compressed record file!" % filename
+        decompress_fn = _COMPRESSORS[_COMPRESSOR_BY_ID[fd.read(1)]][2]
+
+        def _decompress(first, payload):
+            return first, _split_frames(decompress_fn(payload))
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            pending = collections.deque()
+
+            def _drain_one():
+                first, blobs = pending.popleft().result()
+                for i, blob in enumerate(blobs, first):
+                    if keep is None or keep[i]:
+                        yield blob
+
+            first = 0
+            for num_records, payload in _iter_blocks(fd):
+                if keep is None or keep[first:first + num_records].any():
+                    pending.append(pool.submit(_decompress, first, payload))
+                first += num_records
+                if len(pending) > 2 * num_workers:
+                    yield from _drain_one()
+            while pending:
+                yield from _drain_one()
+
+
+def _build_index(filename, record_format):
+    """Build an offset index by scanning a record file once."""
+    offsets = array.array('Q')
+    with open(filename, 'rb', buffering=_READ_BUFFER_SIZE) as fd:
+        if _read_header(filename)[1] != 'none':
+            position = fd.seek(len(_BLOCK_MAGIC) + 1)
+            for num_records, payload in _iter_blocks(fd):
+                offsets.extend([position] * num_records)
+                position += _BLOCK_HEADER.size + len(payload)
+        elif record_format == 'binary':
+            position = fd.seek(len(_BINARY_MAGIC))
+            while True:
+                header = fd.read(_FRAME_HEADER.size)
+                if not header:
+                    break
+                (length,) = _FRAME_HEADER.unpack(header)
+                offsets.append(position)
+                position = fd.seek(length, os.SEEK_CUR)
+        else:
+            position = 0
+            for line in fd:
+                offsets.append(position)
+                position += len(line)
+    return offsets
+
+
+class IndexedRecordReader(object):
+    """Random-access reader for a binary or base64 record file.
+
+    Uses the <filename>.index sidecar if present, and otherwise builds the
+    offset index in memory by scanning the file once. For block-compressed
+    files, reading a record decompresses its whole block; the most recent
+    block is cached, so reading in file order stays cheap.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._record_format, self._compression = _read_header(filename)
+        assert self._record_format in ('binary', 'base64'), \
+            "IndexedRecordReader can't read '%s' files." % self._record_format
+        if os.path.exists(filename + INDEX_SUFFIX):
+            self._offsets = read_index(filename)
+        else:
+            self._offsets = _build_index(filename, self._record_format)
+        self._selected = {}
+        self._fd = None
+        self._fd_pid = None  # Process that opened _fd.
+        self._block = (None, None)  # (block offset, record blobs)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getstate__(self):
+        # File handles can't be pickled; reopen lazily after unpickling.
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_fd_pid'] = None
+        state['_block'] = (None, None)
+        return state
+
+    def read_blob(self, i):
+        """Return the raw pickle bytes of record i."""
+        if self._fd_pid != os.getpid():
+            # A forked child shares the file position of its parent's handle
+            # (and its siblings'), so it needs a handle of its own.
+            self._fd = open(self._filename, 'rb')
+            self._fd_pid = os.getpid()
+            self._block = (None, None)
+        offset = self._offsets[i]
+        if self._compression != 'none':
+            if self._block[0] != offset:
+                self._fd.seek(offset)
+                _, payload = next(_iter_blocks(self._fd))
+                decompress_fn = _COMPRESSORS[self._compression][2]
+                self._block = (offset, _split_frames(decompress_fn(payload)))
+            return self._block[1][i - bisect_left(self._offsets, offset)]
+        self._fd.seek(offset)
+        if self._record_format == 'binary':
+            (length,) = _FRAME_HEADER.unpack(self._fd.read(_FRAME_HEADER.size))
+            return self._fd.read(length)
+        return base64.b64decode(self._fd.readline())
+
+    def __getitem__(self, i):
+        return pkl.loads(self.read_blob(i))
+
+    def get_block_ids(self, indices):
+        """Return the id of the compressed block holding each of indices, or
+        None if the file isn't block-compressed."""
+        if self._compression == 'none':
+            return None
+        return np.frombuffer(self._offsets, dtype=np.uint64)[indices]
+
+    def get_indices(self, fraction=None):
+        """Return the indices of records selected by fraction, in file order.
+
+        The selection is computed once per fraction and cached.
+        """
+        if not (fraction and fraction < 1):
+            return np.arange(len(self))
+        if fraction not in self._selected:
+            hashes = read_hashes(self._filename)
+            if hashes is not None:
+                self._selected[fraction] = select_by_hash(hashes, fraction)
+            else:
+                self._selected[fraction] = np.array(
+                    [i for i in range(len(self))
+                     if bytes_to_float(self.read_blob(i)) <= fraction],
+                    dtype=np.int64)
+        return self._selected[fraction]
+
+    def close(self):
+        if self._fd is not None and self._fd_pid == os.getpid():
+            self._fd.close()
+        self._fd = self._fd_pid = None
+
+
+class ShardedRecordReader(object):
+    """Random-access reader over the shards of a shard manifest, concatenated."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._readers = [get_record_reader(f) for f in read_shard_manifest(filename)]
+        self._starts = np.cumsum([0] + [len(r) for r in self._readers])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def _locate(self, i):
+        shard = int(np.searchsorted(self._starts, i, side='right')) - 1
+        return self._readers[shard], i - int(self._starts[shard])
+
+    def read_blob(self, i):
+        reader, j = self._locate(i)
+        return reader.read_blob(j)
+
+    def __getitem__(self, i):
+        reader, j = self._locate(i)
+        return reader[j]
+
+    def get_block_ids(self, indices):
+        shards = np.searchsorted(self._starts, indices, side='right') - 1
+        block_ids = np.zeros(len(indices), dtype=np.uint64)
+        compressed = False
+        for shard, reader in enumerate(self._readers):
+            mask = shards == shard
+            if not mask.any():
+                continue
+            local = indices[mask] - self._starts[shard]
+            ids = reader.get_block_ids(local) if hasattr(reader, 'get_block_ids') else None
+            if ids is None:
+                ids = local  # Every record is its own block.
+            else:
+                compressed = True
+            block_ids[mask] = (np.uint64(shard) << np.uint64(48)) + ids.astype(np.uint64)
+        return block_ids if compressed else None
+
+    def get_indices(self, fraction=None):
+        return np.concatenate([reader.get_indices(fraction) + start for reader, start
+                               in zip(self._readers, self._starts)]).astype(np.int64)
+
+    def close(self):
+        for reader in self._readers:
+            if hasattr(reader, 'close'):
+                reader.close()
+
+
+def get_record_reader(filename):
+    """Get a random-access reader for a record file in any format.
+
+    Readers support len(), reader[i] and get_indices(fraction); all but tensor
+    stores also support read_blob(i).
+    """
+    record_format = get_record_format(filename)
+    if record_format == 'tensor':
+        from . import tensor_store
+        return tensor_store.TensorStore(filename)
+    elif record_format == 'sharded':
+        return ShardedRecordReader(filename)
+    return IndexedRecordReader(filename)
+
+
+def _shuffle_order(reader, order, rng):
+    """Return a random permutation of order, a sorted array of record indices.
+
+    For block-compressed files, reading records in a fully random order would
+    decompress a whole block for each record. Instead, the order of the blocks
+    is shuffled, and then the order of the records within each block, so that
+    every block is decompressed once per pass.
+    """
+    block_ids = reader.get_block_ids(order) if hasattr(reader, 'get_block_ids') else None
+    if block_ids is None:
+        return rng.permutation(order)
+    # order is in file order, so the records of each block are contiguous.
+    blocks = np.split(order, np.flatnonzero(block_ids[1:] != block_ids[:-1]) + 1)
+    return np.concatenate([rng.permutation(blocks[b]) for b in rng.permutation(len(blocks))])
+
+
+def _shard_order(reader, order, shard, num_shards, chunk_size=None):
+    """Return the part of order, an array of record indices, read by shard of num_shards.
+
+    If chunk_size is set, shards take every num_shards-th run of chunk_size
+    records in order. Otherwise, for block-compressed files, each shard gets
+    whole blocks (in the order they appear in order), so that each block is
+    decompressed by a single shard, and for other files, shards take every
+    num_shards-th record.
+    """
+    if chunk_size:
+        chunks = [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+        shard_chunks = chunks[shard::num_shards]
+        return np.concatenate(shard_chunks) if shard_chunks else order[:0]
+    block_ids = reader.get_block_ids(order) if hasattr(reader, 'get_block_ids') else None
+    if block_ids is None:
+        return order[shard::num_shards]
+    blocks = np.split(order, np.flatnonzero(block_ids[1:] != block_ids[:-1]) + 1)
+    shard_blocks = blocks[shard::num_shards]
+    return np.concatenate(shard_blocks) if shard_blocks else order[:0]
+
+
+def _prefetch_worker(reader, order, worker_id, num_workers, chunk_size, out_queue):
+    """Read every num_workers-th chunk of records in order, starting at chunk worker_id.
+
+    Chunks of Instances are sent encoded as arrays (see
+    tensor_store.encode_instances), and other chunks as they are.
+    """
+    from . import tensor_store
+    for start in range(worker_id * chunk_size, len(order), num_workers * chunk_size):
+        records = [reader[int(i)] for i in order[start:start + chunk_size]]
+        chunk = tensor_store.encode_instances(records)
+        out_queue.put(('records', records) if chunk is None else ('arrays', chunk))
+
+
+def _iter_prefetched(reader, order, num_workers, chunk_size=64, max_chunks=8):
+    """Yield records of a random-access reader in the given order, read by worker processes.
+
+    Records are split into chunks of chunk_size, and worker w reads chunks
+    w, w + num_workers, ... into its own queue of at most max_chunks chunks.
+    The main process takes chunks from the queues round-robin, so records come
+    out in exactly the given order.
+
+    Sending an object through a queue pickles it again, and unpickling an
+    Instance costs about as much as reading it from the file. So workers encode
+    Instances as flat arrays, which the main process unpickles and turns back
+    into Instances much faster.
+    """
+    from . import tensor_store
+    ctx = multiprocessing.get_context('fork')
+    queues = [ctx.Queue(maxsize=max_chunks) for _ in range(num_workers)]
+    workers = [ctx.Process(target=_prefetch_worker,
+                           args=(reader, order, w, num_workers, chunk_size, queues[w]),
+                           daemon=True)
+               for w in range(num_workers)]
+    try:
+        for worker in workers:
+            worker.start()
+        num_chunks = (len(order) + chunk_size - 1) // chunk_size
+        for c in range(num_chunks):
+            w = c % num_workers
+            while True:
+                try:
+                    kind, chunk = queues[w].get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    if not workers[w].is_alive():
+                        raise RuntimeError("Record prefetch worker %d for '%s' died." %
+                                           (w, reader._filename))
+            yield from (tensor_store.decode_instances(chunk) if kind == 'arrays' else chunk)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def read_records(filename, repeatable=False, fraction=None, shuffle=False,
+                 decompress_threads=2, shard=None, seed=None, shard_chunk_size=None,
+                 prefetch_workers=0):
     """Streaming read records from file.
 
     Args:
-      filename: path to file of b64-encoded pickles, one per line
+      filename: path to record file, in any of RECORD_FORMATS
       repeatable: if true, returns a RepeatableIterator that can read the file
         multiple times.
       fraction: if set to a float between 0 and 1, load only the specified percentage
         of examples. Hashing is used to ensure that the same examples are loaded each
         epoch.
+      shuffle: if true, read records in a new random order on each pass, using
+        random access through the offset index. The permutation is drawn from
+        Python's global random state, so it follows the run's random seed.
+        Block-compressed files are shuffled by block, and then within blocks.
+      shard: optional (k, num_shards), to read only the k-th of num_shards
+        disjoint parts of each pass, e.g. for one of several data-parallel
+        processes. Records are read by random access, so the other parts are
+        never read or unpickled.
+      seed: (int) if set, shuffle pass e with seed + e instead of the global
+        random state. Processes reading shards of a file must use the same seed,
+        so that their shards of each pass are disjoint and cover the file.
+      shard_chunk_size: (int) if set, shards take every num_shards-th run of
+        this many records (e.g. batches) of each pass; see _shard_order.
+      decompress_threads: (int) number of threads used to decompress blocks of
+        block-compressed files
+      prefetch_workers: (int) if positive, read and unpickle records in this
+        many worker processes, each handling a disjoint stripe of each pass,
+        while the caller consumes them in order; see _iter_prefetched. Not used
+        for 'tensor' files, which are cheap to read.
+
+    A shard manifest is read as the concatenation of its shards.
 
     Returns:
-      iterable, possible repeatable, yielding deserialized Python objects
+      iterable, possible repeatable, yielding deserialized Python objects. If
+      repeatable, its shard() method reads a shard of the same records, unless
+      this is already a shard or is shuffled without a seed, and for tensor
+      stores, its get_batch_source() reads batches without building Instances.
     """
+    shard_fn = None
+    # Shards of a shuffled file are only disjoint if they use the same seed.
+    if shard is None and (seed is not None or not shuffle):
+        def shard_fn(k, num_shards, chunk_size):
+            return read_records(filename, repeatable=True, fraction=fraction,
+                                shuffle=shuffle, decompress_threads=decompress_threads,
+                                shard=(k, num_shards), seed=seed,
+                                shard_chunk_size=chunk_size,
+                                prefetch_workers=prefetch_workers)
+
+    record_format, compression = _read_header(filename)
+    shard_files = []
+    base_format = record_format
+    if record_format == 'sharded':
+        shard_files = read_shard_manifest(filename)
+        base_format = get_record_format(shard_files[0]) if shard_files else 'binary'
+    use_prefetch = prefetch_workers > 0 and base_format != 'tensor'
+
+    if shuffle or shard is not None or use_prefetch:
+        reader = get_record_reader(filename)
+        passes = itertools.count()
+
+        def _pass_order():
+            order = reader.get_indices(fraction)
+            n_pass = next(passes)
+            if shuffle:
+                if seed is None:
+                    rng = np.random.RandomState(random.randint(0, 2**32 - 1))
+                else:
+                    rng = np.random.RandomState((seed + n_pass) % 2**32)
+                order = _shuffle_order(reader, order, rng)
+            if shard is not None:
+                order = _shard_order(reader, order, *shard, chunk_size=shard_chunk_size)
+            return order
+
+        def _iter_random_access_fn():
+            if use_prefetch:
+                return _iter_prefetched(reader, _pass_order(), prefetch_workers)
+            return (reader[int(i)] for i in _pass_order())
+        batch_source = (reader, _pass_order) if record_format == 'tensor' else None
+        return RepeatableIterator(_iter_random_access_fn, shard_fn, batch_source) \
+            if repeatable else _iter_random_access_fn()
+    elif record_format == 'sharded':
+        def _iter_shards_fn():
+            for shard_file in shard_files:
+                yield from read_records(shard_file, fraction=fraction,
+                                        decompress_threads=decompress_threads)
+        return RepeatableIterator(_iter_shards_fn, shard_fn) if repeatable else _iter_shards_fn()
+    elif record_format == 'tensor':
+        from . import tensor_store
+        store = tensor_store.TensorStore(filename)
+
+        def _iter_tensor_fn():
+            return store.iter_instances(fraction=fraction)
+        batch_source = (store, lambda: store.get_indices(fraction))
+        return RepeatableIterator(_iter_tensor_fn, shard_fn, batch_source) if repeatable \
+            else _iter_tensor_fn()
+    elif compression != 'none':
+        hashes = read_hashes(filename) if fraction and fraction < 1 else None
+
+        def _iter_blocks_fn():
+            keep = None
+            if hashes is not None:
+                keep = np.zeros(len(hashes), dtype=bool)
+                keep[select_by_hash(hashes, fraction)] = True
+            for blob in _iter_block_blobs(filename, keep=keep,
+                                          num_workers=decompress_threads):
+                if hashes is None and fraction and fraction < 1 and \
+                        bytes_to_float(blob) > fraction:
+                    continue
+                yield pkl.loads(blob)
+        return RepeatableIterator(_iter_blocks_fn, shard_fn) if repeatable else _iter_blocks_fn()
+    elif fraction and fraction < 1 and record_format == 'binary' and \
+            os.path.exists(filename + HASH_SUFFIX) and os.path.exists(filename + INDEX_SUFFIX):
+        # Seek straight to the selected records, without reading the others.
+        reader = IndexedRecordReader(filename)
+
+        def _iter_selected_fn():
+            for i in reader.get_indices(fraction):
+                yield reader[int(i)]
+        return RepeatableIterator(_iter_selected_fn, shard_fn) if repeatable else _iter_selected_fn()
+    elif record_format == 'binary':
+        blob_iter_fn = _iter_binary_blobs
+    else:
+        blob_iter_fn = _iter_base64_blobs
+
     def _iter_fn():
-        with open(filename, 'rb') as fd:
-            for line in fd:
-                blob = base64.b64decode(line)
-                if fraction and fraction < 1:
-                    hash_float = bytes_to_float(blob)
-                    if hash_float > fraction:
-                        continue
-                example = pkl.loads(blob)
-                yield example
-    return RepeatableIterator(_iter_fn) if repeatable else _iter_fn()
+        for blob in blob_iter_fn(filename):
+            if fraction and fraction < 1:
+                hash_float = bytes_to_float(blob)
+                if hash_float > fraction:
+                    continue
+            example = pkl.loads(blob)
+            yield example
+    return RepeatableIterator(_iter_fn, shard_fn) if repeatable else _iter_fn()
@@ -0,0 +1,177 @@
+'''Content-addressed cache of preprocessing artifacts, shared across experiments.
+
+Artifacts (files or directories) are stored as <cache_dir>/<name>-<key>, where
+key is a hash of everything the artifact was built from, so experiments with
+the same inputs reuse each other's artifacts and different inputs never clash.
+Entries are published by renaming a fully written temporary copy into place,
+so concurrent jobs never see a partial entry; if two jobs build the same
+artifact, the first to publish wins and the other copy is discarded.
+'''
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import tempfile
+
+
+def get_key(**inputs):
+    ''' Hash a dict of JSON-serializable inputs to a short hex key. '''
+    blob = json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+def get_file_fingerprint(path):
+    ''' Identify a (large) input file by path, size and mtime, without reading it. '''
+    if not path or not os.path.exists(path):
+        return {'path': path}
+    stat = os.stat(path)
+    return {'path': os.path.realpath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def get_dir_fingerprint(path):
+    ''' Identify all files under path (or path itself, if it's a file) by
+    name, size and mtime, without reading them. See get_file_fingerprint. '''
+    if not os.path.isdir(path):
+        return get_file_fingerprint(path)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, filename))
+            files.append((os.path.relpath(os.path.join(dirpath, filename), path),
+                          stat.st_size, stat.st_mtime))
+    return {'path': os.path.realpath(path), 'files': files}
+
+
+def get_file_digest(path, sample_size=None):
+    ''' Hash the contents of a file.
+
+    If sample_size is set, only the size and the first and last sample_size
+    bytes are hashed, which is enough to tell apart versions of large data
+    files without reading them in full.
+    '''
+    digest = hashlib.sha1()
+    size = os.path.getsize(path)
+    digest.update(str(size).encode('utf-8'))
+    with open(path, 'rb') as fd:
+        if sample_size is None or size <= 2 * sample_size:
+            for chunk in iter(lambda: fd.read(1 << 20), b""):
+                digest.update(chunk)
+        else:
+            digest.update(fd.read(sample_size))
+            fd.seek(-sample_size, os.SEEK_END)
+            digest.update(fd.read(sample_size))
+    return digest.hexdigest()
+
+
+def get_dir_digest(path, sample_size=None):
+    ''' Hash the names and contents of all files under path (or of path itself,
+    if it's a file). See get_file_digest. '''
+    if os.path.isfile(path):
+        return get_file_digest(path, sample_size)
+    digests = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            digests.append((os.path.relpath(file_path, path),
+                            get_file_digest(file_path, sample_size)))
+    return get_key(files=digests)
+
+
+def get_entry_path(cache_dir, name, key):
+    return os.path.join(cache_dir, "%s-%s" % (name, key))
+
+
+def _link_or_copy(src, dst):
+    ''' Hardlink src to dst, falling back to a copy (e.g. across filesystems). '''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _copy_entry(src, dst):
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        # Replace, rather than write through, existing files.
+        os.remove(dst)
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link_or_copy)
+    else:
+        _link_or_copy(src, dst)
+
+
+def fetch(cache_dir, name, key, dst):
+    ''' Copy (by hardlinking) a cached entry to dst, if it exists.
+
+    Returns:
+        True if the entry was found and copied.
+    '''
+    if not cache_dir:
+        return False
+    entry = get_entry_path(cache_dir, name, key)
+    if not os.path.exists(entry):
+        return False
+    _copy_entry(entry, dst)
+    log.info("\tReused shared cache entry %s for %s", entry, dst)
+    return True
+
+
+def fetch_files(cache_dir, name, key, dst_dir):
+    ''' Copy (by hardlinking) the files of an entry made by publish_files into dst_dir.
+
+    Returns:
+        True if the entry was found and copied.
+    '''
+    if not cache_dir:
+        return False
+    entry = get_entry_path(cache_dir, name, key)
+    if not os.path.isdir(entry):
+        return False
+    for filename in sorted(os.listdir(entry)):
+        _copy_entry(os.path.join(entry, filename), os.path.join(dst_dir, filename))
+    log.info("\tReused shared cache entry %s in %s", entry, dst_dir)
+    return True
+
+
+def publish(cache_dir, name, key, src):
+    ''' Add src to the cache as an entry, unless it's already there. '''
+    _publish(cache_dir, name, key, src, lambda temp_entry: _copy_entry(src, temp_entry))
+
+
+def publish_files(cache_dir, name, key, paths):
+    ''' Add a directory entry holding the given files (by basename) to the cache. '''
+    def _populate(temp_entry):
+        os.makedirs(temp_entry)
+        for path in paths:
+            _copy_entry(path, os.path.join(temp_entry, os.path.basename(path)))
+    _publish(cache_dir, name, key, ", ".join(paths), _populate)
+
+
+def _publish(cache_dir, name, key, description, populate_fn):
+    if not cache_dir:
+        return
+    entry = get_entry_path(cache_dir, name, key)
+    if os.path.exists(entry):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=".%s-%s." % (name, key), dir=cache_dir)
+    try:
+        temp_entry = os.path.join(temp_dir, name)
+        populate_fn(temp_entry)
+        try:
+            # Fails if another job published the same entry in the meantime;
+            # os.rename won't replace a non-empty directory.
+            if os.path.exists(entry):
+                return
+            os.rename(temp_entry, entry)
+        except OSError:
+            if not os.path.exists(entry):
+                raise
+            return
+        log.info("\tAdded %s to shared cache as %s", description, entry)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,616 @@
+'''Pre-tensorized, memory-mapped storage for indexed Instances.
+
+Instead of pickling every indexed Instance, this writes the numeric content of
+each field (token ids for each TextField namespace, label ids, spans) into flat
+arrays on disk, plus an offsets table for variable-length fields. Readers map
+the arrays with np.memmap, so reading an example doesn't unpickle it, and
+several runs on one node share the same pages in the OS page cache.
+
+Training and evaluation read tensor stores with TensorBatchIterator, which
+builds each padded batch straight from the mapped arrays, with one gather per
+stored key, instead of building, padding and tensorizing an Instance per
+example. Fields stored as pickled extras are still batched through AllenNLP.
+Reading a store as an iterable of Instances (e.g. with the AllenNLP iterators)
+rebuilds each Instance from shallow copies of per-field templates.
+
+On-disk layout, for a record file <file>:
+    <file>          header: magic + pickled schema (field templates, dtypes,
+                    number of examples)
+    <file>.arrays/  one raw array file per stored key, plus '<key>.offsets'
+                    (int64) for variable-length keys, a uint32 'hash' array
+                    used for training_data_fraction, and an 'extras' binary
+                    record file holding any fields that can't be stored as
+                    arrays (e.g. MetadataField), one dict per example.
+
+The header is written last, so a partially written store is never picked up.
+All Instances in a store must have the same fields; the field types and
+per-example structure are taken from the first Instance.
+'''
+import _pickle as pkl
+import copy
+import itertools
+import os
+import random
+import shutil
+from zlib import crc32
+
+import numpy as np
+import torch
+
+from allennlp.data import Instance
+from allennlp.data.dataset import Batch
+from allennlp.data.fields import TextField, LabelField, SpanField, ListField
+from allennlp.data.token_indexers import TokenCharactersIndexer
+
+from ..allennlp_mods.numeric_field import NumericField
+from . import serialize
+
+ARRAYS_SUFFIX = serialize.ARRAYS_SUFFIX
+_EXTRAS_NAME = "extras"
+_HASH_NAME = "hash"
+
+
+def _get_arrays_dir(filename):
+    return filename + ARRAYS_SUFFIX
+
+
+class _ArrayWriter(object):
+    ''' Append-only writer for one flat array, with an optional offsets table. '''
+
+    def __init__(self, arrays_dir, key, dtype, ragged):
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.ragged = ragged
+        self.row_shape = None
+        self._size = 0
+        self._data_fd = open(os.path.join(arrays_dir, key), 'wb')
+        self._offsets_fd = None
+        if ragged:
+            self._offsets_fd = open(os.path.join(arrays_dir, key + ".offsets"), 'wb')
+            np.zeros(1, dtype=np.int64).tofile(self._offsets_fd)
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        if not self.ragged:
+            values = values.reshape((1,) + values.shape)
+        row_shape = values.shape[1:]
+        if self.row_shape is None and (len(values) or not self.ragged):
+            self.row_shape = row_shape
+        elif row_shape != self.row_shape and len(values):
+            raise ValueError("Inconsistent shape for key '%s': %s vs %s" %
+                             (self.key, row_shape, self.row_shape))
+        values.tofile(self._data_fd)
+        self._size += len(values)
+        if self.ragged:
+            np.array([self._size], dtype=np.int64).tofile(self._offsets_fd)
+
+    def close(self):
+        self._data_fd.close()
+        if self._offsets_fd is not None:
+            self._offsets_fd.close()
+
+    def spec(self):
+        return {'dtype': self.dtype.str, 'ragged': self.ragged,
+                'row_shape': self.row_shape or (), 'size': self._size}
+
+
+class _FieldCodec(object):
+    ''' Converts one field of an Instance to and from flat arrays.
+
+    The template is a copy of the field from the first Instance, with its
+    per-example data removed; decoded fields are shallow copies of it.
+    '''
+
+    def __init__(self, name, field):
+        self.name = name
+        self.template = self._make_template(field)
+
+    def _make_template(self, field):
+        return copy.copy(field)
+
+    def keys(self):
+        ''' Return (key, dtype, ragged) for each array this codec writes. '''
+        raise NotImplementedError
+
+    def encode(self, field):
+        ''' Return a dict of key -> array-like values for this field. '''
+        raise NotImplementedError
+
+    def decode(self, arrays, i):
+        ''' Rebuild the field for example i from the mapped arrays. '''
+        raise NotImplementedError
+
+    def batch(self, arrays, indices):
+        ''' Return the batched tensor(s) of this field for the given examples,
+        as Batch.as_tensor_dict() would for the decoded fields. '''
+        raise NotImplementedError
+
+    def get_lengths(self, arrays, indices):
+        ''' Return the length of this field for each example, or None if it
+        doesn't need padding. '''
+        return None
+
+    def _key(self, suffix):
+        return "%s.%s" % (self.name, suffix)
+
+    def _batch_rows(self, values):
+        ''' Convert one row of values per example to a batch of the field's tensors. '''
+        # The template holds the first example's values; its tensor gives the
+        # dtype and shape used by the field class.
+        row = self.template.as_tensor({})
+        return torch.as_tensor(values).to(row.dtype).view((len(values),) + row.shape)
+
+
+class _TextFieldCodec(_FieldCodec):
+    ''' Stores the indexed token ids of each indexer namespace. '''
+
+    def __init__(self, name, field):
+        self._token_keys = sorted(field._indexed_tokens.keys())
+        super().__init__(name, field)
+
+    def _make_template(self, field):
+        template = copy.copy(field)
+        template._indexed_tokens = None
+        template.tokens = []
+        return template
+
+    def keys(self):
+        return [(self._key(k), np.int32, True) for k in self._token_keys]
+
+    def encode(self, field):
+        assert sorted(field._indexed_tokens.keys()) == self._token_keys
+        return {self._key(k): field._indexed_tokens[k] for k in self._token_keys}
+
+    def decode(self, arrays, i):
+        field = copy.copy(self.template)
+        # AllenNLP pads token sequences in place, so it needs plain lists.
+        field._indexed_tokens = {k: arrays.get_row(self._key(k), i).tolist()
+                                 for k in self._token_keys}
+        return field
+
+    def batch(self, arrays, indices):
+        # As TextField.as_tensor: ids padded with 0 to the longest in the batch.
+        return {k: torch.from_numpy(arrays.get_padded_rows(self._key(k), indices)
+                                    .astype(np.int64))
+                for k in self._token_keys}
+
+    def get_lengths(self, arrays, indices):
+        return arrays.get_row_lengths(self._key(self._token_keys[0]), indices)
+
+
+class _LabelFieldCodec(_FieldCodec):
+    ''' Stores the label id of a LabelField with integer labels. '''
+
+    def keys(self):
+        return [(self._key("label"), np.int64, False)]
+
+    def encode(self, field):
+        return {self._key("label"): field._label_id}
+
+    def decode(self, arrays, i):
+        field = copy.copy(self.template)
+        field.label = field._label_id = int(arrays.get_row(self._key("label"), i))
+        return field
+
+    def batch(self, arrays, indices):
+        return self._batch_rows(arrays.get_rows(self._key("label"), indices))
+
+
+class _NumericFieldCodec(_FieldCodec):
+    ''' Stores the value of a NumericField. '''
+
+    def keys(self):
+        return [(self._key("value"), np.float32, False)]
+
+    def encode(self, field):
+        return {self._key("value"): field._label_id}
+
+    def decode(self, arrays, i):
+        field = copy.copy(self.template)
+        value = arrays.get_row(self._key("value"), i)
+        field.label = value.item()
+        field._label_id = np.array(value, dtype=np.float32)
+        return field
+
+    def batch(self, arrays, indices):
+        return self._batch_rows(arrays.get_rows(self._key("value"), indices))
+
+
+class _SpanFieldCodec(_FieldCodec):
+    ''' Stores the (start, end) pair of a SpanField. '''
+
+    def keys(self):
+        return [(self._key("span"), np.int64, False)]
+
+    def encode(self, field):
+        return {self._key("span"): (field.span_start, field.span_end)}
+
+    def decode(self, arrays, i):
+        field = copy.copy(self.template)
+        field.span_start, field.span_end = arrays.get_row(self._key("span"), i).tolist()
+        return field
+
+    def batch(self, arrays, indices):
+        return self._batch_rows(arrays.get_rows(self._key("span"), indices))
+
+
+class _SpanListFieldCodec(_FieldCodec):
+    ''' Stores a ListField of SpanFields as a variable-length (n, 2) array. '''
+
+    def _make_template(self, field):
+        template = copy.copy(field)
+        template.field_list = field.field_list[:1]
+        return template
+
+    def keys(self):
+        return [(self._key("spans"), np.int64, True)]
+
+    def encode(self, field):
+        spans = [(f.span_start, f.span_end) for f in field.field_list]
+        return {self._key("spans"): np.array(spans, dtype=np.int64).reshape(-1, 2)}
+
+    def decode(self, arrays, i):
+        field = copy.copy(self.template)
+        span_template = self.template.field_list[0]
+        field_list = []
+        for start, end in arrays.get_row(self._key("spans"), i).tolist():
+            span_field = copy.copy(span_template)
+            span_field.span_start, span_field.span_end = start, end
+            field_list.append(span_field)
+        field.field_list = field_list
+        return field
+
+    def batch(self, arrays, indices):
+        # As ListField.as_tensor: lists are padded with empty spans.
+        empty_span = self.template.field_list[0].empty_field().as_tensor({}).numpy()
+        return torch.from_numpy(arrays.get_padded_rows(self._key("spans"), indices,
+                                                       padding_value=empty_span))
+
+    def get_lengths(self, arrays, indices):
+        return arrays.get_row_lengths(self._key("spans"), indices)
+
+
+def _get_codec(name, field):
+    ''' Return a codec for the field, or None to store it as a pickled extra. '''
+    if isinstance(field, TextField):
+        if field._indexed_tokens is None:
+            return None
+        # Ragged rows of char ids aren't supported; fixed-width ones (ELMo) are.
+        if any(isinstance(indexer, TokenCharactersIndexer)
+               for indexer in field._token_indexers.values()):
+            return None
+        return _TextFieldCodec(name, field)
+    if isinstance(field, LabelField) and isinstance(field.label, int):
+        return _LabelFieldCodec(name, field)
+    if isinstance(field, NumericField) and np.ndim(field._label_id) == 0:
+        return _NumericFieldCodec(name, field)
+    if isinstance(field, SpanField):
+        return _SpanFieldCodec(name, field)
+    if isinstance(field, ListField) and field.field_list and \
+            all(isinstance(f, SpanField) for f in field.field_list):
+        return _SpanListFieldCodec(name, field)
+    return None
+
+
+def write_tensor_store(instances, filename, flush_every=10000):
+    """Streaming write indexed Instances to a memory-mappable tensor store.
+
+    Args:
+      instances: iterable(Instance), indexed instances to write
+      filename: path to the header file to write; arrays go to <filename>.arrays/
+      flush_every: (int), flush the extras file after this many examples
+
+    Returns:
+      (int) the number of instances written
+    """
+    arrays_dir = _get_arrays_dir(filename)
+    if os.path.isdir(arrays_dir):
+        shutil.rmtree(arrays_dir)
+    os.makedirs(arrays_dir)
+
+    codecs, writers = None, {}
+    hashes = []
+
+    def _encoded_instances():
+        nonlocal codecs
+        for instance in instances:
+            if codecs is None:
+                codecs = {}
+                for name, field in instance.fields.items():
+                    codec = _get_codec(name, field)
+                    if codec is not None:
+                        codecs[name] = codec
+                        for key, dtype, ragged in codec.keys():
+                            writers[key] = _ArrayWriter(arrays_dir, key, dtype, ragged)
+            extras = {}
+            for name, field in instance.fields.items():
+                if name in codecs:
+                    for key, values in codecs[name].encode(field).items():
+                        writers[key].append(values)
+                else:
+                    extras[name] = field
+            if set(codecs) - set(instance.fields):
+                raise ValueError("Instance is missing fields %s; tensor stores "
+                                 "require all Instances to have the same fields." %
+                                 sorted(set(codecs) - set(instance.fields)))
+            # Hash the full Instance, as the record formats do.
+            hashes.append(crc32(pkl.dumps(instance)) & 0xffffffff)
+            yield extras
+
+    serialize.write_records(_encoded_instances(),
+                            os.path.join(arrays_dir, _EXTRAS_NAME),
+                            flush_every=flush_every, record_format='binary')
+    np.array(hashes, dtype=np.uint32).tofile(os.path.join(arrays_dir, _HASH_NAME))
+    for writer in writers.values():
+        writer.close()
+
+    schema = {
+        'num_examples': len(hashes),
+        'codecs': codecs or {},
+        'arrays': {key: writer.spec() for key, writer in writers.items()},
+    }
+    with open(filename, 'wb') as fd:
+        fd.write(serialize.TENSOR_MAGIC)
+        pkl.dump(schema, fd)
+    return len(hashes)
+
+
+def _make_instance(codecs, arrays, i, extras):
+    fields = {name: codec.decode(arrays, i) for name, codec in codecs.items()}
+    fields.update(extras)
+    instance = Instance(fields)
+    instance.indexed = True
+    return instance
+
+
+def encode_instances(instances):
+    """Encode a list of indexed Instances as flat arrays, as in a tensor store.
+
+    The result pickles and unpickles much faster than the Instances, and
+    decode_instances rebuilds them cheaply, so this is used to send Instances
+    between processes.
+
+    Returns:
+      a picklable chunk for decode_instances, or None if the Instances can't
+      be encoded, e.g. if they aren't all indexed or don't have the same fields.
+    """
+    if not instances or not all(isinstance(instance, Instance) and instance.indexed
+                                for instance in instances):
+        return None
+    codecs = {}
+    for name, field in instances[0].fields.items():
+        codec = _get_codec(name, field)
+        if codec is not None:
+            codecs[name] = codec
+    values = {key: [] for codec in codecs.values() for key, _, _ in codec.keys()}
+    extras = []
+    try:
+        for instance in instances:
+            if set(codecs) - set(instance.fields):
+                return None
+            for name, codec in codecs.items():
+                for key, value in codec.encode(instance.fields[name]).items():
+                    values[key].append(value)
+            extras.append({name: field for name, field in instance.fields.items()
+                           if name not in codecs})
+    except (AssertionError, AttributeError, TypeError, ValueError):
+        # A field doesn't match the first Instance's.
+        return None
+    data, offsets = {}, {}
+    for codec in codecs.values():
+        for key, dtype, ragged in codec.keys():
+            if not ragged:
+                data[key] = np.asarray(values[key], dtype=dtype)
+                continue
+            rows = [np.asarray(row, dtype=dtype) for row in values[key]]
+            lengths = [len(row) for row in rows]
+            rows = [row for row in rows if len(row)]
+            data[key] = np.concatenate(rows) if rows else np.zeros(0, dtype=dtype)
+            offsets[key] = np.cumsum([0] + lengths, dtype=np.int64)
+    return codecs, data, offsets, extras
+
+
+def decode_instances(chunk):
+    """Rebuild the Instances encoded by encode_instances."""
+    codecs, data, offsets, extras = chunk
+    arrays = _MappedArrays.from_arrays(data, offsets)
+    return [_make_instance(codecs, arrays, i, fields) for i, fields in enumerate(extras)]
+
+
+class _MappedArrays(object):
+    ''' Read-only, memory-mapped view of the arrays in a tensor store. '''
+
+    def __init__(self, arrays_dir=None, specs=None):
+        self._data, self._offsets = {}, {}
+        specs = specs or {}
+        for key, spec in specs.items():
+            shape = (spec['size'],) + tuple(spec['row_shape'])
+            path = os.path.join(arrays_dir, key)
+            if spec['size'] == 0:
+                self._data[key] = np.zeros(shape, dtype=spec['dtype'])
+            else:
+                self._data[key] = np.memmap(path, dtype=spec['dtype'], mode='r', shape=shape)
+            if spec['ragged']:
+                self._offsets[key] = np.fromfile(path + ".offsets", dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, data, offsets):
+        ''' View in-memory arrays (and offsets tables of ragged keys) the same way. '''
+        arrays = cls()
+        arrays._data, arrays._offsets = data, offsets
+        return arrays
+
+    def get_row(self, key, i):
+        if key in self._offsets:
+            offsets = self._offsets[key]
+            return self._data[key][offsets[i]:offsets[i + 1]]
+        return self._data[key][i]
+
+    def get_rows(self, key, indices):
+        ''' Return the rows of a fixed-size key for an array of examples. '''
+        return np.asarray(self._data[key][indices])
+
+    def get_row_lengths(self, key, indices):
+        ''' Return the row lengths of a variable-length key for an array of examples. '''
+        offsets = self._offsets[key]
+        return offsets[indices + 1] - offsets[indices]
+
+    def get_padded_rows(self, key, indices, padding_value=0):
+        ''' Return the rows of a variable-length key for an array of examples,
+        padded to the longest, as an array of (len(indices), max length) + row shape. '''
+        data, offsets = self._data[key], self._offsets[key]
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        max_length = int(lengths.max()) if len(indices) else 0
+        padded = np.empty((len(indices), max_length) + data.shape[1:], dtype=data.dtype)
+        padded[...] = padding_value
+        # Gather all of the rows from the mapped array at once.
+        rows = np.repeat(np.arange(len(indices)), lengths)
+        cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        padded[rows, cols] = data[np.repeat(starts, lengths) + cols]
+        return padded
+
+
+class TensorStore(object):
+    ''' Random-access reader for a tensor store written by write_tensor_store. '''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fd:
+            assert fd.read(len(serialize.TENSOR_MAGIC)) == serialize.TENSOR_MAGIC, \
+                "File '%s' is not a tensor store!" % filename
+            schema = pkl.load(fd)
+        arrays_dir = _get_arrays_dir(filename)
+        self._num_examples = schema['num_examples']
+        self._codecs = schema['codecs']
+        self._arrays = _MappedArrays(arrays_dir, schema['arrays'])
+        self._extras_file = os.path.join(arrays_dir, _EXTRAS_NAME)
+        self._extras_reader = None
+        self._has_extras = None
+        self._hash_file = os.path.join(arrays_dir, _HASH_NAME)
+
+    def __len__(self):
+        return self._num_examples
+
+    def get_hashes(self):
+        ''' Return the uint32 hash of each example. '''
+        return np.fromfile(self._hash_file, dtype=np.uint32)
+
+    def get_indices(self, fraction=None):
+        ''' Return the indices of examples selected by fraction, in order. '''
+        if fraction and fraction < 1:
+            return serialize.select_by_hash(self.get_hashes(), fraction)
+        return np.arange(self._num_examples)
+
+    def _make_instance(self, i, extras):
+        return _make_instance(self._codecs, self._arrays, i, extras)
+
+    def _get_extras(self, i):
+        if self._extras_reader is None:
+            self._extras_reader = serialize.IndexedRecordReader(self._extras_file)
+        return self._extras_reader[i]
+
+    def __getitem__(self, i):
+        return self._make_instance(i, self._get_extras(i))
+
+    def get_sort_lengths(self, indices):
+        ''' Return an array of (len(indices), k): the lengths of the k stored
+        fields that need padding (text fields and span lists) of each example,
+        in field order. '''
+        lengths = [codec.get_lengths(self._arrays, indices) for codec in self._codecs.values()]
+        lengths = [field_lengths for field_lengths in lengths if field_lengths is not None]
+        if not lengths:
+            return np.zeros((len(indices), 0), dtype=np.int64)
+        return np.stack(lengths, axis=1)
+
+    def get_batch(self, indices):
+        ''' Return the tensor dict for a batch of examples, the same as
+        Batch(instances).as_tensor_dict() for their Instances. '''
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = {name: codec.batch(self._arrays, indices) for name, codec in self._codecs.items()}
+        if self._has_extras is None:
+            self._has_extras = bool(self._num_examples and self._get_extras(0))
+        if self._has_extras:
+            # Fields without a codec (e.g. MetadataField) are batched by AllenNLP.
+            extras = Batch([Instance(self._get_extras(int(i))) for i in indices])
+            batch.update(extras.as_tensor_dict())
+        return batch
+
+    def iter_instances(self, fraction=None):
+        ''' Yield Instances in order, optionally only those selected by fraction. '''
+        if fraction and fraction < 1:
+            # Seek to the selected examples only.
+            for i in self.get_indices(fraction):
+                yield self[int(i)]
+            return
+        for i, extras in enumerate(serialize.read_records(self._extras_file)):
+            yield self._make_instance(i, extras)
+
+
+class TensorBatchIterator(object):
+    ''' Batches a dataset read from a tensor store straight from its arrays.
+
+    Used in place of AllenNLP's BasicIterator (sort_by_lengths=False) or
+    BucketIterator (sort_by_lengths=True), which it follows: examples are
+    taken in windows of max_instances_in_memory, sorted by the lengths of
+    their padded fields with padding_noise, and split into batches of
+    batch_size; with biggest_batch_first, the last two batches of a window
+    (which hold the longest examples) come first. Yields tensor dicts, as the
+    AllenNLP iterators do.
+
+    The dataset must be a RepeatableIterator with a batch source (see
+    can_read), e.g. from serialize.read_records on a tensor store. Each pass
+    reads the same examples, in the same order, as iterating over it would.
+    '''
+
+    def __init__(self, batch_size, sort_by_lengths=False, padding_noise=0.1,
+                 biggest_batch_first=False, max_instances_in_memory=None,
+                 instances_per_epoch=None):
+        self._batch_size = batch_size
+        self._sort_by_lengths = sort_by_lengths
+        self._padding_noise = padding_noise
+        self._biggest_batch_first = biggest_batch_first
+        self._max_instances_in_memory = max_instances_in_memory
+        self._instances_per_epoch = instances_per_epoch
+
+    @staticmethod
+    def can_read(dataset):
+        ''' Whether dataset is read from a tensor store, so it can be batched by this. '''
+        return isinstance(dataset, serialize.RepeatableIterator) and \
+            dataset.get_batch_source() is not None
+
+    def __call__(self, dataset, num_epochs=None, shuffle=True):
+        store, order_fn = dataset.get_batch_source()
+        epochs = itertools.count() if num_epochs is None else range(num_epochs)
+        for _ in epochs:
+            for batch_indices in self._create_batches(store, order_fn(), shuffle):
+                yield store.get_batch(batch_indices)
+
+    def _create_batches(self, store, order, shuffle):
+        if self._instances_per_epoch is not None:
+            order = order[:self._instances_per_epoch]
+        window_size = self._max_instances_in_memory or max(len(order), 1)
+        for start in range(0, len(order), window_size):
+            window = order[start:start + window_size]
+            rng = np.random.RandomState(random.randint(0, 2**32 - 1))
+            if self._sort_by_lengths:
+                lengths = store.get_sort_lengths(window).astype(np.float64)
+                if self._padding_noise:
+                    lengths += rng.uniform(-1, 1, lengths.shape) * lengths * self._padding_noise
+                if lengths.shape[1]:
+                    # Sort by the first field's length, then the second, etc.
+                    window = window[np.lexsort(lengths.T[::-1])]
+            elif shuffle:
+                window = rng.permutation(window)
+            batches = [window[i:i + self._batch_size]
+                       for i in range(0, len(window), self._batch_size)]
+            move_to_front = self._sort_by_lengths and self._biggest_batch_first and \
+                len(batches) > 1
+            if move_to_front:
+                last_batch = batches.pop()
+                penultimate_batch = batches.pop()
+            if shuffle and self._sort_by_lengths:
+                random.shuffle(batches)
+            if move_to_front:
+                batches.insert(0, penultimate_batch)
+                batches.insert(0, last_batch)
+            yield from batches
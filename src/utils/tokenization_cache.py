@@ -0,0 +1,118 @@
+'''On-disk cache of tokenized sentences, one cache file per source data file.
+
+Cache files live at <cache_dir>/<tokenizer name>/<source file digest>.npz, so
+they are shared by every task, experiment and run that reads the same file
+with the same tokenizer, and go stale automatically when the file changes.
+Sentences are looked up by a 64-bit hash of their raw text, and the full
+(untruncated) tokenization is stored, so one cache serves any max_seq_len.
+
+Each cache file is an uncompressed .npz with:
+    keys     uint64 sentence hashes
+    offsets  int64, len(keys) + 1 offsets into ids
+    ids      int32 token ids, per sentence
+    vocab    uint8, the distinct tokens as NUL-separated utf-8
+'''
+import hashlib
+import logging as log
+import os
+
+import numpy as np
+
+from . import shared_cache
+
+
+def _hash_sentence(sent):
+    return int.from_bytes(hashlib.blake2b(sent.encode('utf-8'), digest_size=8).digest(),
+                          'little')
+
+
+def get_cache_file(cache_dir, data_file, tokenizer_name):
+    ''' Get the cache file for a source data file. '''
+    # Source files can be large, so only sample their contents.
+    digest = shared_cache.get_file_digest(data_file, sample_size=1 << 20)
+    return os.path.join(cache_dir, tokenizer_name, digest + ".npz")
+
+
+class TokenizationCache(object):
+    ''' Tokenize sentences with tokenize_fn, reusing tokenizations saved in cache_file.
+
+    If cache_file is None, tokenizations are only kept in memory.
+    '''
+
+    def __init__(self, cache_file, tokenize_fn):
+        self._cache_file = cache_file
+        self._tokenize_fn = tokenize_fn
+        # Saved tokenizations are only decoded when they're looked up.
+        self._saved_rows = {}
+        self._saved = None
+        self._new_tokens = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            self._load()
+
+    def _load(self):
+        with np.load(self._cache_file) as saved:
+            self._saved = {name: saved[name] for name in saved.files}
+        vocab_bytes = self._saved['vocab'].tobytes()
+        self._saved['vocab'] = vocab_bytes.decode('utf-8').split("\0") if vocab_bytes else []
+        self._saved_rows = dict(zip(self._saved['keys'].tolist(),
+                                    range(len(self._saved['keys']))))
+        log.info("\tLoaded %d cached tokenizations from %s", len(self._saved_rows),
+                 self._cache_file)
+
+    def _get_saved(self, row):
+        offsets, ids, vocab = self._saved['offsets'], self._saved['ids'], self._saved['vocab']
+        return [vocab[i] for i in ids[offsets[row]:offsets[row + 1]].tolist()]
+
+    def tokenize(self, sent):
+        ''' Return the tokens of a sentence. The returned list must not be modified. '''
+        key = _hash_sentence(sent)
+        row = self._saved_rows.get(key)
+        if row is not None:
+            return self._get_saved(row)
+        tokens = self._new_tokens.get(key)
+        if tokens is None:
+            tokens = self._new_tokens[key] = self._tokenize_fn(sent)
+        return tokens
+
+    def get_missing(self, sents):
+        ''' Return the distinct sentences in sents that aren't cached yet. '''
+        missing = {}
+        for sent in sents:
+            key = _hash_sentence(sent)
+            if key not in self._saved_rows and key not in self._new_tokens:
+                missing[key] = sent
+        return list(missing.values())
+
+    def update(self, sents, token_lists):
+        ''' Add tokenizations computed elsewhere, e.g. in worker processes. '''
+        for sent, tokens in zip(sents, token_lists):
+            self._new_tokens[_hash_sentence(sent)] = tokens
+
+    def save(self):
+        ''' Write new tokenizations (along with the saved ones) to the cache file. '''
+        if self._cache_file is None or not self._new_tokens:
+            return
+        keys, token_lists = [], []
+        for key, row in self._saved_rows.items():
+            keys.append(key)
+            token_lists.append(self._get_saved(row))
+        for key, tokens in self._new_tokens.items():
+            keys.append(key)
+            token_lists.append(tokens)
+
+        token2id = {}
+        ids = [token2id.setdefault(token, len(token2id))
+               for tokens in token_lists for token in tokens]
+        offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens in token_lists], out=offsets[1:])
+        vocab = np.frombuffer("\0".join(token2id).encode('utf-8'), dtype=np.uint8)
+
+        os.makedirs(os.path.dirname(self._cache_file), exist_ok=True)
+        # Write to a temporary file and rename, so concurrent readers never see
+        # a partial file. If several runs save at once, the last one wins.
+        temp_file = "%s.%d.tmp.npz" % (self._cache_file[:-len(".npz")], os.getpid())
+        np.savez(temp_file, keys=np.array(keys, dtype=np.uint64), offsets=offsets,
+                 ids=np.array(ids, dtype=np.int32), vocab=vocab)
+        os.replace(temp_file, self._cache_file)
+        log.info("\tSaved %d tokenizations (%d new) to %s", len(keys),
+                 len(self._new_tokens), self._cache_file)
@@ -3,7 +3,11 @@ Assorted utilities for working with neural networks in AllenNLP.
 """
 from typing import Dict, List, Sequence, Optional, Union, Iterable
 
+import contextlib
 import copy
+import io
+import itertools
+import multiprocessing
 import os
 import json
 import random
@@ -25,6 +29,8 @@ from allennlp.common.checks import ConfigurationError
 from allennlp.modules.seq2seq_encoders.seq2seq_encoder import Seq2SeqEncoder
 from allennlp.common.params import Params
 
+from . import tokenization_cache
+
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -32,11 +38,39 @@ logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 TOKENIZER = MosesTokenizer()
 SOS_TOK, EOS_TOK = "<SOS>", "<EOS>"
 
+# Directory for on-disk tokenization caches (see tokenization_cache.py), or
+# None to always tokenize. Set from args.tokenization_cache_dir.
+TOKENIZATION_CACHE_DIR = None
+# Number of processes used to tokenize data files (see iter_pretokenized).
+# Set from args.tokenization_workers.
+TOKENIZATION_WORKERS = 1
+# JSON file where count_lines caches its results, or None to not cache.
+LINE_COUNT_CACHE_FILE = None
+# Shard (k, num_shards) of data files read by open_data_file, or None to read
+# whole files, and the number of files opened that way. See data_file_shard().
+_DATA_FILE_SHARD = None
+_DATA_FILE_SHARD_OPENS = 0
+
 # Note: using the full 'detokenize()' method is not recommended, since it does
 # a poor job of adding correct whitespace. Use unescape_xml() only.
 _MOSES_DETOKENIZER = MosesDetokenizer()
 
 
+def parse_task_list_arg(task_list):
+    '''Parse task list argument into a list of task names.'''
+    # Imported here, since the task modules import this one.
+    from ..tasks import ALL_GLUE_TASKS
+    task_names = []
+    for task_name in task_list.split(','):
+        if task_name == 'glue':
+            task_names.extend(ALL_GLUE_TASKS)
+        elif task_name == 'none' or task_name == '':
+            continue
+        else:
+            task_names.append(task_name)
+    return task_names
+
+
 def copy_iter(elems):
     '''Simple iterator yielding copies of elements.'''
     for elem in elems:
@@ -158,12 +192,88 @@ def unescape_moses(moses_tokens):
     return [_MOSES_DETOKENIZER.unescape_xml(t) for t in moses_tokens]
 
 
-def process_sentence(sent, max_seq_len, sos_tok=SOS_TOK, eos_tok=EOS_TOK):
-    '''process a sentence '''
+def get_tokenization_cache(data_file):
+    ''' Get a TokenizationCache for sentences from data_file, or None if
+    TOKENIZATION_CACHE_DIR isn't set. Call its save() when done. '''
+    if not TOKENIZATION_CACHE_DIR:
+        return None
+    cache_file = tokenization_cache.get_cache_file(TOKENIZATION_CACHE_DIR, data_file,
+                                                   TOKENIZER.__class__.__name__)
+    return tokenization_cache.TokenizationCache(cache_file, TOKENIZER.tokenize)
+
+
+def _tokenize(sent):
+    return TOKENIZER.tokenize(sent)
+
+
+def _get_row_sentences(rows, sent_columns, row_filter):
+    ''' Get the sentences to tokenize from rows, skipping rows that are
+    filtered out or malformed (loaders skip those rows too). '''
+    sents = []
+    for row in rows:
+        try:
+            if row_filter is not None and not row_filter(row):
+                continue
+            sents.extend(row[i] for i in sent_columns if i is not None and row[i])
+        except (IndexError, KeyError, ValueError):
+            continue
+    return sents
+
+
+def iter_pretokenized(rows, sent_columns, tok_cache=None, row_filter=None,
+                      chunk_size=10000):
+    ''' Yield (row, tok_cache) for each row, with the sentences of the row
+    tokenized ahead of time, for use with process_sentence(tok_cache=...).
+
+    If TOKENIZATION_WORKERS > 1, rows are read in chunks, and the sentences in
+    columns sent_columns of each chunk are tokenized in a process pool while
+    the previous chunk is consumed. Rows are yielded in order, and loaders
+    still decide which rows to skip; row_filter only avoids tokenizing rows
+    that the loader will skip anyway. Otherwise, rows are yielded as-is with
+    tok_cache (possibly None), and tokenized on demand.
+
+    Args:
+        rows: iterable of rows, as lists of column strings
+        sent_columns: indices of the columns holding sentences
+        tok_cache: TokenizationCache to add tokenizations to; if None, a new
+            in-memory cache is used for each chunk.
+        row_filter: optional function of a row, false for rows to skip
+    '''
+    if TOKENIZATION_WORKERS <= 1:
+        for row in rows:
+            yield row, tok_cache
+        return
+
+    rows = iter(rows)
+
+    def _submit(pool):
+        chunk = list(itertools.islice(rows, chunk_size))
+        chunk_cache = tok_cache
+        if chunk_cache is None:
+            chunk_cache = tokenization_cache.TokenizationCache(None, _tokenize)
+        missing = chunk_cache.get_missing(_get_row_sentences(chunk, sent_columns, row_filter))
+        chunksize = max(1, len(missing) // (4 * TOKENIZATION_WORKERS))
+        return chunk, chunk_cache, missing, pool.map_async(_tokenize, missing, chunksize)
+
+    with multiprocessing.get_context('fork').Pool(TOKENIZATION_WORKERS) as pool:
+        chunk, chunk_cache, missing, result = _submit(pool)
+        while chunk:
+            chunk_cache.update(missing, result.get())
+            # Tokenize the next chunk while this one is consumed.
+            next_chunk, next_cache, next_missing, next_result = _submit(pool)
+            for row in chunk:
+                yield row, chunk_cache
+            chunk, chunk_cache, missing, result = next_chunk, next_cache, next_missing, next_result
+
+
+def process_sentence(sent, max_seq_len, sos_tok=SOS_TOK, eos_tok=EOS_TOK,
+                     tok_cache=None):
+    '''process a sentence, using tok_cache (a TokenizationCache) if given '''
     max_seq_len -= 2
     assert max_seq_len > 0, "Max sequence length should be at least 2!"
     if isinstance(sent, str):
-        return [sos_tok] + TOKENIZER.tokenize(sent)[:max_seq_len] + [eos_tok]
+        tokens = tok_cache.tokenize(sent) if tok_cache is not None else TOKENIZER.tokenize(sent)
+        return [sos_tok] + tokens[:max_seq_len] + [eos_tok]
     elif isinstance(sent, list):
         assert isinstance(sent[0], str), "Invalid sentence found!"
         return [sos_tok] + sent[:max_seq_len] + [eos_tok]
@@ -180,6 +290,116 @@ def load_json_data(filename: str) -> Iterable:
             yield json.loads(line)
 
 
+def _count_newlines(filename: str) -> int:
+    count, last = 0, b"\n"
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 24), b""):
+            count += chunk.count(b"\n")
+            last = chunk[-1:]
+    # Count a final line without a trailing newline, as iterating over lines does.
+    return count if last == b"\n" else count + 1
+
+
+def count_lines(filename: str) -> int:
+    ''' Count the lines in a file, reading it in large binary chunks.
+
+    Results are cached in LINE_COUNT_CACHE_FILE (if set), keyed by path, size
+    and mtime, so repeated runs over the same corpus don't reread it.
+    '''
+    stat = os.stat(filename)
+    key = os.path.realpath(filename)
+    cache = {}
+    if LINE_COUNT_CACHE_FILE and os.path.isfile(LINE_COUNT_CACHE_FILE):
+        try:
+            with open(LINE_COUNT_CACHE_FILE) as fd:
+                cache = json.load(fd)
+        except ValueError:
+            cache = {}
+        entry = cache.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['count']
+    count = _count_newlines(filename)
+    if LINE_COUNT_CACHE_FILE:
+        cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'count': count}
+        # Write and rename, so concurrent runs never read a partial file.
+        temp_file = "%s.%d.tmp" % (LINE_COUNT_CACHE_FILE, os.getpid())
+        with open(temp_file, 'w') as fd:
+            json.dump(cache, fd)
+        os.replace(temp_file, LINE_COUNT_CACHE_FILE)
+    return count
+
+
+def _get_line_start(fd, offset: int) -> int:
+    ''' Return the offset of the first line of binary file fd starting at or after offset. '''
+    if offset == 0:
+        return 0
+    fd.seek(offset - 1)
+    fd.readline()
+    return fd.tell()
+
+
+class _ByteRange(io.RawIOBase):
+    ''' Read-only raw stream over bytes [start, stop) of binary file fd. '''
+
+    def __init__(self, fd, start, stop):
+        super().__init__()
+        self._fd = fd
+        self._fd.seek(start)
+        self._remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self._fd.read(min(len(buf), self._remaining))
+        buf[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._fd.close()
+        super().close()
+
+
+@contextlib.contextmanager
+def data_file_shard(k: int, num_shards: int):
+    ''' Within this context, open_data_file reads only shard k of num_shards of
+    each file. Yields a function returning the number of files read that way so
+    far, which is 0 if the data wasn't read with open_data_file. '''
+    global _DATA_FILE_SHARD, _DATA_FILE_SHARD_OPENS
+    _DATA_FILE_SHARD, _DATA_FILE_SHARD_OPENS = (k, num_shards), 0
+    try:
+        yield lambda: _DATA_FILE_SHARD_OPENS
+    finally:
+        _DATA_FILE_SHARD = None
+
+
+def open_data_file(path: str, encoding: str = None, errors: str = 'strict'):
+    ''' Open a data file for reading lines, like open(path) or, if encoding is
+    given, codecs.open(path, 'r', encoding, errors).
+
+    Within data_file_shard(k, num_shards), only the k-th of num_shards
+    contiguous byte ranges of the file is read, extended to whole lines: the
+    lines that start in that range. Loaders of streaming tasks use this, so that
+    each shard of a split is indexed (or counted) without reading the others.
+    '''
+    global _DATA_FILE_SHARD_OPENS
+    if _DATA_FILE_SHARD is None:
+        if encoding is None:
+            return open(path, 'r')
+        return codecs.open(path, 'r', encoding, errors=errors)
+    _DATA_FILE_SHARD_OPENS += 1
+    k, num_shards = _DATA_FILE_SHARD
+    fd = open(path, 'rb')
+    size = os.fstat(fd.fileno()).st_size
+    start = _get_line_start(fd, size * k // num_shards)
+    stop = _get_line_start(fd, size * (k + 1) // num_shards)
+    stream = io.BufferedReader(_ByteRange(fd, start, stop))
+    if encoding is None:
+        return io.TextIOWrapper(stream)
+    return codecs.getreader(encoding)(stream, errors)
+
+
 def load_lines(filename: str) -> Iterable[str]:
     ''' Load text data, yielding each line. '''
     with open(filename) as fd:
@@ -237,20 +457,22 @@ def load_diagnostic_tsv(
                 indexes.append(new_index)
         return indexes
 
+    tok_cache = get_tokenization_cache(data_file)
     with codecs.open(data_file, 'r', 'utf-8', errors='ignore') as data_fh:
         for _ in range(skip_rows):
             data_fh.readline()
-        for row_idx, row in enumerate(data_fh):
+        rows = (line.rstrip().split(delimiter) for line in data_fh)
+        for row_idx, (row, row_cache) in enumerate(iter_pretokenized(
+                rows, [s1_idx, s2_idx], tok_cache=tok_cache)):
             try:
-                row = row.rstrip().split(delimiter)
-                sent1 = process_sentence(row[s1_idx], max_seq_len)
+                sent1 = process_sentence(row[s1_idx], max_seq_len, tok_cache=row_cache)
                 if targ_map is not None:
                     targ = targ_map[row[targ_idx]]
                 elif targ_fn is not None:
                     targ = targ_fn(row[targ_idx])
                 else:
                     targ = int(row[targ_idx])
-                sent2 = process_sentence(row[s2_idx], max_seq_len)
+                sent2 = process_sentence(row[s2_idx], max_seq_len, tok_cache=row_cache)
                 sent2s.append(sent2)
 
                 sent1s.append(sent1)
@@ -270,6 +492,8 @@ def load_diagnostic_tsv(
             except Exception as e:
                 print(e, " file: %s, row: %d" % (data_file, row_idx))
                 continue
+    if tok_cache is not None:
+        tok_cache.save()
 
     ix_to_lex_sem_dic[0] = "missing"
     ix_to_pr_ar_str_dic[0] = "missing"
@@ -313,15 +537,21 @@ def load_tsv(
 
     To load only rows that have a certain value for a certain column, like genre in MNLI, set filter_idx and filter_value.'''
     sent1s, sent2s, targs, idxs = [], [], [], []
+    tok_cache = get_tokenization_cache(data_file)
+
+    def _row_filter(row):
+        return not filter_idx or row[filter_idx] == filter_value
+
     with codecs.open(data_file, 'r', 'utf-8', errors='ignore') as data_fh:
         for _ in range(skip_rows):
             data_fh.readline()
-        for row_idx, row in enumerate(data_fh):
+        rows = (line.strip().split(delimiter) for line in data_fh)
+        for row_idx, (row, row_cache) in enumerate(iter_pretokenized(
+                rows, [s1_idx, s2_idx], tok_cache=tok_cache, row_filter=_row_filter)):
             try:
-                row = row.strip().split(delimiter)
                 if filter_idx and row[filter_idx] != filter_value:
                     continue
-                sent1 = process_sentence(row[s1_idx], max_seq_len)
+                sent1 = process_sentence(row[s1_idx], max_seq_len, tok_cache=row_cache)
                 if (targ_idx is not None and not row[targ_idx]) or not len(sent1):
                     continue
 
@@ -336,7 +566,7 @@ def load_tsv(
                     targ = 0
 
                 if s2_idx is not None:
-                    sent2 = process_sentence(row[s2_idx], max_seq_len)
+                    sent2 = process_sentence(row[s2_idx], max_seq_len, tok_cache=row_cache)
                     if not len(sent2):
                         continue
                     sent2s.append(sent2)
@@ -351,6 +581,8 @@ def load_tsv(
             except Exception as e:
                 print(e, " file: %s, row: %d" % (data_file, row_idx))
                 continue
+    if tok_cache is not None:
+        tok_cache.save()
 
     if idx_idx is not None:
         return sent1s, sent2s, targs, idxs
@@ -0,0 +1,113 @@
+'''Readers for pretrained word vector files (GloVe / fastText text format).
+
+Text vector files have one word per line, followed by its vector as
+space-separated floats. fastText files also start with a "<count> <dim>"
+header line, which is skipped since it doesn't have d_word values.
+
+A vector file can be pre-converted once with convert_word_vectors (see
+scripts/convert_word_vectors.py), which writes next to it:
+    <file>.npy    float32 matrix with one row per word
+    <file>.words  the words, one per line, in the same order
+If these exist, they're used instead of the text file, and only the rows for
+words in the vocabulary are read from the memory-mapped matrix.
+'''
+import io
+import logging as log
+import os
+
+import numpy as np
+
+VECTORS_SUFFIX = ".npy"
+WORDS_SUFFIX = ".words"
+
+
+def _iter_text_vectors(vec_file, keep=None):
+    ''' Yield (word, vector) from a text vector file.
+
+    If keep is given, only words in keep have their vectors parsed and yielded.
+    '''
+    with io.open(vec_file, 'r', encoding='utf-8', newline='\n', errors='ignore') as vec_fh:
+        for line in vec_fh:
+            word, _, vec = line.partition(' ')
+            if keep is not None and word not in keep:
+                continue
+            yield word, np.array(vec.split(), dtype=np.float32)
+
+
+def has_converted_vectors(vec_file):
+    return (os.path.exists(vec_file + VECTORS_SUFFIX) and
+            os.path.exists(vec_file + WORDS_SUFFIX))
+
+
+def convert_word_vectors(vec_file):
+    ''' Convert a text vector file to the binary .npy + .words format.
+
+    Returns:
+        (num_words, d_word) of the converted vectors.
+    '''
+    raw_file = vec_file + VECTORS_SUFFIX + ".raw"
+    d_word, num_words = None, 0
+    with open(raw_file, 'wb') as raw_fh, \
+            io.open(vec_file + WORDS_SUFFIX + ".tmp", 'w', encoding='utf-8') as words_fh:
+        for word, vec in _iter_text_vectors(vec_file):
+            if d_word is None and len(vec) > 1:
+                d_word = len(vec)
+            if len(vec) != d_word:
+                continue  # e.g. the fastText header
+            vec.tofile(raw_fh)
+            words_fh.write(word + "\n")
+            num_words += 1
+    vectors = np.memmap(raw_file, dtype=np.float32, mode='r', shape=(num_words, d_word))
+    np.save(vec_file + VECTORS_SUFFIX + ".tmp", vectors)
+    del vectors
+    os.remove(raw_file)
+    # np.save appends .npy to names that don't end with it.
+    os.replace(vec_file + VECTORS_SUFFIX + ".tmp.npy", vec_file + VECTORS_SUFFIX)
+    os.replace(vec_file + WORDS_SUFFIX + ".tmp", vec_file + WORDS_SUFFIX)
+    return num_words, d_word
+
+
+def load_converted_vectors(vec_file):
+    ''' Load converted vectors, as (list of words, memory-mapped float32 matrix). '''
+    with io.open(vec_file + WORDS_SUFFIX, 'r', encoding='utf-8', newline='\n') as words_fh:
+        words = [line.rstrip("\n") for line in words_fh]
+    vectors = np.load(vec_file + VECTORS_SUFFIX, mmap_mode='r')
+    assert len(words) == len(vectors), \
+        "Converted vectors for %s have %d words but %d rows" % (vec_file, len(words), len(vectors))
+    return words, vectors
+
+
+def read_vocab_vectors(vec_file, token2idx, d_word):
+    ''' Read vectors for the words in a vocabulary.
+
+    Args:
+        vec_file: (str) path to a text vector file, possibly with a converted copy
+        token2idx: dict mapping each word to look up to its vocab index
+        d_word: (int) expected vector dimension
+
+    Returns:
+        (indices, vectors): int64 array of vocab indices, and a float32 matrix
+        with the corresponding vectors. If a word occurs more than once in the
+        file, its last vector is used.
+    '''
+    if has_converted_vectors(vec_file):
+        log.info("\tReading converted vectors from %s", vec_file + VECTORS_SUFFIX)
+        words, vectors = load_converted_vectors(vec_file)
+        assert vectors.shape[1] == d_word, \
+            "Vectors in %s have dimension %d, not %d" % (vec_file, vectors.shape[1], d_word)
+        row_by_idx = {token2idx[word]: row for row, word in enumerate(words)
+                      if word in token2idx}
+        indices = np.fromiter(row_by_idx.keys(), dtype=np.int64, count=len(row_by_idx))
+        rows = np.fromiter(row_by_idx.values(), dtype=np.int64, count=len(row_by_idx))
+        # Sorted rows read the mapped file sequentially.
+        order = np.argsort(rows)
+        return indices[order], np.asarray(vectors[rows[order]])
+
+    vec_by_idx = {}
+    for word, vec in _iter_text_vectors(vec_file, keep=token2idx):
+        if len(vec) == d_word:
+            vec_by_idx[token2idx[word]] = vec
+    indices = np.fromiter(vec_by_idx.keys(), dtype=np.int64, count=len(vec_by_idx))
+    vectors = np.stack(list(vec_by_idx.values())) if vec_by_idx else \
+        np.zeros((0, d_word), dtype=np.float32)
+    return indices, vectors
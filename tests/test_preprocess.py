@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src import preprocess
+from src.tasks.tasks import SingleClassificationTask
+
+
+class TinyTask(SingleClassificationTask):
+    ''' In-memory classification task, to test task caching. '''
+
+    def __init__(self, path, max_seq_len, name, **kw):
+        super().__init__(name, n_classes=2, **kw)
+        self.train_data_text = [[['a', 'b'], ['c']], [0, 1]]
+        self.val_data_text = [[['d']], [1]]
+        self.test_data_text = [[['e']], [0]]
+        self.sentences = self.train_data_text[0] + self.val_data_text[0]
+
+    def tokenizer_is_supported(self, tokenizer_name):
+        return True
+
+
+class TestGetTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.args = SimpleNamespace(data_dir=self.temp_dir, exp_dir=self.temp_dir,
+                                    pretrain_tasks='tiny', target_tasks='none',
+                                    tokenizer='MosesTokenizer', reload_tasks=0,
+                                    max_seq_len=10, max_targ_v_size=100)
+        registry = {'tiny': (TinyTask, 'tiny/', {})}
+        patcher = mock.patch.dict(preprocess.TASKS_REGISTRY, registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cached_task_text_not_loaded(self):
+        tasks, _, _ = preprocess.get_tasks(self.args)
+        self.assertEqual(tasks[0].example_counts,
+                         {'train': 2, 'val': 1, 'test': 1})
+
+        tasks, _, _ = preprocess.get_tasks(self.args)
+        task = tasks[0]
+        self.assertIn('_text_path', task.__dict__)
+        self.assertNotIn('train_data_text', task.__dict__)
+        self.assertEqual(task.example_counts,
+                         {'train': 2, 'val': 1, 'test': 1})
+
+        # The text is still loaded on first access.
+        self.assertEqual(task.val_data_text, [[['d']], [1]])
+        self.assertNotIn('_text_path', task.__dict__)
+
+
+if __name__ == '__main__':
+    unittest.main()